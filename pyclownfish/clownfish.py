@@ -8,6 +8,8 @@ Clownfish is an automatic management system for Lustre
 # pylint: disable=too-many-lines
 import threading
 import os
+import heapq
+import json
 import time
 import prettytable
 
@@ -22,6 +24,18 @@ from pyclownfish import clownfish_qos
 from pyclownfish import corosync
 from pyclownfish import clownfish_common
 
+# The file under the parent directory of the workspace that saves the
+# durations of the operations, so it is kept across restarts
+CLOWNFISH_OPERATION_HISTORY_FNAME = "operation_history.json"
+# The default number of threads that check the services in parallel
+CLOWNFISH_STATUS_THREAD_NUMBER = 16
+# The default max number of services being checked on each host
+CLOWNFISH_STATUS_HOST_LIMIT = 4
+# The default number of threads that fix the services in parallel
+CLOWNFISH_FIX_THREAD_NUMBER = 5
+# The default max number of services being fixed on each host
+CLOWNFISH_FIX_HOST_LIMIT = 2
+
 
 class ClownfishServiceStatus(object):
     """
@@ -46,12 +60,65 @@ class ClownfishServiceStatus(object):
         self.css_fix_time_dict = {}
         # The fixing services
         self.css_fix_services = []
+        # Heap of (priority, fix time, sequence, LustreService.ls_service_name)
+        # of the services that have problems and are not being fixed. The
+        # item is stale if it is not the value in css_problem_keys.
+        self.css_problem_heap = []
+        self.css_problem_sequence = 0
+        # The valid items in css_problem_heap.
+        # Keys are the LustreService.ls_service_name
+        self.css_problem_keys = {}
+        # Number of the services being fixed on the host.
+        # Keys are the hostnames
+        self.css_host_fixing = {}
+        # The time the current problem of the service was found.
+        # Keys are the LustreService.ls_service_name
+        self.css_problem_start_dict = {}
         # Protected by css_problem_condition
         self.css_fix_thread_waiting_number = 0
-        self.css_fix_thread_number = 5
+        self.css_fix_thread_number = instance.ci_fix_thread_number
+        # The max number of services being fixed on each host, so the
+        # failures on one host won't occupy all of the fix threads
+        self.css_fix_host_limit = instance.ci_fix_host_limit
         self.css_log = log
+        # Keys are the hostnames, values are the lists of
+        # LustreService.ls_service_name that have instances on the host
+        self.css_host_services = {}
+        # The services that should be checked because of the events from
+        # the watchers. Keys are the LustreService.ls_service_name
+        self.css_event_services = {}
+        # The services being scheduled to check status.
+        # Keys are the LustreService.ls_service_name, value is LustreService
+        self.css_schedule_services = {}
+        # Heap of (deadline, sequence, LustreService.ls_service_name), the
+        # item is stale if its deadline is not in css_schedule_deadlines
+        self.css_schedule_heap = []
+        self.css_schedule_sequence = 0
+        # The deadlines of the next checks, the service being checked has no
+        # deadline. Keys are the LustreService.ls_service_name
+        self.css_schedule_deadlines = {}
+        # Number of the running checks of the services on the host.
+        # Keys are the hostnames
+        self.css_host_checking = {}
+        # The current check intervals of the services.
+        # Keys are the LustreService.ls_service_name
+        self.css_interval_dict = {}
+        # The last time that the service had problem.
+        # Keys are the LustreService.ls_service_name
+        self.css_problem_time_dict = {}
+        # The last time the service was checked by running commands.
+        # Keys are the LustreService.ls_service_name
+        self.css_poll_time_dict = {}
+        # Protects all of the scheduling fields above and wakes up the
+        # status threads
+        self.css_schedule_condition = threading.Condition()
+        self.css_status_thread_number = instance.ci_status_thread_number
+        # The max number of running checks of services on each host
+        self.css_host_check_limit = instance.ci_status_host_limit
         if not no_operation:
             self.css_start_status_threads()
+            if instance.ci_status_watcher:
+                self.css_start_watchers()
             self.css_start_fix_threads()
 
     def css_service_status(self, service_name):
@@ -78,44 +145,284 @@ class ClownfishServiceStatus(object):
 
         self.css_problem_condition.acquire()
         if status.lss_has_problem():
+            if service_name not in self.css_problem_status_dict:
+                self.css_problem_start_dict[service_name] = time.time()
             self.css_problem_status_dict[service_name] = status
+            if (service_name not in self.css_problem_keys and
+                    service_name not in self.css_fix_services):
+                self._css_problem_push(service)
             self.css_problem_condition.notifyAll()
         else:
             if service_name in self.css_problem_status_dict:
                 del self.css_problem_status_dict[service_name]
+                problem_start = self.css_problem_start_dict.pop(service_name)
+                service.ls_recovery_record(time.time() - problem_start)
+            # The item in the heap becomes stale
+            if service_name in self.css_problem_keys:
+                del self.css_problem_keys[service_name]
         self.css_problem_condition.release()
 
-    def css_status_thread(self, service):
+    def _css_problem_push(self, service):
         """
-        Thread that checks status of a service
+        Queue a service that has problem to be fixed. The MGS or the MDT
+        combined with MGS has the highest priority, then the MDTs, then the
+        OSTs. For the services that have the same priority, the service
+        that has smaller fix time has the higher priority.
+        Condition css_problem_condition should be held.
         """
+        service_type = service.ls_service_type
         service_name = service.ls_service_name
-        instance = self.css_instance
+        if (service_type == lustre.LUSTRE_SERVICE_TYPE_MGT or
+                (service_type == lustre.LUSTRE_SERVICE_TYPE_MDT and
+                 service.lmdt_is_mgs)):
+            priority = 0
+        elif service_type == lustre.LUSTRE_SERVICE_TYPE_MDT:
+            priority = 1
+        else:
+            priority = 2
+        self.css_problem_sequence += 1
+        key = (priority, self.css_fix_time_dict.get(service_name, 0),
+               self.css_problem_sequence, service_name)
+        self.css_problem_keys[service_name] = key
+        heapq.heappush(self.css_problem_heap, key)
+
+    def _css_service_fix_hostnames(self, service):
+        """
+        Return the hostnames that fixing the service might run on
+        """
+        # pylint: disable=no-self-use
+        return [host.sh_hostname for host in service.ls_hosts()]
 
-        name = "thread_checking_service_%s" % service_name
-        thread_workspace = instance.ci_workspace + "/" + name
+    def _css_problem_pick(self):
+        """
+        Pick the service with the highest priority whose hosts are not
+        busy fixing other services. Return the status, or None.
+        Condition css_problem_condition should be held.
+        """
+        skipped = []
+        picked = None
+        while len(self.css_problem_heap) > 0:
+            key = heapq.heappop(self.css_problem_heap)
+            service_name = key[3]
+            if self.css_problem_keys.get(service_name) != key:
+                # The problem has disappeared or the service is requeued
+                continue
+            status = self.css_problem_status_dict[service_name]
+            hostnames = self._css_service_fix_hostnames(status.lss_service)
+            busy = False
+            for hostname in hostnames:
+                if (self.css_host_fixing.get(hostname, 0) >=
+                        self.css_fix_host_limit):
+                    busy = True
+                    break
+            if busy:
+                skipped.append(key)
+                continue
+            del self.css_problem_keys[service_name]
+            for hostname in hostnames:
+                self.css_host_fixing[hostname] = \
+                    self.css_host_fixing.get(hostname, 0) + 1
+            picked = status
+            break
+        for key in skipped:
+            heapq.heappush(self.css_problem_heap, key)
+        return picked
+
+    def _css_thread_log(self, name):
+        """
+        Return the child log of a thread, None on error
+        """
+        thread_workspace = self.css_instance.ci_workspace + "/" + name
         if not os.path.exists(thread_workspace):
             ret = utils.mkdir(thread_workspace)
             if ret:
                 self.css_log.cl_error("failed to create direcotry [%s] on local host",
                                       thread_workspace)
-                return -1
+                return None
         elif not os.path.isdir(thread_workspace):
             self.css_log.cl_error("[%s] is not a directory", thread_workspace)
-            return -1
-        log = self.css_log.cl_get_child(name, resultsdir=thread_workspace)
+            return None
+        return self.css_log.cl_get_child(name, resultsdir=thread_workspace)
 
-        log.cl_info("starting thread that checks status of service [%s]",
-                    service_name)
-        while instance.ci_running:
+    def _css_schedule(self, service_name, deadline):
+        """
+        Schedule the next check of the service.
+        Condition css_schedule_condition should be held.
+        """
+        self.css_schedule_sequence += 1
+        self.css_schedule_deadlines[service_name] = deadline
+        heapq.heappush(self.css_schedule_heap,
+                       (deadline, self.css_schedule_sequence, service_name))
+        self.css_schedule_condition.notifyAll()
+
+    def _css_service_hostnames(self, service_name):
+        """
+        Return the hostnames of the instances of the service
+        """
+        service = self.css_schedule_services[service_name]
+        hostnames = []
+        for service_instance in service.ls_instances.values():
+            hostname = service_instance.lsi_host.sh_hostname
+            if hostname not in hostnames:
+                hostnames.append(hostname)
+        return hostnames
+
+    def _css_pick_service(self):
+        """
+        Pick a service that is due to be checked and whose hosts are not
+        busy. Return (service_name, 0), or (None, seconds to wait).
+        Condition css_schedule_condition should be held.
+        """
+        now = time.time()
+        skipped = []
+        picked = None
+        wait_time = lustre.LUSTRE_SERVICE_STATUS_CHECK_INTERVAL
+        while len(self.css_schedule_heap) > 0:
+            deadline, sequence, service_name = self.css_schedule_heap[0]
+            if self.css_schedule_deadlines.get(service_name) != deadline:
+                # Rescheduled, skip the stale item
+                heapq.heappop(self.css_schedule_heap)
+                continue
+            if deadline > now:
+                wait_time = min(wait_time, deadline - now)
+                break
+            heapq.heappop(self.css_schedule_heap)
+            hostnames = self._css_service_hostnames(service_name)
+            busy = False
+            for hostname in hostnames:
+                if (self.css_host_checking.get(hostname, 0) >=
+                        self.css_host_check_limit):
+                    busy = True
+                    break
+            if busy:
+                skipped.append((deadline, sequence, service_name))
+                continue
+            picked = service_name
+            del self.css_schedule_deadlines[service_name]
+            for hostname in hostnames:
+                self.css_host_checking[hostname] = \
+                    self.css_host_checking.get(hostname, 0) + 1
+            break
+        for item in skipped:
+            heapq.heappush(self.css_schedule_heap, item)
+        if picked is not None:
+            return picked, 0
+        if len(skipped) > 0:
+            # Will be woken up when a check of the busy hosts finishes
+            wait_time = lustre.LUSTRE_SERVICE_STATUS_CHECK_INTERVAL
+        return None, wait_time
+
+    def _css_next_interval(self, service, status):
+        """
+        Return the interval to the next check of the service, shorter after
+        recent problems. Only when the watchers report the changes of the
+        service, the interval becomes longer when the service has been
+        stable, otherwise failures would be detected later.
+        Condition css_schedule_condition should be held.
+        """
+        service_name = service.ls_service_name
+        now = time.time()
+        if status.lss_has_problem():
+            self.css_problem_time_dict[service_name] = now
+        problem_time = self.css_problem_time_dict.get(service_name)
+        if (problem_time is not None and
+                now - problem_time < lustre.LUSTRE_SERVICE_STATUS_STABLE_TIME):
+            return lustre.LUSTRE_SERVICE_STATUS_MIN_INTERVAL
+        interval = self.css_interval_dict.get(service_name)
+        if (interval is None or
+                interval < lustre.LUSTRE_SERVICE_STATUS_CHECK_INTERVAL or
+                not self.css_service_watched(service)):
+            return lustre.LUSTRE_SERVICE_STATUS_CHECK_INTERVAL
+        return min(interval * 2, lustre.LUSTRE_SERVICE_STATUS_MAX_INTERVAL)
+
+    def css_host_event(self, log, host, event):
+        """
+        Check the services on the host immediately, called on the events of
+        the watcher on the host
+        """
+        log.cl_debug("scheduling checks of the services on host [%s] "
+                     "because of event [%s]", host.sh_hostname, event)
+        now = time.time()
+        self.css_schedule_condition.acquire()
+        for service_name in self.css_host_services.get(host.sh_hostname, []):
+            self.css_event_services[service_name] = True
+            # The service being checked will be rescheduled when finished
+            if service_name in self.css_schedule_deadlines:
+                self._css_schedule(service_name, now)
+        self.css_schedule_condition.release()
+
+    def css_service_watched(self, service):
+        """
+        Whether the changes on all of the hosts of the service are being
+        reported by the watchers
+        """
+        if not self.css_instance.ci_status_watcher:
+            return False
+        for service_instance in service.ls_instances.values():
+            if not service_instance.lsi_host.lsh_watcher_alive():
+                return False
+        return True
+
+    def _css_check_service(self, log, service, woken):
+        """
+        Check the status of a service and update it
+        """
+        service_name = service.ls_service_name
+        status = self.css_service_status(service_name)
+        # If the watchers report the changes, only check the status on
+        # events and poll in a low frequency in case of lost events
+        now = time.time()
+        poll_time = self.css_poll_time_dict.get(service_name, 0)
+        if (status is None or woken or status.lss_has_problem() or
+                now - poll_time >= lustre.LUSTRE_SERVICE_STATUS_POLL_INTERVAL or
+                not self.css_service_watched(service)):
             status = lustre.LustreServiceStatus(service)
             status.lss_check(log)
+            self.css_poll_time_dict[service_name] = now
+        else:
+            # Nothing has changed, so the status is still up to date
+            status.lss_update_time = now
+        return status
+
+    def css_status_thread(self, thread_id):
+        """
+        Thread that checks status of the services that are due
+        """
+        instance = self.css_instance
+
+        name = "thread_checking_status_%s" % thread_id
+        log = self._css_thread_log(name)
+        if log is None:
+            return -1
 
+        log.cl_info("starting thread [%s] that checks status of services",
+                    thread_id)
+        self.css_schedule_condition.acquire()
+        while instance.ci_running:
+            service_name, wait_time = self._css_pick_service()
+            if service_name is None:
+                self.css_schedule_condition.wait(wait_time)
+                continue
+            woken = self.css_event_services.pop(service_name, False)
+            service = self.css_schedule_services[service_name]
+            self.css_schedule_condition.release()
+
+            status = self._css_check_service(log, service, woken)
             self.css_update_status(status)
 
-            time.sleep(lustre.LUSTRE_SERVICE_STATUS_CHECK_INTERVAL)
-        log.cl_info("thread that checks status of service [%s] exited",
-                    service_name)
+            self.css_schedule_condition.acquire()
+            for hostname in self._css_service_hostnames(service_name):
+                self.css_host_checking[hostname] -= 1
+            interval = self._css_next_interval(service, status)
+            self.css_interval_dict[service_name] = interval
+            status.lss_interval = interval
+            if service_name in self.css_event_services:
+                # Events happened during the check
+                interval = 0
+            self._css_schedule(service_name, time.time() + interval)
+        self.css_schedule_condition.release()
+        log.cl_info("thread [%s] that checks status of services exited",
+                    thread_id)
         return 0
 
     def css_start_status_threads(self):
@@ -130,128 +437,87 @@ class ClownfishServiceStatus(object):
             services = lustrefs.lf_services()
             for service in services:
                 if service.ls_service_name not in service_dict:
-                    service_dict[service.ls_service_name] = True
-                    utils.thread_start(self.css_status_thread,
-                                       (service, ))
+                    service_dict[service.ls_service_name] = service
 
         for mgs in instance.ci_mgs_dict.values():
             if mgs.ls_service_name not in service_dict:
-                utils.thread_start(self.css_status_thread,
-                                   (mgs, ))
-                service_dict[mgs.ls_service_name] = True
+                service_dict[mgs.ls_service_name] = mgs
+
+        self.css_schedule_condition.acquire()
+        now = time.time()
+        for service_name, service in service_dict.iteritems():
+            for service_instance in service.ls_instances.values():
+                hostname = service_instance.lsi_host.sh_hostname
+                if hostname not in self.css_host_services:
+                    self.css_host_services[hostname] = []
+                if service_name not in self.css_host_services[hostname]:
+                    self.css_host_services[hostname].append(service_name)
+            self.css_schedule_services[service_name] = service
+            self._css_schedule(service_name, now)
+        self.css_schedule_condition.release()
+
+        thread_number = min(self.css_status_thread_number, len(service_dict))
+        for thread_id in range(thread_number):
+            utils.thread_start(self.css_status_thread, (thread_id, ))
+
+    def css_start_watchers(self):
+        """
+        Start the watchers on the hosts of the services
+        """
+        for host in self.css_instance.ci_hosts.values():
+            if host.sh_hostname not in self.css_host_services:
+                continue
+            host.lsh_watcher_start(self.css_log, self.css_host_event)
 
     def css_fix_thread(self, thread_id):
         """
         Thread that fix the services
         """
-        # pylint: disable=too-many-branches,too-many-statements,too-many-locals
         instance = self.css_instance
 
         name = "thread_fixing_service_%s" % thread_id
-        thread_workspace = instance.ci_workspace + "/" + name
-        if not os.path.exists(thread_workspace):
-            ret = utils.mkdir(thread_workspace)
-            if ret:
-                self.css_log.cl_error("failed to create direcotry [%s] on local host",
-                                      thread_workspace)
-                return -1
-        elif not os.path.isdir(thread_workspace):
-            self.css_log.cl_error("[%s] is not a directory", thread_workspace)
+        log = self._css_thread_log(name)
+        if log is None:
             return -1
-        log = self.css_log.cl_get_child(name, resultsdir=thread_workspace)
 
         log.cl_info("starting thread [%s] that fix services", thread_id)
         fixing_status = None
         while instance.ci_running:
             self.css_problem_condition.acquire()
             if fixing_status is not None:
-                fix_name = fixing_status.lss_service.ls_service_name
+                fix_service = fixing_status.lss_service
+                fix_name = fix_service.ls_service_name
                 assert fix_name in self.css_fix_services
                 fix_index = self.css_fix_services.index(fix_name)
                 del self.css_fix_services[fix_index]
+                for hostname in self._css_service_fix_hostnames(fix_service):
+                    self.css_host_fixing[hostname] -= 1
+                # The check threads might have found the problem again
+                # during fixing
+                if fix_name in self.css_problem_status_dict:
+                    self._css_problem_push(fix_service)
 
             # When HA is disabled, this thread does nothing
             self.css_fix_thread_waiting_number += 1
             self.css_problem_condition.notifyAll()
-            while ((not instance.ci_native_ha) or
-                   (len(self.css_problem_status_dict) == 0)):
-                self.css_problem_condition.wait()
-            self.css_fix_thread_waiting_number -= 1
             #
             # Do no remove the status from the dictionary, remove it after
             # fixing, because the check threads might add the status when
             # fixing anyway.
             #
-            # The priority level of services is:
-            # 1. The MGS or the MDT combined with MGS
-            # 2. The MDTs
-            # 3. The OSTs
-            # For the services that have the same priority, the service that
-            # has smaller fix time has the higher priority
-            fixing_status = None
-            for status in self.css_problem_status_dict.values():
-                service = status.lss_service
-                service_type = service.ls_service_type
-                service_name = service.ls_service_name
-
-                if service_name in self.css_fix_services:
-                    continue
-
-                if fixing_status is None:
-                    fixing_status = status
-                    continue
-
-                fix_service = fixing_status.lss_service
-                fix_type = fix_service.ls_service_type
-                fix_name = fix_service.ls_service_name
-                fix_is_mgs = bool((fix_type == lustre.LUSTRE_SERVICE_TYPE_MGT) or
-                                  (fix_type == lustre.LUSTRE_SERVICE_TYPE_MDT and
-                                   fix_service.lmdt_is_mgs))
-
-                is_mgs = bool((service_type == lustre.LUSTRE_SERVICE_TYPE_MGT) or
-                              (service_type == lustre.LUSTRE_SERVICE_TYPE_MDT and
-                               service.lmdt_is_mgs))
-
-                if fix_name not in self.css_fix_time_dict:
-                    fix_time_ealier = True
-                elif service_name not in self.css_fix_time_dict:
-                    fix_time_ealier = False
-                else:
-                    fix_time_ealier = bool(self.css_fix_time_dict[fix_name] <=
-                                           self.css_fix_time_dict[service_name])
-
-                if is_mgs:
-                    if fix_is_mgs:
-                        if not fix_time_ealier:
-                            fixing_status = status
-                    else:
-                        fixing_status = status
-                elif service_type == lustre.LUSTRE_SERVICE_TYPE_MDT:
-                    if fix_is_mgs:
-                        pass
-                    elif fix_type == lustre.LUSTRE_SERVICE_TYPE_MDT:
-                        if not fix_time_ealier:
-                            fixing_status = status
-                    else:
-                        fixing_status = status
-                else:
-                    if fix_is_mgs:
-                        pass
-                    elif fix_type == lustre.LUSTRE_SERVICE_TYPE_MDT:
-                        pass
-                    else:
-                        if not fix_time_ealier:
-                            fixing_status = status
-            if fixing_status is not None:
-                fix_name = fixing_status.lss_service.ls_service_name
-                self.css_fix_time_dict[fix_name] = time.time()
-                assert fix_name not in self.css_fix_services
-                self.css_fix_services.append(fix_name)
+            while True:
+                if instance.ci_native_ha:
+                    fixing_status = self._css_problem_pick()
+                    if fixing_status is not None:
+                        break
+                self.css_problem_condition.wait()
+            self.css_fix_thread_waiting_number -= 1
+            fix_name = fixing_status.lss_service.ls_service_name
+            self.css_fix_time_dict[fix_name] = time.time()
+            assert fix_name not in self.css_fix_services
+            self.css_fix_services.append(fix_name)
             self.css_problem_condition.release()
 
-            if fixing_status is None:
-                continue
-
             service = fixing_status.lss_service
             service_name = service.ls_service_name
 
@@ -299,7 +565,11 @@ class ClownfishInstance(object):
     # pylint: disable=too-many-arguments,too-many-public-methods
     def __init__(self, log, workspace, lazy_prepare, hosts, mgs_dict, lustres,
                  natvie_ha, corosync_cluster, qos_dict, iso_path, local_host,
-                 mnt_path, no_operation=False):
+                 mnt_path, no_operation=False, status_watcher=False,
+                 fix_thread_number=CLOWNFISH_FIX_THREAD_NUMBER,
+                 fix_host_limit=CLOWNFISH_FIX_HOST_LIMIT,
+                 status_thread_number=CLOWNFISH_STATUS_THREAD_NUMBER,
+                 status_host_limit=CLOWNFISH_STATUS_HOST_LIMIT):
         self.ci_lazy_prepare = lazy_prepare
         # Keys are the host IDs, not the hostnames
         self.ci_hosts = hosts
@@ -315,12 +585,28 @@ class ClownfishInstance(object):
         self.ci_corosync_cluster = corosync_cluster
         # ISO path of Clownfish
         self.ci_iso_path = iso_path
+        # Whether the watchers on the hosts report the status changes
+        self.ci_status_watcher = status_watcher
+        # The number of threads that fix the services in parallel
+        self.ci_fix_thread_number = fix_thread_number
+        # The max number of services being fixed on each host
+        self.ci_fix_host_limit = fix_host_limit
+        # The number of threads that check the services in parallel
+        self.ci_status_thread_number = status_thread_number
+        # The max number of services being checked on each host
+        self.ci_status_host_limit = status_host_limit
         self.ci_service_status = ClownfishServiceStatus(self, log, no_operation)
         self.ci_qos_dict = qos_dict
         # Local host to umount the ISO
         self.ci_local_host = local_host
         # The mnt path of the ISO
         self.ci_mnt_path = mnt_path
+        # The durations of the cluster wide operations, used to estimate
+        # the time of the plans
+        history_fpath = (os.path.dirname(workspace.rstrip("/")) + "/" +
+                         CLOWNFISH_OPERATION_HISTORY_FNAME)
+        self.ci_operation_history = lustre.LustreOperationHistory(history_fpath)
+        self.ci_operation_history.loh_load(log)
 
     def ci_mount_lustres(self, log):
         """
@@ -373,108 +659,201 @@ class ClownfishInstance(object):
                 return -1
         return 0
 
-    def ci_umount_all(self, log):
+    def _ci_lock_all(self, log, operation):
         """
-        Umount all file system and MGS
+        Acquire the write locks of all MGS and file systems, return the
+        lock handles, or None on failure
         """
-        ret = self.ci_umount_lustres(log)
-        if ret:
-            log.cl_stderr("failed to umount all Lustre file systems")
-            return -1
+        lock_handles = []
+        for mgs in self.ci_mgs_dict.values():
+            mgs_lock_handle = mgs.ls_lock.rwl_writer_acquire(log)
+            if mgs_lock_handle is None:
+                log.cl_stderr("aborting %s all file systems and MGS",
+                              operation)
+                for lock_handle in reversed(lock_handles):
+                    lock_handle.rwh_release()
+                return None
+            lock_handles.append(mgs_lock_handle)
 
-        ret = self.ci_umount_mgs(log)
-        if ret:
-            log.cl_stderr("failed to umount all MGS")
-            return -1
+        for lustrefs in self.ci_lustres.values():
+            fs_lock_handle = lustrefs.lf_lock.rwl_writer_acquire(log)
+            if fs_lock_handle is None:
+                log.cl_stderr("aborting %s all file systems and MGS",
+                              operation)
+                for lock_handle in reversed(lock_handles):
+                    lock_handle.rwh_release()
+                return None
+            lock_handles.append(fs_lock_handle)
+        return lock_handles
 
-        return 0
+    def _ci_graph(self, operation_name, host_concurrency):
+        """
+        Return an empty graph of a cluster wide operation
+        """
+        if host_concurrency is None:
+            if operation_name == "format":
+                host_concurrency = lustre.LUSTRE_FORMAT_HOST_CONCURRENCY
+            else:
+                host_concurrency = lustre.LUSTRE_OPERATION_HOST_CONCURRENCY
+        return lustre.LustreOperationGraph(operation_name,
+                                           host_concurrency=host_concurrency,
+                                           progress=True,
+                                           history=self.ci_operation_history)
 
-    def ci_umount_all_nolock(self, log):
+    def ci_mount_plan(self, host_concurrency=None):
         """
-        Umount all file system and MGS
-        Locks should be held
+        Return the graph that mounts all MGS and file systems. Each MGS is
+        mounted before the file systems that share it.
         """
+        graph = self._ci_graph("mount", host_concurrency)
+        for mgs in self.ci_mgs_dict.values():
+            hostnames = [host.sh_hostname for host in mgs.ls_hosts()]
+            graph.lg_add(mgs.ls_service_name,
+                         "MGS [%s]" % mgs.ls_service_name,
+                         mgs.ls_mount_nolock, (), hostnames)
+
         for lustrefs in self.ci_lustres.values():
-            ret = lustrefs.lf_umount_nolock(log)
-            if ret:
-                log.cl_stderr("failed to umount file system [%s]",
-                              lustrefs.lf_fsname)
-                return -1
+            mgs_names = []
+            if lustrefs.lf_mgs is not None:
+                mgs_names.append(lustrefs.lf_mgs.ls_service_name)
+            lustrefs.lf_mount_add(graph, mgs_names=mgs_names)
+        return graph
+
+    def ci_umount_plan(self, host_concurrency=None):
+        """
+        Return the graph that umounts all file systems and MGS. Each MGS is
+        umounted after all of the file systems that share it.
+        """
+        graph = self._ci_graph("umount", host_concurrency)
+        # Key: MGS service name, value: the operations before umounting it
+        mgs_dependencies = {}
+        for lustrefs in self.ci_lustres.values():
+            names = lustrefs.lf_umount_add(graph)
+            if lustrefs.lf_mgs is not None:
+                mgs_name = lustrefs.lf_mgs.ls_service_name
+                if mgs_name not in mgs_dependencies:
+                    mgs_dependencies[mgs_name] = []
+                mgs_dependencies[mgs_name] += names
 
         for mgs in self.ci_mgs_dict.values():
-            ret = mgs.ls_umount_nolock(log)
+            hostnames = [host.sh_hostname for host in mgs.ls_hosts()]
+            graph.lg_add(mgs.ls_service_name,
+                         "MGS [%s]" % mgs.ls_service_name,
+                         mgs.ls_umount_nolock, (), hostnames,
+                         dependencies=mgs_dependencies.get(mgs.ls_service_name))
+        return graph
+
+    def ci_format_plan(self, log, host_concurrency=None):
+        """
+        Return the graph that formats all MGS and file systems, None on
+        error
+        """
+        graph = self._ci_graph("format", host_concurrency)
+        for mgs in self.ci_mgs_dict.values():
+            hostnames = [host.sh_hostname for host in mgs.ls_hosts()]
+            graph.lg_add(mgs.ls_service_name,
+                         "MGS [%s]" % mgs.ls_service_name,
+                         mgs.ls_format_nolock, (), hostnames)
+
+        for lustrefs in self.ci_lustres.values():
+            ret = lustrefs.lf_format_add(log, graph)
             if ret:
-                log.cl_stderr("failed to umount MGS [%s]",
-                              mgs.ls_service_name)
-                return -1
-        return 0
+                log.cl_stderr("failed to plan formatting Lustre file system "
+                              "[%s]",
+                              lustrefs.lf_fsname)
+                return None
+        return graph
 
-    def ci_mount_all(self, log):
+    def _ci_run_plan(self, log, graph, dry_run):
         """
-        Mount all file system and MGS
+        Run the graph, or only print the plan if dry_run
         """
-        ret = self.ci_mount_mgs(log)
+        # pylint: disable=no-self-use
+        operation_name = graph.lg_operation_name
+        if dry_run:
+            log.cl_stdout("plan to %s all file systems and MGS",
+                          operation_name)
+            return graph.lg_plan(log)
+
+        log.cl_stdout("starting to %s all file systems and MGS",
+                      operation_name)
+        ret = graph.lg_run(log)
+        graph.lg_report(log)
         if ret:
-            log.cl_stderr("failed to mount all MGS")
+            log.cl_stderr("failed to %s all file systems and MGS",
+                          operation_name)
             return -1
+        log.cl_stdout("finished to %s all file systems and MGS",
+                      operation_name)
+        return 0
 
-        ret = self.ci_mount_lustres(log)
-        if ret:
-            log.cl_stderr("failed to mount all Lustre file systems")
+    def ci_umount_all(self, log, dry_run=False, host_concurrency=None):
+        """
+        Umount all file system and MGS
+        """
+        lock_handles = self._ci_lock_all(log, "umounting")
+        if lock_handles is None:
             return -1
 
-        return 0
+        ret = self.ci_umount_all_nolock(log, dry_run=dry_run,
+                                        host_concurrency=host_concurrency)
 
-    def ci_format_all_nolock(self, log):
+        for lock_handle in reversed(lock_handles):
+            lock_handle.rwh_release()
+        return ret
+
+    def ci_umount_all_nolock(self, log, dry_run=False, host_concurrency=None):
         """
-        Format all file system and MGS
+        Umount all file system and MGS
         Locks should be held
         """
-        ret = self.ci_umount_all_nolock(log)
+        graph = self.ci_umount_plan(host_concurrency=host_concurrency)
+        return self._ci_run_plan(log, graph, dry_run)
+
+    def ci_mount_all(self, log, dry_run=False, host_concurrency=None):
+        """
+        Mount all file system and MGS
+        """
+        lock_handles = self._ci_lock_all(log, "mounting")
+        if lock_handles is None:
+            return -1
+
+        graph = self.ci_mount_plan(host_concurrency=host_concurrency)
+        ret = self._ci_run_plan(log, graph, dry_run)
+
+        for lock_handle in reversed(lock_handles):
+            lock_handle.rwh_release()
+        return ret
+
+    def ci_format_all_nolock(self, log, host_concurrency=None, dry_run=False):
+        """
+        Format all file system and MGS. All of the targets are formatted in
+        parallel, at most host_concurrency of them on each host at the same
+        time.
+        Locks should be held
+        """
+        ret = self.ci_umount_all_nolock(log, dry_run=dry_run,
+                                        host_concurrency=host_concurrency)
         if ret:
             log.cl_stderr("failed to umount all")
             return ret
 
-        for mgs in self.ci_mgs_dict.values():
-            ret = mgs.ls_format_nolock(log)
-            if ret:
-                log.cl_stderr("failed to umount and format MGS [%s]",
-                              mgs.ls_service_name)
-                return -1
-
-        for lustrefs in self.ci_lustres.values():
-            ret = lustrefs.lf_format_nolock(log)
-            if ret:
-                log.cl_stderr("failed to umount and format Lustre file system "
-                              "[%s]",
-                              lustrefs.lf_fsname)
-                return -1
-        return 0
+        graph = self.ci_format_plan(log, host_concurrency=host_concurrency)
+        if graph is None:
+            return -1
+        return self._ci_run_plan(log, graph, dry_run)
 
-    def ci_format_all(self, log):
+    def ci_format_all(self, log, host_concurrency=None, dry_run=False):
         """
         Format all file system and MGS
         """
-        lock_handles = []
-        for mgs in self.ci_mgs_dict.values():
-            mgs_lock_handle = mgs.ls_lock.rwl_writer_acquire(log)
-            if mgs_lock_handle is None:
-                log.cl_stderr("aborting formating all file systems and MGS")
-                for lock_handle in reversed(lock_handles):
-                    lock_handle.rwh_release()
-                return -1
-            lock_handles.append(mgs_lock_handle)
-
-        for lustrefs in self.ci_lustres.values():
-            fs_lock_handle = lustrefs.lf_lock.rwl_writer_acquire(log)
-            if fs_lock_handle is None:
-                log.cl_stderr("aborting formating all file systems and MGS")
-                for lock_handle in reversed(lock_handles):
-                    lock_handle.rwh_release()
-                return -1
-            lock_handles.append(fs_lock_handle)
+        lock_handles = self._ci_lock_all(log, "formating")
+        if lock_handles is None:
+            return -1
 
-        ret = self.ci_format_all_nolock(log)
+        ret = self.ci_format_all_nolock(log,
+                                        host_concurrency=host_concurrency,
+                                        dry_run=dry_run)
 
         for lock_handle in reversed(lock_handles):
             lock_handle.rwh_release()
@@ -497,6 +876,17 @@ class ClownfishInstance(object):
             log.cl_stderr("failed to umount all")
             return ret
 
+        if self.ci_lazy_prepare:
+            install_hosts = lustre.lustre_hosts_need_install(log,
+                                                             self.ci_hosts.values())
+        else:
+            install_hosts = self.ci_hosts.values()
+        ret = lustre.lustre_rpms_distribute(log, workspace + "/distribution",
+                                            install_hosts)
+        if ret:
+            log.cl_stderr("failed to distribute Lustre RPMs to hosts")
+            return ret
+
         args_array = []
         thread_ids = []
         for host in self.ci_hosts.values():
@@ -567,7 +957,17 @@ class ClownfishInstance(object):
         self.ci_running = False
 
         ret = 0
-        command = ("umount %s" % (self.ci_mnt_path))
+        for host in self.ci_hosts.values():
+            host.lsh_agent_stop(log)
+            host.lsh_watcher_stop(log)
+            retval = host.sh_control_stop(log)
+            if retval:
+                log.cl_error("failed to stop SSH master connection to host "
+                             "[%s]", host.sh_hostname)
+                ret = -1
+        ssh_host.ssh_control_dir_remove()
+
+        command = ["umount", self.ci_mnt_path]
         retval = self.ci_local_host.sh_run(log, command)
         if retval.cr_exit_status:
             log.cl_error("failed to run command [%s] on host [%s], "
@@ -579,7 +979,7 @@ class ClownfishInstance(object):
                          retval.cr_stderr)
             ret = -1
 
-        command = ("rmdir %s" % (self.ci_mnt_path))
+        command = ["rmdir", self.ci_mnt_path]
         retval = self.ci_local_host.sh_run(log, command)
         if retval.cr_exit_status:
             log.cl_error("failed to run command [%s] on host [%s], "
@@ -597,6 +997,10 @@ class ClownfishInstance(object):
         Enable high availability
         """
         self.ci_native_ha = True
+        service_status = self.ci_service_status
+        service_status.css_problem_condition.acquire()
+        service_status.css_problem_condition.notifyAll()
+        service_status.css_problem_condition.release()
 
     def ci_native_ha_disable(self, log):
         """
@@ -631,6 +1035,82 @@ class ClownfishInstance(object):
             table.add_row([lustrefs.lf_fsname])
         log.cl_stdout(table)
 
+    def ci_command_stats(self, log, hostnames=None, json_format=False):
+        """
+        Print the statistics of the commands run on the hosts
+        """
+        stats = utils.COMMAND_STATISTICS.cst_encode(hostnames=hostnames)
+        if json_format:
+            fact_caches = {}
+            for host in self.ci_hosts.values():
+                if (hostnames is not None and
+                        host.sh_hostname not in hostnames):
+                    continue
+                hit_misses = host.sh_fact_cache.hfc_stats()
+                fact_caches[host.sh_hostname] = dict(
+                    (name, {"hits": hits, "misses": misses})
+                    for name, (hits, misses) in hit_misses.iteritems())
+            stats["fact_caches"] = fact_caches
+            log.cl_stdout(json.dumps(stats, indent=4, sort_keys=True))
+            return 0
+
+        table = prettytable.PrettyTable()
+        table.field_names = ["Host", "Command", "Count", "Failures",
+                             "Timeouts", "Average", "P50", "P95", "P99",
+                             "Max", "Stdout bytes", "Stderr bytes"]
+        for hostname in sorted(stats["hosts"]):
+            classes = stats["hosts"][hostname]
+            for cmd_class in sorted(classes):
+                cmd_stats = classes[cmd_class]
+                table.add_row([hostname, cmd_class, cmd_stats["count"],
+                               cmd_stats["failures"], cmd_stats["timeouts"],
+                               "%.3f" % cmd_stats["average"],
+                               "%.3f" % cmd_stats["p50"],
+                               "%.3f" % cmd_stats["p95"],
+                               "%.3f" % cmd_stats["p99"],
+                               "%.3f" % cmd_stats["max"],
+                               cmd_stats["stdout_bytes"],
+                               cmd_stats["stderr_bytes"]])
+        log.cl_stdout(table)
+        return 0
+
+    def ci_reboot_hosts(self, log, hostnames, wave_size=None):
+        """
+        Reboot the hosts in parallel, the hosts that share a service are
+        never rebooted at the same time
+        """
+        hosts = []
+        for hostname in hostnames:
+            found = None
+            for host in self.ci_hosts.values():
+                if host.sh_hostname == hostname:
+                    found = host
+                    break
+            if found is None:
+                log.cl_stderr("host [%s] is not configured", hostname)
+                return -1
+            if found not in hosts:
+                hosts.append(found)
+
+        services = list(self.ci_mgs_dict.values())
+        for lustrefs in self.ci_lustres.values():
+            services += lustrefs.lf_services()
+        conflicts = lustre.lustre_ha_conflicts(services)
+
+        if wave_size is None:
+            wave_size = ssh_host.REBOOT_WAVE_SIZE
+        orchestrator = ssh_host.RebootOrchestrator(hosts, wave_size=wave_size,
+                                                   conflicts=conflicts)
+        ret = orchestrator.ro_run(log)
+        for host in hosts:
+            if host.sh_hostname in orchestrator.ro_durations:
+                log.cl_stdout("host [%s] rebooted in [%.1f] seconds",
+                              host.sh_hostname,
+                              orchestrator.ro_durations[host.sh_hostname])
+            else:
+                log.cl_stdout("host [%s] failed to reboot", host.sh_hostname)
+        return ret
+
     def ci_name2service(self, service_name):
         """
         Find the service by name
@@ -847,6 +1327,50 @@ def parse_qos_config(log, lustre_fs, lustre_config, config_fpath, workspace):
     return 0, qos
 
 
+def config_positive_number(log, config, config_fpath, key, default):
+    """
+    Return the positive number configured by the key, or the default value
+    if not configured. Return None if the configured value is invalid.
+    """
+    value = utils.config_value(config, key)
+    if value is None:
+        log.cl_info("no [%s] is configured, using default value [%d]",
+                    key, default)
+        return default
+    if value < 1:
+        log.cl_error("invalid [%s] [%s], should be positive, please correct "
+                     "file [%s]", key, value, config_fpath)
+        return None
+    return value
+
+
+def config_host_limit(log, config, config_fpath, key, default, thread_key,
+                      thread_number):
+    """
+    Return the max number of the threads that could work on the same host.
+    The limit should be less than the number of threads, otherwise one host
+    could occupy all of the threads. Return None if the configured value is
+    invalid.
+    """
+    # pylint: disable=too-many-arguments
+    value = utils.config_value(config, key)
+    if value is None:
+        value = min(default, max(thread_number - 1, 1))
+        log.cl_info("no [%s] is configured, using default value [%d]",
+                    key, value)
+        return value
+    if value < 1:
+        log.cl_error("invalid [%s] [%s], should be positive, please correct "
+                     "file [%s]", key, value, config_fpath)
+        return None
+    if thread_number > 1 and value >= thread_number:
+        log.cl_error("invalid [%s] [%s], should be less than [%s] [%d], "
+                     "please correct file [%s]", key, value, thread_key,
+                     thread_number, config_fpath)
+        return None
+    return value
+
+
 def init_instance(log, workspace, config, config_fpath, no_operation=False):
     """
     Parse the config and init the instance
@@ -867,6 +1391,46 @@ def init_instance(log, workspace, config, config_fpath, no_operation=False):
         lazy_prepare_string = "disabled"
     log.cl_info("lazy prepare is %s", lazy_prepare_string)
 
+    use_agent = utils.config_value(config, cstr.CSTR_REMOTE_AGENT)
+    if use_agent is None:
+        use_agent = False
+        log.cl_info("no [%s] is configured, using default value false",
+                    cstr.CSTR_REMOTE_AGENT)
+
+    status_watcher = utils.config_value(config, cstr.CSTR_STATUS_WATCHER)
+    if status_watcher is None:
+        status_watcher = False
+        log.cl_info("no [%s] is configured, using default value false",
+                    cstr.CSTR_STATUS_WATCHER)
+
+    status_thread_number = config_positive_number(log, config, config_fpath,
+                                                  cstr.CSTR_STATUS_THREAD_NUMBER,
+                                                  CLOWNFISH_STATUS_THREAD_NUMBER)
+    if status_thread_number is None:
+        return None
+
+    status_host_limit = config_host_limit(log, config, config_fpath,
+                                          cstr.CSTR_STATUS_HOST_LIMIT,
+                                          CLOWNFISH_STATUS_HOST_LIMIT,
+                                          cstr.CSTR_STATUS_THREAD_NUMBER,
+                                          status_thread_number)
+    if status_host_limit is None:
+        return None
+
+    fix_thread_number = config_positive_number(log, config, config_fpath,
+                                               cstr.CSTR_FIX_THREAD_NUMBER,
+                                               CLOWNFISH_FIX_THREAD_NUMBER)
+    if fix_thread_number is None:
+        return None
+
+    fix_host_limit = config_host_limit(log, config, config_fpath,
+                                       cstr.CSTR_FIX_HOST_LIMIT,
+                                       CLOWNFISH_FIX_HOST_LIMIT,
+                                       cstr.CSTR_FIX_THREAD_NUMBER,
+                                       fix_thread_number)
+    if fix_host_limit is None:
+        return None
+
     dist_configs = utils.config_value(config, cstr.CSTR_LUSTRE_DISTRIBUTIONS)
     if dist_configs is None:
         log.cl_error("can NOT find [%s] in the config file, "
@@ -980,7 +1544,9 @@ def init_instance(log, workspace, config, config_fpath, no_operation=False):
         host = lustre.LustreServerHost(hostname,
                                        lustre_rpms=lustre_distribution,
                                        identity_file=ssh_identity_file,
-                                       host_id=host_id)
+                                       host_id=host_id,
+                                       ssh_multiplex=True,
+                                       use_agent=use_agent)
         hosts[host_id] = host
 
     lustre_configs = utils.config_value(config, cstr.CSTR_LUSTRES)
@@ -1502,8 +2068,13 @@ def init_instance(log, workspace, config, config_fpath, no_operation=False):
     mnt_path = "/mnt/" + utils.random_word(8)
 
     if not no_operation:
-        command = ("mkdir -p %s && mount -o loop %s %s" %
-                   (mnt_path, iso_path, mnt_path))
+        ret = local_host.sh_mkdir(log, mnt_path)
+        if ret:
+            log.cl_error("failed to create directory [%s] on host [%s]",
+                         mnt_path, local_host.sh_hostname)
+            return None
+
+        command = ["mount", "-o", "loop", iso_path, mnt_path]
         retval = local_host.sh_run(log, command)
         if retval.cr_exit_status:
             log.cl_error("failed to run command [%s] on host [%s], "
@@ -1534,4 +2105,9 @@ def init_instance(log, workspace, config, config_fpath, no_operation=False):
 
     return ClownfishInstance(log, workspace, lazy_prepare, hosts, mgs_dict,
                              lustres, ha_native, corosync_cluster, qos_dict,
-                             iso_path, local_host, mnt_path, no_operation=no_operation)
+                             iso_path, local_host, mnt_path, no_operation=no_operation,
+                             status_watcher=status_watcher,
+                             fix_thread_number=fix_thread_number,
+                             fix_host_limit=fix_host_limit,
+                             status_thread_number=status_thread_number,
+                             status_host_limit=status_host_limit)
@@ -9,6 +9,9 @@ from pyclownfish import clownfish_command_common
 from pyclownfish import clownfish_subsystem_option
 from pyclownfish import clownfish_subsystem_fs
 from pyclownfish import clownfish_subsystem_service
+from pylcommon import utils
+from pylcommon import ssh_host
+from pylcommon import lustre
 
 # Key: subsystem name. Value: calss Subsystem
 SUBSYSTEM_DICT = {}
@@ -20,7 +23,9 @@ CLOWNFISH_COMMNAD_MOUNT_ALL = "mount_all"
 CLOWNFISH_COMMNAD_NONEXISTENT = "nonexistent"
 CLOWNFISH_COMMNAD_PREPARE = "prepare"
 CLOWNFISH_COMMNAD_QUIT = "q"
+CLOWNFISH_COMMNAD_REBOOT = "reboot"
 CLOWNFISH_COMMNAD_RETVAL = "retval"
+CLOWNFISH_COMMNAD_STATS = "stats"
 CLOWNFISH_COMMNAD_UMOUNT_ALL = "umount_all"
 
 CLOWNFISH_DELIMITER_AND = "AND"
@@ -29,6 +34,40 @@ CLOWNFISH_DELIMITER_CONT = "CONT"
 MAX_FAST_COMMAND_TIME = 1
 
 
+def parse_plan_options(log, args, flag_options=None):
+    """
+    Parse the options of the cluster wide operations, return
+    (0, (dry_run, host_concurrency, flags)), or (-1, None) on error
+    """
+    if flag_options is None:
+        flag_options = []
+    dry_run = False
+    host_concurrency = None
+    flags = []
+    index = 0
+    while index < len(args):
+        arg = args[index]
+        index += 1
+        if arg == "-n" or arg == "--dry-run":
+            dry_run = True
+        elif arg == "-p" or arg == "--parallel":
+            if index >= len(args):
+                log.cl_stderr("missing value of option [%s]", arg)
+                return -1, None
+            try:
+                host_concurrency = int(args[index])
+            except ValueError:
+                log.cl_stderr("invalid parallelism [%s]", args[index])
+                return -1, None
+            index += 1
+        elif arg in flag_options:
+            flags.append(arg)
+        else:
+            log.cl_stderr("unknown option [%s]", arg)
+            return -1, None
+    return 0, (dry_run, host_concurrency, flags)
+
+
 def clownfish_command_format_all(connection, args):
     """
     Format all the filesystems
@@ -36,14 +75,19 @@ def clownfish_command_format_all(connection, args):
     log = connection.cc_command_log
     if ((clownfish_command_common.CLOWNFISH_OPTION_SHORT_HELP in args) or
             (clownfish_command_common.CLOWNFISH_OPTION_LONG_HELP in args)):
-        log.cl_stdout("""Usage: format_all
+        log.cl_stdout("""Usage: format_all [-f] [-n] [-p parallelism]
 Format *all* Lustre device(s)
-  -f: force running the command without asking for confirmation""")
+  -f: force running the command without asking for confirmation
+  -n: only print the plan and its estimated time
+  -p: the max number of devices being formatted on each host at the same
+      time, default: %s""" % lustre.LUSTRE_FORMAT_HOST_CONCURRENCY)
         return 0
 
-    confirmed = False
-    if "-f" in args or "--force" in args:
-        confirmed = True
+    ret, options = parse_plan_options(log, args, ["-f", "--force"])
+    if ret:
+        return -1
+    dry_run, host_concurrency, flags = options
+    confirmed = bool(dry_run or len(flags) > 0)
 
     if not confirmed:
         input_result = connection.cc_ask_for_input("Are you sure to format all Lustre devices? (y,N) ")
@@ -58,7 +102,8 @@ Format *all* Lustre device(s)
         return -1
 
     instance = connection.cc_instance
-    return instance.ci_format_all(log)
+    return instance.ci_format_all(log, host_concurrency=host_concurrency,
+                                  dry_run=dry_run)
 
 
 SUBSYSTEM_NONE.ss_command_dict[CLOWNFISH_COMMNAD_FORMAT_ALL] = \
@@ -74,12 +119,20 @@ def clownfish_command_mount_all(connection, args):
     log = connection.cc_command_log
     if ((clownfish_command_common.CLOWNFISH_OPTION_SHORT_HELP in args) or
             (clownfish_command_common.CLOWNFISH_OPTION_LONG_HELP in args)):
-        log.cl_stdout("""Usage: mount_all
-Mount *all* Lustre device(s)""")
+        log.cl_stdout("""Usage: mount_all [-n] [-p parallelism]
+Mount *all* Lustre device(s)
+  -n: only print the plan and its estimated time
+  -p: the max number of devices being mounted on each host at the same
+      time, default: %s""" % lustre.LUSTRE_OPERATION_HOST_CONCURRENCY)
         return 0
 
+    ret, options = parse_plan_options(log, args)
+    if ret:
+        return -1
+    dry_run, host_concurrency, _ = options
     instance = connection.cc_instance
-    return instance.ci_mount_all(log)
+    return instance.ci_mount_all(log, dry_run=dry_run,
+                                 host_concurrency=host_concurrency)
 
 
 SUBSYSTEM_NONE.ss_command_dict[CLOWNFISH_COMMNAD_MOUNT_ALL] = \
@@ -95,12 +148,20 @@ def clownfish_command_umount_all(connection, args):
     log = connection.cc_command_log
     if ((clownfish_command_common.CLOWNFISH_OPTION_SHORT_HELP in args) or
             (clownfish_command_common.CLOWNFISH_OPTION_LONG_HELP in args)):
-        log.cl_stdout("""Usage: umount_all
-Umount *all* Lustre device(s)""")
+        log.cl_stdout("""Usage: umount_all [-n] [-p parallelism]
+Umount *all* Lustre device(s)
+  -n: only print the plan and its estimated time
+  -p: the max number of devices being umounted on each host at the same
+      time, default: %s""" % lustre.LUSTRE_OPERATION_HOST_CONCURRENCY)
         return 0
 
+    ret, options = parse_plan_options(log, args)
+    if ret:
+        return -1
+    dry_run, host_concurrency, _ = options
     instance = connection.cc_instance
-    return instance.ci_umount_all(log)
+    return instance.ci_umount_all(log, dry_run=dry_run,
+                                  host_concurrency=host_concurrency)
 
 
 SUBSYSTEM_NONE.ss_command_dict[CLOWNFISH_COMMNAD_UMOUNT_ALL] = \
@@ -270,6 +331,94 @@ SUBSYSTEM_NONE.ss_command_dict[CLOWNFISH_COMMNAD_PREPARE] = \
                                               speed=clownfish_command_common.SPEED_ALWAYS_SLOW)
 
 
+def clownfish_command_reboot(connection, args):
+    """
+    Reboot the hosts
+    """
+    log = connection.cc_command_log
+    if ((clownfish_command_common.CLOWNFISH_OPTION_SHORT_HELP in args) or
+            (clownfish_command_common.CLOWNFISH_OPTION_LONG_HELP in args) or
+            len(args) == 0):
+        log.cl_stdout("""Usage: %s [-w wave_size] <hostname>...
+Reboot the host(s) in parallel, the hosts that share a service will not be
+rebooted at the same time
+  -w: the max number of hosts that reboot at the same time, default: %d""" %
+                      (CLOWNFISH_COMMNAD_REBOOT, ssh_host.REBOOT_WAVE_SIZE))
+        return 0
+
+    wave_size = None
+    hostnames = []
+    index = 0
+    while index < len(args):
+        arg = args[index]
+        index += 1
+        if arg == "-w" or arg == "--wave":
+            if index >= len(args):
+                log.cl_stderr("missing value of option [%s]", arg)
+                return -1
+            try:
+                wave_size = int(args[index])
+            except ValueError:
+                log.cl_stderr("invalid wave size [%s]", args[index])
+                return -1
+            index += 1
+        else:
+            hostnames.append(arg)
+
+    if len(hostnames) == 0:
+        log.cl_stderr("no host is specified")
+        return -1
+    return connection.cc_instance.ci_reboot_hosts(log, hostnames,
+                                                  wave_size=wave_size)
+
+
+SUBSYSTEM_NONE.ss_command_dict[CLOWNFISH_COMMNAD_REBOOT] = \
+    clownfish_command_common.ClownfishCommand(CLOWNFISH_COMMNAD_REBOOT,
+                                              clownfish_command_reboot,
+                                              speed=clownfish_command_common.SPEED_ALWAYS_SLOW)
+
+
+def clownfish_command_stats(connection, args):
+    """
+    Print the statistics of the commands on the hosts
+    """
+    log = connection.cc_command_log
+    if ((clownfish_command_common.CLOWNFISH_OPTION_SHORT_HELP in args) or
+            (clownfish_command_common.CLOWNFISH_OPTION_LONG_HELP in args)):
+        log.cl_stdout("""Usage: %s [-j] [-r] [hostname]...
+Print the latency and output size statistics of the commands run on the hosts
+  -j: print the statistics in JSON format
+  -r: clear the statistics""" %
+                      (CLOWNFISH_COMMNAD_STATS))
+        return 0
+
+    json_format = False
+    reset = False
+    hostnames = []
+    for arg in args:
+        if arg == "-j" or arg == "--json":
+            json_format = True
+        elif arg == "-r" or arg == "--reset":
+            reset = True
+        else:
+            hostnames.append(arg)
+
+    if reset:
+        utils.COMMAND_STATISTICS.cst_reset()
+        log.cl_stdout("cleared the statistics of commands")
+        return 0
+
+    if len(hostnames) == 0:
+        hostnames = None
+    return connection.cc_instance.ci_command_stats(log, hostnames=hostnames,
+                                                   json_format=json_format)
+
+
+SUBSYSTEM_NONE.ss_command_dict[CLOWNFISH_COMMNAD_STATS] = \
+    clownfish_command_common.ClownfishCommand(CLOWNFISH_COMMNAD_STATS,
+                                              clownfish_command_stats)
+
+
 def clownfish_command_names():
     """
     Return the command names
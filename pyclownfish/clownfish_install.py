@@ -33,9 +33,13 @@ def main():
         missing_dependencies.append("python-dateutil")
 
     local_host = ssh_host.SSHHost("localhost", local=True)
-    for dependent_rpm in install_common.CLOWNFISH_INSTALL_DEPENDENT_RPMS:
-        ret = local_host.sh_rpm_query(log, dependent_rpm)
-        if ret != 0:
+    dependent_rpms = install_common.CLOWNFISH_INSTALL_DEPENDENT_RPMS
+    installed = local_host.sh_rpms_installed(log, dependent_rpms)
+    if installed is None:
+        log.cl_error("failed to query dependency RPMs")
+        sys.exit(-1)
+    for dependent_rpm in dependent_rpms:
+        if not installed[dependent_rpm]:
             missing_dependencies.append(dependent_rpm)
 
     if len(missing_dependencies):
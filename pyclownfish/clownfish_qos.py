@@ -14,6 +14,7 @@ import hashlib
 
 from pylcommon import utils
 from pylcommon import lustre
+from pylcommon import ssh_host
 from pylcommon import cstr
 from pyclownfish import esmon_influxdb
 
@@ -600,19 +601,50 @@ class ClownfishDecayQoS(object):
 
         name = "uid_" + uid_string
         lustrefs = self.cdqos_lustrefs
-        for host in lustrefs.lf_oss_list():
-            ret = host.lsh_stop_ost_io_tbf_rule(log, name)
-            if ret:
-                log.cl_debug("failed to stop rule [%s]", name)
+        expression = "uid={%s}" % uid_string
+        ret = self._cdqos_restart_tbf_rule(log, lustrefs.lf_oss_list(),
+                                           lustre.PARAM_PATH_OST_IO, name,
+                                           expression, rpc_limit)
+        if ret:
+            return -1
 
-            expression = "uid={%s}" % uid_string
-            ret = host.lsh_start_ost_io_tbf_rule(log, name, expression,
-                                                 rpc_limit)
+        self.cdqos_oss_throttled_uids.append(uid_string)
+        return 0
+
+    def _cdqos_restart_tbf_rule(self, log, hosts, param_path, name,
+                                expression, rpc_limit):
+        """
+        Stop and then start a TBF rule on all of the hosts in parallel
+        """
+        # pylint: disable=too-many-arguments,no-self-use
+        for host in hosts:
+            ret = host.lsh_check_tbf_rule_support(log)
             if ret:
                 return -1
 
-        self.cdqos_oss_throttled_uids.append(uid_string)
-        return 0
+        param = "%s.nrs_tbf_rule" % param_path
+        command = lustre.lctl_set_param_command(param,
+                                                lustre.tbf_rule_stop_value(name))
+        results = ssh_host.run_on_hosts(log, hosts, command)
+        for hostname, retval in results.iteritems():
+            if retval.cr_exit_status != 0:
+                log.cl_debug("failed to stop rule [%s] on host [%s]", name,
+                             hostname)
+
+        value = lustre.tbf_rule_start_value(name, expression, rpc_limit)
+        command = lustre.lctl_set_param_command(param, value)
+        results = ssh_host.run_on_hosts(log, hosts, command)
+        ret = 0
+        for hostname, retval in results.iteritems():
+            if retval.cr_exit_status != 0:
+                log.cl_error("failed to run command [%s] on host [%s], "
+                             "ret = [%d], stdout = [%s], stderr = [%s]",
+                             command, hostname,
+                             retval.cr_exit_status,
+                             retval.cr_stdout,
+                             retval.cr_stderr)
+                ret = -1
+        return ret
 
     def cdqos_enforce_mds_tbf(self, log, uid, rpc_limit):
         """
@@ -624,29 +656,21 @@ class ClownfishDecayQoS(object):
 
         name = "uid_" + uid_string
         lustrefs = self.cdqos_lustrefs
-        for host in lustrefs.lf_mds_list():
-            ret = host.lsh_stop_mdt_tbf_rule(log, name)
-            if ret:
-                log.cl_debug("failed to stop rule [%s]", name)
-
-            expression = "uid={%s} warning=1" % uid_string
-            ret = host.lsh_start_mdt_tbf_rule(log, name, expression,
-                                              rpc_limit)
-            if ret:
-                return -1
+        mds_list = lustrefs.lf_mds_list()
+        expression = "uid={%s} warning=1" % uid_string
+        ret = self._cdqos_restart_tbf_rule(log, mds_list,
+                                           lustre.PARAM_PATH_MDT, name,
+                                           expression, rpc_limit)
+        if ret:
+            return -1
 
         name = "ldlm_enqueue"
-        lustrefs = self.cdqos_lustrefs
-        for host in lustrefs.lf_mds_list():
-            ret = host.lsh_stop_mdt_tbf_rule(log, name)
-            if ret:
-                log.cl_debug("failed to stop rule [%s]", name)
-
-            expression = "opcode={ldlm_enqueue}"
-            ret = host.lsh_start_mdt_tbf_rule(log, name, expression,
-                                              10000)
-            if ret:
-                return -1
+        expression = "opcode={ldlm_enqueue}"
+        ret = self._cdqos_restart_tbf_rule(log, mds_list,
+                                           lustre.PARAM_PATH_MDT, name,
+                                           expression, 10000)
+        if ret:
+            return -1
 
         self.cdqos_mds_throttled_uids.append(uid_string)
         return 0
@@ -664,19 +688,26 @@ class ClownfishDecayQoS(object):
                          lustre.JOBID_VAR_PROCNAME_UID)
             return -1
 
-        for host in lustrefs.lf_oss_list():
-            ret = host.lsh_enable_ost_io_tbf(log, lustre.TBF_TYPE_GENERAL)
-            if ret:
-                log.cl_error("failed to enable TBF for ost_io on file system "
-                             "[%s]", fsname)
-                return -1
-
-        for host in lustrefs.lf_mds_list():
-            ret = host.lsh_enable_mdt_tbf(log, lustre.TBF_TYPE_GENERAL)
-            if ret:
-                log.cl_error("failed to enable TBF for all MDT services on file system "
-                             "[%s]", fsname)
-                return -1
+        for hosts, param_path in ((lustrefs.lf_oss_list(),
+                                   lustre.PARAM_PATH_OST_IO),
+                                  (lustrefs.lf_mds_list(),
+                                   lustre.PARAM_PATH_MDT)):
+            if len(hosts) == 0:
+                continue
+            command = hosts[0].lsh_enable_tbf_command(param_path,
+                                                      lustre.TBF_TYPE_GENERAL)
+            results = ssh_host.run_on_hosts(log, hosts, command)
+            for hostname, retval in results.iteritems():
+                if retval.cr_exit_status != 0:
+                    log.cl_error("failed to run command [%s] on host [%s], "
+                                 "ret = [%d], stdout = [%s], stderr = [%s]",
+                                 command, hostname,
+                                 retval.cr_exit_status,
+                                 retval.cr_stdout,
+                                 retval.cr_stderr)
+                    log.cl_error("failed to enable TBF for [%s] on file "
+                                 "system [%s]", param_path, fsname)
+                    return -1
 
         self.cdqos_thread = utils.thread_start(self.cdqos_thread_main, ())
         return 0
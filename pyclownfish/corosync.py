@@ -5,6 +5,7 @@
 Library for Corosync
 """
 from pylcommon import install_common
+from pylcommon import ssh_host
 from pylcommon import constants
 
 
@@ -350,10 +351,12 @@ quorum {
         Config and create Lustre resource.
         """
         # pylint: disable=too-many-branches,too-many-locals,too-many-statements
-        # stop corosync, stopping might fail
-        for host in self.lcc_hosts.itervalues():
-            command = "systemctl stop corosync"
-            retval = host.sh_run(log, command, timeout=60)
+        # stop corosync on all hosts in parallel, stopping might fail
+        hosts = self.lcc_hosts.values()
+        command = "systemctl stop corosync"
+        results = ssh_host.run_on_hosts(log, hosts, command, timeout=60)
+        for host in hosts:
+            retval = results[host.sh_hostname]
             if retval.cr_exit_status != 0:
                 # Stop might fail, kill -9 by force
                 log.cl_info("failed to run command [%s] on host "
@@ -365,10 +368,9 @@ quorum {
                             retval.cr_stdout,
                             retval.cr_stderr)
 
-                command = "killall -9 corosync"
-                retval = host.sh_run(log, command)
+                force_command = "killall -9 corosync"
+                retval = host.sh_run(log, force_command)
 
-                command = "systemctl stop corosync"
                 retval = host.sh_run(log, command)
                 if retval.cr_exit_status != 0:
                     log.cl_error("failed to run command [%s] on host "
@@ -381,10 +383,11 @@ quorum {
                                  retval.cr_stderr)
                     return -1
 
-        # start pacemaker and corosync
+        # start pacemaker and corosync on all hosts in parallel
         command = "systemctl start corosync pacemaker"
-        for host in self.lcc_hosts.itervalues():
-            retval = host.sh_run(log, command)
+        results = ssh_host.run_on_hosts(log, hosts, command)
+        for host in hosts:
+            retval = results[host.sh_hostname]
             if retval.cr_exit_status != 0:
                 log.cl_error("failed to run command [%s] on host "
                              "[%s], ret = [%d], stdout = [%s], stderr = "
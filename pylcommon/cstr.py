@@ -31,6 +31,8 @@ CSTR_ESMON_SERVER_HOSTNAME = "esmon_server_hostname"
 CSTR_ESMON_COLLECT_INTERVAL = "esmon_collect_interval"
 CSTR_FAILED = "failed"
 CSTR_FALSE = "false"
+CSTR_FIX_HOST_LIMIT = "fix_host_limit"
+CSTR_FIX_THREAD_NUMBER = "fix_thread_number"
 CSTR_FSNAME = "fsname"
 CSTR_HIGH_AVAILABILITY = "high_availability"
 CSTR_HOSTS = "hosts"
@@ -79,6 +81,7 @@ CSTR_PIP = "pip"
 CSTR_QOS = "qos"
 CSTR_RAM_SIZE = "ram_size"
 CSTR_REINSTALL = "reinstall"
+CSTR_REMOTE_AGENT = "remote_agent"
 CSTR_CLOWNFISH_SERVER = "clownfish_server"
 CSTR_SERVER_HOSTS = "server_hosts"
 CSTR_SERVER_HOST_ID = "server_host_id"
@@ -92,6 +95,9 @@ CSTR_SKIP_VIRT = "skip_virt"
 CSTR_SSH_HOSTS = "ssh_hosts"
 CSTR_SSH_IDENTITY_FILE = "ssh_identity_file"
 CSTR_STATUS = "status"
+CSTR_STATUS_HOST_LIMIT = "status_host_limit"
+CSTR_STATUS_THREAD_NUMBER = "status_thread_number"
+CSTR_STATUS_WATCHER = "status_watcher"
 CSTR_TAG = "tag"
 CSTR_TEMPLATE_HOSTNAME = "template_hostname"
 CSTR_TEMPLATES = "templates"
@@ -0,0 +1,238 @@
+# Copyright (c) 2018 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Library for distributing a file/directory from local host to many hosts
+
+The local host only seeds a few hosts, the hosts that already got the
+content relay it to the others, so the uplink of the local host will not
+be the bottleneck. The hosts that already have the same content are
+skipped according to the checksum manifests.
+"""
+import os
+import threading
+import time
+import traceback
+
+# local libs
+from pylcommon import utils
+from pylcommon import ssh_host
+
+# The max number of hosts that local host sends to at the same time
+DISTRIBUTE_SEED_FANOUT = 4
+# The max number of hosts that each remote host relays to at the same time
+DISTRIBUTE_RELAY_FANOUT = 2
+
+
+def manifest_command(dest_parent, basename):
+    """
+    Return the command that prints the checksum manifest of the content.
+    The checksums are calculated in parallel, and sorted so that the same
+    content always has the same manifest.
+    """
+    return ("cd %s && find %s -type f -print0 | %s | LC_ALL=C sort" %
+            (dest_parent, basename, ssh_host.checksum_command()))
+
+
+class FileDistribution(object):
+    """
+    Each distribution of a file/directory has an object of this type
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, source, dest_parent, hosts,
+                 seed_fanout=DISTRIBUTE_SEED_FANOUT,
+                 relay_fanout=DISTRIBUTE_RELAY_FANOUT):
+        # pylint: disable=too-many-arguments
+        # The path of the file/directory on local host
+        self.fd_source = source.rstrip("/")
+        # The parent directory on the hosts to put the file/directory into
+        self.fd_dest_parent = dest_parent
+        # The path of the file/directory on the hosts
+        self.fd_dest = (dest_parent + "/" +
+                        os.path.basename(self.fd_source))
+        self.fd_hosts = hosts
+        self.fd_seed_fanout = seed_fanout
+        self.fd_relay_fanout = relay_fanout
+        self.fd_condition = threading.Condition()
+        # The hosts that need the content, each item is a tuple of
+        # (host, local_only)
+        self.fd_pending = []
+        # The number of running sends of local host
+        self.fd_local_busy = 0
+        # Hostname -> [host, number of running sends], the hosts that
+        # have got the content and can relay it
+        self.fd_relays = {}
+        # The number of running sends
+        self.fd_running = 0
+        # The hosts failed to get the content
+        self.fd_failed = []
+        self.fd_seeded = 0
+        self.fd_relayed = 0
+
+    def _fd_pick_source(self, local_only):
+        """
+        Return (True, None) if local host should send, (False, relay_host)
+        if a relay host should send, None if no source is free now.
+        Condition should be held.
+        """
+        if not local_only:
+            best = None
+            for relay in self.fd_relays.values():
+                if relay[1] >= self.fd_relay_fanout:
+                    continue
+                if best is None or relay[1] < best[1]:
+                    best = relay
+            if best is not None:
+                return False, best[0]
+        if self.fd_local_busy < self.fd_seed_fanout:
+            return True, None
+        return None
+
+    def _fd_send(self, log, host, relay_host):
+        """
+        Send the content to a host, from local host if relay_host is None
+        """
+        command = "mkdir -p %s" % self.fd_dest_parent
+        retval = host.sh_run(log, command)
+        if retval.cr_exit_status:
+            log.cl_error("failed to run command [%s] on host [%s], "
+                         "ret = [%d], stdout = [%s], stderr = [%s]",
+                         command,
+                         host.sh_hostname,
+                         retval.cr_exit_status,
+                         retval.cr_stdout,
+                         retval.cr_stderr)
+            return -1
+
+        if relay_host is None:
+            return host.sh_send_file(log, self.fd_source, self.fd_dest_parent)
+        return relay_host.sh_send_file(log, self.fd_dest, self.fd_dest_parent,
+                                       from_local=False, remote_host=host)
+
+    def _fd_send_thread(self, log, host, relay_host):
+        """
+        Thread of sending the content to a host
+        """
+        # pylint: disable=bare-except
+        if relay_host is None:
+            log.cl_debug("sending [%s] from local host to host [%s]",
+                         self.fd_source, host.sh_hostname)
+        else:
+            log.cl_debug("relaying [%s] from host [%s] to host [%s]",
+                         self.fd_dest, relay_host.sh_hostname,
+                         host.sh_hostname)
+        try:
+            ret = self._fd_send(log, host, relay_host)
+        except:
+            log.cl_error("exception when sending [%s] to host [%s]: [%s]",
+                         self.fd_dest, host.sh_hostname,
+                         traceback.format_exc())
+            ret = -1
+
+        self.fd_condition.acquire()
+        self.fd_running -= 1
+        if relay_host is None:
+            self.fd_local_busy -= 1
+        else:
+            self.fd_relays[relay_host.sh_hostname][1] -= 1
+
+        if ret == 0:
+            if relay_host is None:
+                self.fd_seeded += 1
+            else:
+                self.fd_relayed += 1
+            self.fd_relays[host.sh_hostname] = [host, 0]
+        elif relay_host is not None:
+            log.cl_debug("failed to relay [%s] from host [%s] to host [%s], "
+                         "will send from local host",
+                         self.fd_dest, relay_host.sh_hostname,
+                         host.sh_hostname)
+            self.fd_pending.append((host, True))
+        else:
+            log.cl_error("failed to send [%s] from local host to host [%s]",
+                         self.fd_source, host.sh_hostname)
+            self.fd_failed.append(host)
+        self.fd_condition.notify_all()
+        self.fd_condition.release()
+
+    def _fd_check_manifests(self, log):
+        """
+        Find out the hosts that do not have the same content
+        """
+        parent = os.path.dirname(self.fd_source)
+        basename = os.path.basename(self.fd_source)
+        command = manifest_command(parent, basename)
+        retval = utils.run(command)
+        if retval.cr_exit_status:
+            log.cl_error("failed to run command [%s] on local host, "
+                         "ret = [%d], stdout = [%s], stderr = [%s]",
+                         command,
+                         retval.cr_exit_status,
+                         retval.cr_stdout,
+                         retval.cr_stderr)
+            return -1
+        local_manifest = retval.cr_stdout
+
+        command = manifest_command(self.fd_dest_parent, basename)
+        host_results = ssh_host.run_on_hosts(log, self.fd_hosts, command)
+        for host in self.fd_hosts:
+            retval = host_results[host.sh_hostname]
+            if (retval.cr_exit_status == 0 and
+                    retval.cr_stdout == local_manifest):
+                log.cl_debug("host [%s] already has [%s]",
+                             host.sh_hostname, self.fd_dest)
+                self.fd_relays[host.sh_hostname] = [host, 0]
+            else:
+                self.fd_pending.append((host, False))
+        return 0
+
+    def fd_run(self, log):
+        """
+        Distribute the content to all hosts, return 0 if all succeeded
+        """
+        start_time = time.time()
+        ret = self._fd_check_manifests(log)
+        if ret:
+            return -1
+        skipped = len(self.fd_relays)
+
+        self.fd_condition.acquire()
+        while len(self.fd_pending) > 0 or self.fd_running > 0:
+            for host, local_only in self.fd_pending[:]:
+                source = self._fd_pick_source(local_only)
+                if source is None:
+                    continue
+                is_local, relay_host = source
+                if is_local:
+                    self.fd_local_busy += 1
+                else:
+                    self.fd_relays[relay_host.sh_hostname][1] += 1
+                self.fd_running += 1
+                self.fd_pending.remove((host, local_only))
+                utils.thread_start(self._fd_send_thread,
+                                   (log, host, relay_host))
+            self.fd_condition.wait()
+        self.fd_condition.release()
+
+        log.cl_info("distributed [%s] to [%d] hosts in [%.1f] seconds, "
+                    "[%d] from local host, [%d] relayed, [%d] skipped, "
+                    "[%d] failed", self.fd_source, len(self.fd_hosts),
+                    time.time() - start_time, self.fd_seeded,
+                    self.fd_relayed, skipped, len(self.fd_failed))
+        if len(self.fd_failed) > 0:
+            return -1
+        return 0
+
+
+def distribute(log, source, dest_parent, hosts,
+               seed_fanout=DISTRIBUTE_SEED_FANOUT,
+               relay_fanout=DISTRIBUTE_RELAY_FANOUT):
+    """
+    Distribute the file/directory on local host into the parent directory
+    on the hosts. Return 0 if all hosts got the content.
+    """
+    # pylint: disable=too-many-arguments
+    distribution = FileDistribution(source, dest_parent, hosts,
+                                    seed_fanout=seed_fanout,
+                                    relay_fanout=relay_fanout)
+    return distribution.fd_run(log)
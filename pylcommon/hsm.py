@@ -9,7 +9,6 @@ import time
 
 # Local libs
 from pylcommon import utils
-from pylcommon import watched_io
 from pylcommon import daemon
 from pylcommon import time_util
 
@@ -19,6 +18,38 @@ COMMAND_HSM_REMOVER = "hsm_remover"
 COMMAND_LSHMTOOL_POSIX = "lhsmtool_posix"
 
 
+def run_logged(log, host, command, stdout_file, stderr_file, flush_tee=False):
+    """
+    Run a long living command, save the output into files and log each
+    line of the output as soon as it comes
+    """
+    # pylint: disable=too-many-arguments
+    def stdout_line(line):
+        """
+        Log a line of stdout
+        """
+        log.cl_debug("log from host [%s]: [%s]", host.sh_hostname, line)
+
+    def stderr_line(line):
+        """
+        Log a line of stderr
+        """
+        log.cl_error("log from host [%s]: [%s]", host.sh_hostname, line)
+
+    stdout_fd = open(stdout_file, "w")
+    stderr_fd = open(stderr_file, "w")
+    log.cl_debug("start to run command [%s] on host [%s]",
+                 command, host.sh_hostname)
+    retval = host.sh_run(log, command, stdout_tee=stdout_fd,
+                         stderr_tee=stderr_fd, return_stdout=False,
+                         return_stderr=False, timeout=None,
+                         flush_tee=flush_tee, stdout_line_func=stdout_line,
+                         stderr_line_func=stderr_line)
+    stdout_fd.close()
+    stderr_fd.close()
+    return retval
+
+
 class HSMCopytool(object):
     """
     Each SSH host has an object of this type
@@ -85,20 +116,8 @@ class HSMCopytool(object):
         log = parent_log.cl_get_child("copytool", resultsdir=self.hc_workspace)
 
         host = self.hc_host
-        args = {}
-        args[watched_io.WATCHEDIO_LOG] = host.sh_hostname
-        args[watched_io.WATCHEDIO_HOSTNAME] = log
-        stdout_fd = watched_io.watched_io_open(self.hc_stdout_file,
-                                               watched_io.log_watcher_debug, args)
-        stderr_fd = watched_io.watched_io_open(self.hc_stderr_file,
-                                               watched_io.log_watcher_error, args)
-        log.cl_debug("start to run command [%s] on host [%s]",
-                     self.hc_command, host.sh_hostname)
-        retval = host.sh_run(log, self.hc_command, stdout_tee=stdout_fd,
-                             stderr_tee=stderr_fd, return_stdout=False,
-                             return_stderr=False, timeout=None, flush_tee=True)
-        stdout_fd.close()
-        stderr_fd.close()
+        retval = run_logged(log, host, self.hc_command, self.hc_stdout_file,
+                            self.hc_stderr_file, flush_tee=True)
         if daemon.SHUTTING_DOWN:
             log.cl_debug("finished running command [%s] on host [%s], "
                          "ret = [%d], "
@@ -186,20 +205,8 @@ class HSMRemover(object):
         stderr_file = workspace + "/" + "remover_watching.stderr"
 
         host = self.hr_host
-        args = {}
-        args["hostname"] = host.sh_hostname
-        args["log"] = log
-        stdout_fd = watched_io.watched_io_open(stdout_file,
-                                               watched_io.log_watcher_debug, args)
-        stderr_fd = watched_io.watched_io_open(stderr_file,
-                                               watched_io.log_watcher_error, args)
-        log.cl_debug("start to run command [%s] on host [%s]",
-                     self.hr_command, host.sh_hostname)
-        retval = host.sh_run(log, self.hr_command, stdout_tee=stdout_fd,
-                             stderr_tee=stderr_fd, return_stdout=False,
-                             return_stderr=False, timeout=None)
-        stdout_fd.close()
-        stderr_fd.close()
+        retval = run_logged(log, host, self.hr_command, stdout_file,
+                            stderr_file)
         if retval.cr_exit_status:
             log.cl_error("failed to run command [%s] on host [%s], "
                          "ret = [%d], "
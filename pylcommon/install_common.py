@@ -13,6 +13,7 @@ import os
 from pylcommon import utils
 from pylcommon import ssh_host
 from pylcommon import cstr
+from pylcommon import distribute
 
 RPM_PATTERN_RHEL7 = r"^%s-\d.+(\.el7|).*\.(x86_64|noarch)\.rpm$"
 RPM_PATTERN_RHEL6 = r"^%s-\d.+(\.el6|).*\.(x86_64|noarch)\.rpm$"
@@ -255,6 +256,8 @@ class InstallationCluster(object):
         self.ic_pip_dir = self.ic_iso_dir + "/" + cstr.CSTR_PIP
         self.ic_rpm_fnames = None
         self.ic_repo_config_fpath = workspace + "/clownfish.repo"
+        # Whether the ISO files and ISO have been distributed to the hosts
+        self.ic_distributed = False
 
     def _ic_send_iso_files(self, log, host):
         """
@@ -273,13 +276,14 @@ class InstallationCluster(object):
                          retval.cr_stderr)
             return -1
 
-        ret = host.sh_send_file(log, self.ic_mnt_path, self.ic_workspace)
-        if ret:
-            log.cl_error("failed to send file [%s] on local host to "
-                         "directory [%s] on host [%s]",
-                         self.ic_mnt_path, self.ic_workspace,
-                         host.sh_hostname)
-            return -1
+        if not self.ic_distributed:
+            ret = host.sh_send_file(log, self.ic_mnt_path, self.ic_workspace)
+            if ret:
+                log.cl_error("failed to send file [%s] on local host to "
+                             "directory [%s] on host [%s]",
+                             self.ic_mnt_path, self.ic_workspace,
+                             host.sh_hostname)
+                return -1
 
         basename = os.path.basename(self.ic_mnt_path)
         command = ("cd %s && mv %s %s" %
@@ -315,6 +319,8 @@ class InstallationCluster(object):
         send the ISO to a host
         """
         # pylint: disable=too-many-return-statements
+        if self.ic_distributed:
+            return 0
         dirname = os.path.dirname(self.ic_iso_path)
         command = ("mkdir -p %s" % (dirname))
         retval = host.sh_run(log, command)
@@ -336,6 +342,24 @@ class InstallationCluster(object):
             return -1
         return 0
 
+    def _ic_distribute(self, log):
+        """
+        Distribute the ISO files and ISO to all hosts in a tree
+        """
+        if len(self.ic_hosts) == 0:
+            return 0
+        ret = distribute.distribute(log, self.ic_mnt_path, self.ic_workspace,
+                                    self.ic_hosts)
+        if ret:
+            return -1
+        ret = distribute.distribute(log, self.ic_iso_path,
+                                    os.path.dirname(self.ic_iso_path),
+                                    self.ic_hosts)
+        if ret:
+            return -1
+        self.ic_distributed = True
+        return 0
+
     def _ic_host_install(self, log, host, pip_libs, dependent_rpms):
         """
         Install Clownfish on a host
@@ -408,6 +432,11 @@ class InstallationCluster(object):
         packages_dir = self.ic_iso_dir + "/" + cstr.CSTR_PACKAGES
         generate_repo_file(self.ic_repo_config_fpath, packages_dir,
                            "Clownfish")
+        ret = self._ic_distribute(log)
+        if ret:
+            log.cl_error("failed to distribute ISO to hosts")
+            return -1
+
         ret = 0
         for host in self.ic_hosts:
             ret = self._ic_host_install(log, host, pip_libs, dependent_rpms)
@@ -39,8 +39,13 @@ def _iso_mount_and_install(log, workspace, config, config_fpath, install_funct):
 
     mnt_path = "/mnt/" + utils.random_word(8)
 
-    command = ("mkdir -p %s && mount -o loop %s %s" %
-               (mnt_path, iso_path, mnt_path))
+    ret = local_host.sh_mkdir(log, mnt_path)
+    if ret:
+        log.cl_error("failed to create directory [%s] on host [%s]",
+                     mnt_path, local_host.sh_hostname)
+        return -1
+
+    command = ["mount", "-o", "loop", iso_path, mnt_path]
     retval = local_host.sh_run(log, command)
     if retval.cr_exit_status:
         log.cl_error("failed to run command [%s] on host [%s], "
@@ -59,7 +64,7 @@ def _iso_mount_and_install(log, workspace, config, config_fpath, install_funct):
         ret = -1
         log.cl_error("exception: %s", traceback.format_exc())
 
-    command = ("umount %s" % (mnt_path))
+    command = ["umount", mnt_path]
     retval = local_host.sh_run(log, command)
     if retval.cr_exit_status:
         log.cl_error("failed to run command [%s] on host [%s], "
@@ -71,7 +76,7 @@ def _iso_mount_and_install(log, workspace, config, config_fpath, install_funct):
                      retval.cr_stderr)
         ret = -1
 
-    command = ("rmdir %s" % (mnt_path))
+    command = ["rmdir", mnt_path]
     retval = local_host.sh_run(log, command)
     if retval.cr_exit_status:
         log.cl_error("failed to run command [%s] on host [%s], "
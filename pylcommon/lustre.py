@@ -7,6 +7,9 @@ Library for Lustre file system management
 # pylint: disable=too-many-lines
 import os
 import re
+import json
+import threading
+import traceback
 import time
 import prettytable
 
@@ -15,6 +18,9 @@ from pylcommon import utils
 from pylcommon import ssh_host
 from pylcommon import cstr
 from pylcommon import rwlock
+from pylcommon import remote_agent
+from pylcommon import remote_watcher
+from pylcommon import distribute
 
 EPEL_RPM_RHEL6_RPM = ("http://download.fedoraproject.org/pub/epel/6/x86_64/"
                       "epel-release-6-8.noarch.rpm")
@@ -26,6 +32,8 @@ LUSTRE_SERVICE_TYPE_MDT = "MDT"
 LUSTRE_SERVICE_TYPE_OST = "OST"
 
 JOBID_VAR_PROCNAME_UID = "procname_uid"
+# The host fact of Lustre version, changes when Lustre is (un)installed
+HOST_FACT_LUSTRE_VERSION = "lustre_version"
 
 PARAM_PATH_OST_IO = "ost.OSS.ost_io"
 PARAM_PATH_MDT = "mds.MDS.mdt"
@@ -42,6 +50,69 @@ BACKFSTYPE_ZFS = "zfs"
 BACKFSTYPE_LDISKFS = "ldiskfs"
 
 LUSTRE_SERVICE_STATUS_CHECK_INTERVAL = 10
+# The check interval of services that had problems recently
+LUSTRE_SERVICE_STATUS_MIN_INTERVAL = 2
+# The check interval of services that have been stable for long, only if
+# the watchers on the hosts report the changes of the services
+LUSTRE_SERVICE_STATUS_MAX_INTERVAL = 30
+# A service without problem for this long is considered stable
+LUSTRE_SERVICE_STATUS_STABLE_TIME = 60
+# The interval of checking the status by polling when the watchers on the
+# hosts report the changes
+LUSTRE_SERVICE_STATUS_POLL_INTERVAL = 300
+# The max seconds that a host snapshot could be used to check the status of
+# services, so the status threads of the services on a host share a single
+# snapshot in each interval
+LUSTRE_HOST_SNAPSHOT_MAX_AGE = LUSTRE_SERVICE_STATUS_CHECK_INTERVAL / 2
+# The command to list the imported zpools
+ZPOOL_LIST_COMMAND = "zpool list -H -o name"
+# The commands that print the identities of block devices and ZFS datasets.
+# The major:minor of a block device does not change when the device is
+# reformatted or replaced in the same slot, so the UUID of the file system
+# is part of the identity too.
+DEVICE_IDENTITY_COMMAND = ("for device in %s; do "
+                           "echo \"$device $(stat -L -c '%%t:%%T' $device) "
+                           "$(blkid -p -s UUID -o value $device)\"; done")
+DATASET_IDENTITY_COMMAND = "zfs get -H -o name,value guid %s"
+# The max number of operations running on a host at the same time when
+# operating on a whole file system
+LUSTRE_OPERATION_HOST_CONCURRENCY = 8
+# The max number of targets being formatted on a host at the same time, so
+# that a shared storage controller will not be saturated
+LUSTRE_FORMAT_HOST_CONCURRENCY = 2
+# The estimated seconds of the operations that have no history
+LUSTRE_OPERATION_DEFAULT_SECONDS = {"mount": 10.0, "umount": 5.0,
+                                    "format": 60.0}
+# The weight of the latest duration in the estimation of an operation
+LUSTRE_OPERATION_HISTORY_WEIGHT = 0.3
+
+
+def set_jobid_var_command(fsname, jobid_var):
+    """
+    Return the command to set the job ID variable, should run on MGS
+    """
+    return "lctl conf_param %s.sys.jobid_var=%s" % (fsname, jobid_var)
+
+
+def lctl_set_param_command(param, value):
+    """
+    Return the command to set a Lustre parameter
+    """
+    return 'lctl set_param %s="%s"' % (param, value)
+
+
+def tbf_rule_start_value(name, expression, rate):
+    """
+    Return the value of nrs_tbf_rule to start a TBF rule
+    """
+    return "start %s %s rate=%d" % (name, expression, rate)
+
+
+def tbf_rule_stop_value(name):
+    """
+    Return the value of nrs_tbf_rule to stop a TBF rule
+    """
+    return "stop %s" % name
 
 
 def lustre_string2index(index_string):
@@ -302,7 +373,7 @@ class LustreServiceInstance(object):
                           "not %s", service_name, operate)
             return -1
 
-        ret = self._lsi_check_zpool_imported(log)
+        ret = self._lsi_check_zpool_imported(log, max_age=0)
         if ret < 0:
             log.cl_stderr("failed to check whether zpool of Lustre service "
                           "[%s] imported or not on host [%s]", service_name,
@@ -325,6 +396,7 @@ class LustreServiceInstance(object):
 
         command = ("zpool %s %s" % (operate, service.ls_zpool_name))
         retval = host.sh_run(log, command)
+        host.lsh_snapshot_invalidate()
         if retval.cr_exit_status:
             log.cl_stderr("failed to run command [%s] on host [%s], "
                           "ret = [%d], stdout = [%s], stderr = [%s]",
@@ -462,6 +534,9 @@ class LustreServiceInstance(object):
             ret = self._lsi_umount(log)
         if ret == 0 and export_zpool:
             ret = self._lsi_zpool_export(log)
+        if format_device:
+            host.lsh_device_cache_invalidate(self.lsi_device)
+        host.lsh_snapshot_invalidate()
 
         instance_handle.rwh_release()
         host_handle.rwh_release()
@@ -491,11 +566,15 @@ class LustreServiceInstance(object):
         """
         return self._lsi_operate(log, export_zpool=True)
 
-    def _lsi_check_mounted(self, log):
+    def _lsi_check_mounted(self, log,
+                           max_age=LUSTRE_HOST_SNAPSHOT_MAX_AGE,
+                           snapshot=None):
         """
         Return 1 when service is mounted
         Return 0 when service is not mounted
         Return negative when error
+        The status is checked from the given snapshot, or from a snapshot of
+        the host not older than max_age.
         Read lock of the host and read lock of the instance should be held
         """
         # pylint: disable=too-many-locals,too-many-branches,too-many-statements
@@ -522,24 +601,41 @@ class LustreServiceInstance(object):
         mgs_pattern = (r"MGS")
         mgs_regular = re.compile(mgs_pattern)
 
-        # Detect Lustre services
-        command = ("cat /proc/mounts")
-        retval = host.sh_run(log, command)
-        if retval.cr_exit_status != 0:
-            log.cl_error("failed to run command [%s] on host [%s], "
-                         "ret = [%d], stdout = [%s], stderr = [%s]",
-                         command, hostname,
-                         retval.cr_exit_status,
-                         retval.cr_stdout,
-                         retval.cr_stderr)
+        # The mounts, the real device and the label of the device are
+        # shared with the other instances on the host
+        zfs = bool(service.ls_backfstype == BACKFSTYPE_ZFS)
+        if snapshot is None:
+            snapshot = host.lsh_snapshot_get(log, self.lsi_device, zfs,
+                                             max_age=max_age)
+        if snapshot is None:
+            log.cl_error("failed to get snapshot of host [%s]", hostname)
             return -1
 
-        ret, real_device = self._lsi_real_device(log)
-        if ret:
-            log.cl_error("failed to get the real service device of instance "
-                         "[%s] on host [%s]",
-                         service_instance_name, hostname)
-            return -1
+        results = [("cat /proc/mounts", snapshot.lhs_mounts_result)]
+        if not zfs:
+            real_device_result = snapshot.lhs_real_device_results[self.lsi_device]
+            results.append(("readlink -f %s" % self.lsi_device,
+                            real_device_result))
+        for command, retval in results:
+            if retval.cr_exit_status != 0:
+                log.cl_error("failed to run command [%s] on host [%s], "
+                             "ret = [%d], stdout = [%s], stderr = [%s]",
+                             command, hostname,
+                             retval.cr_exit_status,
+                             retval.cr_stdout,
+                             retval.cr_stderr)
+                log.cl_error("failed to check whether instance [%s] is "
+                             "mounted on host [%s]",
+                             service_instance_name, hostname)
+                return -1
+
+        retval = snapshot.lhs_mounts_result
+        # The label is only needed if the device is mounted
+        label_result = snapshot.lhs_label_results[self.lsi_device]
+        if zfs:
+            real_device = self.lsi_device
+        else:
+            real_device = real_device_result.cr_stdout.strip()
 
         ret = 0
         for line in retval.cr_stdout.splitlines():
@@ -573,11 +669,18 @@ class LustreServiceInstance(object):
                     return -1
                 continue
 
-            ret, label = host.lsh_lustre_device_label(log, device)
-            if ret:
+            if label_result.cr_exit_status != 0:
+                log.cl_error("failed to run command [%s] on host [%s], "
+                             "ret = [%d], stdout = [%s], stderr = [%s]",
+                             host.lsh_lustre_device_label_command(self.lsi_device),
+                             hostname,
+                             label_result.cr_exit_status,
+                             label_result.cr_stdout,
+                             label_result.cr_stderr)
                 log.cl_error("failed to get the label of device [%s] on "
                              "host [%s]", device, hostname)
                 return -1
+            label = label_result.cr_stdout.strip()
 
             if service_type == LUSTRE_SERVICE_TYPE_MGT:
                 match = mgs_regular.match(label)
@@ -623,31 +726,39 @@ class LustreServiceInstance(object):
 
         return ret
 
-    def _lsi_check_zpool_imported(self, log):
+    def _lsi_check_zpool_imported(self, log,
+                                  max_age=LUSTRE_HOST_SNAPSHOT_MAX_AGE,
+                                  snapshot=None):
         """
         Return 1 when zpool of the service is imported
         Return 0 when zpool of the service is not imported
         Return negative when error
+        The status is checked from the given snapshot, or from a snapshot of
+        the host not older than max_age.
         Read lock of the host and read lock of the instance should be held
         """
         host = self.lsi_host
         hostname = host.sh_hostname
         service = self.lsi_service
         zpool_name = service.ls_zpool_name
-        command = "zpool list %s" % zpool_name
-        retval = host.sh_run(log, command)
-        output = retval.cr_stderr.strip()
-        if retval.cr_exit_status and output.endswith("no such pool"):
-            return 0
-        elif retval.cr_exit_status:
+        if snapshot is None:
+            snapshot = host.lsh_snapshot_get(log, self.lsi_device, True,
+                                             max_age=max_age)
+        if snapshot is None:
+            log.cl_error("failed to get snapshot of host [%s]", hostname)
+            return -1
+        retval = snapshot.lhs_zpool_result
+        if retval.cr_exit_status:
             log.cl_error("failed to run command [%s] on host [%s], "
                          "ret = [%d], stdout = [%s], stderr = [%s]",
-                         command, hostname,
+                         ZPOOL_LIST_COMMAND, hostname,
                          retval.cr_exit_status,
                          retval.cr_stdout,
                          retval.cr_stderr)
             return -1
-        return 1
+        if zpool_name in snapshot.lhs_zpools:
+            return 1
+        return 0
 
     def _lsi_check(self, log, check_mounted=False, check_zpool_imported=False):
 
@@ -707,6 +818,52 @@ class LustreServiceInstance(object):
         """
         return self._lsi_check(log, check_zpool_imported=True)
 
+    def lsi_probe(self, log):
+        """
+        Return a tuple of (mounted, zpool imported, load) of this instance,
+        load is the number of Lustre services mounted on the host.
+        Return None if the host can not be checked.
+        All of them are derived from a single snapshot gathered now, since
+        the failover decision should not be made on stale status.
+        """
+        instance_name = self.lsi_service_instance_name
+        service = self.lsi_service
+        service_name = service.ls_service_name
+        host = self.lsi_host
+        hostname = host.sh_hostname
+        zfs = bool(service.ls_backfstype == BACKFSTYPE_ZFS)
+
+        host_handle = host.lsh_lock.rwl_reader_acquire(log)
+        if host_handle is None:
+            log.cl_stderr("aborting probing instance [%s] of "
+                          "service [%s] on host [%s]",
+                          instance_name, service_name, hostname)
+            return None
+        instance_handle = self.lsi_lock.rwl_reader_acquire(log)
+        if instance_handle is None:
+            host_handle.rwh_release()
+            log.cl_stderr("aborting probing instance [%s] of "
+                          "service [%s] on host [%s]",
+                          instance_name, service_name, hostname)
+            return None
+
+        snapshot = host.lsh_snapshot_get(log, self.lsi_device, zfs,
+                                         max_age=0)
+        if snapshot is None:
+            instance_handle.rwh_release()
+            host_handle.rwh_release()
+            log.cl_error("failed to get snapshot of host [%s]", hostname)
+            return None
+        mounted = self._lsi_check_mounted(log, snapshot=snapshot)
+        imported = 0
+        if mounted >= 0 and zfs:
+            imported = self._lsi_check_zpool_imported(log, snapshot=snapshot)
+        instance_handle.rwh_release()
+        host_handle.rwh_release()
+        if mounted < 0 or imported < 0:
+            return None
+        return mounted, imported, snapshot.lhs_service_count()
+
     def lsi_encode(self, need_status, status_funct, need_structure):
         """
         Return the encoded structure which can be dumped to Json/YAML string
@@ -742,6 +899,8 @@ class LustreServiceStatus(object):
         self.lss_service = service
         # The time the status is updated
         self.lss_update_time = None
+        # The interval to the next update of the status
+        self.lss_interval = LUSTRE_SERVICE_STATUS_CHECK_INTERVAL
         self.lss_mounted_instance = None
         self.lss_zpool_imported_instance = None
 
@@ -753,7 +912,7 @@ class LustreServiceStatus(object):
             return True
         now = time.time()
         elapsed = now - self.lss_update_time
-        if elapsed < 0 or elapsed > LUSTRE_SERVICE_STATUS_CHECK_INTERVAL + 2:
+        if elapsed < 0 or elapsed > self.lss_interval + 2:
             return True
         return False
 
@@ -799,11 +958,11 @@ class LustreServiceStatus(object):
                     log.cl_stderr("aborting fixing service [%s]",
                                   service_name)
                     return -1
-            ret = service.ls_mount(log)
+            ret = service.ls_failover(log)
             if not_mgs:
                 fs_lock_handle.rwh_release()
             if ret:
-                log.cl_stderr("failed to fix service [%s] by mounting it",
+                log.cl_stderr("failed to fix service [%s] by failing it over",
                               service_name)
                 return ret
         log.cl_info("fixed the service [%s]", service_name)
@@ -889,6 +1048,18 @@ class LustreService(object):
             self.ls_service_name = None
         else:
             self.ls_service_name = lustre_fs.lf_fsname + "-" + self.ls_index_string
+        # The number of successful and failed failovers
+        self.ls_failover_count = 0
+        self.ls_failover_failures = 0
+        # The seconds of the last and all of the successful failovers
+        self.ls_failover_seconds = None
+        self.ls_failover_total_seconds = 0.0
+        # The number of recoveries from problems, and the seconds from
+        # finding the problem to the recovery, mean time to recovery is
+        # ls_recovery_total_seconds / ls_recovery_count
+        self.ls_recovery_count = 0
+        self.ls_recovery_seconds = None
+        self.ls_recovery_total_seconds = 0.0
 
     def ls_service_string(self):
         """
@@ -1008,6 +1179,131 @@ class LustreService(object):
 
         return ret
 
+    def _ls_probe_thread(self, log, instance, probes):
+        """
+        Thread that probes an instance of this service
+        """
+        # pylint: disable=no-self-use,bare-except
+        try:
+            probe = instance.lsi_probe(log)
+        except:
+            log.cl_stderr("exception when probing instance [%s] of service "
+                          "[%s]: [%s]", instance.lsi_service_instance_name,
+                          self.ls_service_name, traceback.format_exc())
+            probe = None
+        probes[instance.lsi_service_instance_name] = probe
+
+    def ls_failover_nolock(self, log):
+        """
+        Mount this service on the best instance, lock should be held.
+        All of the instances are probed at the same time. The instance
+        that has imported the zpool is tried first, then the instances
+        whose hosts have less services mounted.
+        """
+        # pylint: disable=too-many-branches,too-many-locals
+        service_name = self.ls_service_name
+        if len(self.ls_instances) == 0:
+            return -1
+
+        start_time = time.time()
+        probes = {}
+        threads = []
+        for instance in self.ls_instances.values():
+            thread = utils.thread_start(self._ls_probe_thread,
+                                        (log, instance, probes))
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        candidates = []
+        imported_instance = None
+        for instance in self.ls_instances.values():
+            hostname = instance.lsi_host.sh_hostname
+            probe = probes.get(instance.lsi_service_instance_name)
+            if probe is None:
+                log.cl_stdout("skipping host [%s] when failing over service "
+                              "[%s] because it can not be checked",
+                              hostname, service_name)
+                continue
+            mounted, imported, load = probe
+            if mounted:
+                log.cl_stdout("service [%s] is already mounted on host [%s], "
+                              "no need to fail over", service_name, hostname)
+                return 0
+            if imported:
+                imported_instance = instance
+            candidates.append((not imported, load,
+                               instance.lsi_service_instance_name, instance))
+        candidates.sort()
+
+        ret = -1
+        hostname = None
+        for _, load, _, instance in candidates:
+            hostname = instance.lsi_host.sh_hostname
+            if (imported_instance is not None and
+                    imported_instance is not instance):
+                ret = imported_instance.lsi_zpool_export(log)
+                if ret:
+                    log.cl_stderr("failed to export zpool of service [%s] "
+                                  "on host [%s]", service_name,
+                                  imported_instance.lsi_host.sh_hostname)
+                    imported_instance = None
+                    break
+                imported_instance = None
+            log.cl_stdout("failing over service [%s] to host [%s] that has "
+                          "[%d] services mounted", service_name, hostname,
+                          load)
+            ret = instance.lsi_mount(log)
+            if ret == 0:
+                break
+            if self.ls_backfstype == BACKFSTYPE_ZFS:
+                # The zpool might have been imported before mount failed
+                imported_instance = instance
+
+        if ret and imported_instance is not None:
+            # Do not leave the zpool imported on the failed host
+            retval = imported_instance.lsi_zpool_export(log)
+            if retval:
+                log.cl_stderr("failed to export zpool of service [%s] on "
+                              "host [%s]", service_name,
+                              imported_instance.lsi_host.sh_hostname)
+
+        elapsed = time.time() - start_time
+        if ret:
+            self.ls_failover_failures += 1
+            log.cl_stderr("failed to fail over service [%s] in [%.1f] seconds",
+                          service_name, elapsed)
+            return -1
+        self.ls_failover_count += 1
+        self.ls_failover_seconds = elapsed
+        self.ls_failover_total_seconds += elapsed
+        log.cl_stdout("failed over service [%s] to host [%s] in [%.1f] "
+                      "seconds", service_name, hostname, elapsed)
+        return 0
+
+    def ls_failover(self, log):
+        """
+        Mount this service on the best instance
+        """
+        handle = self.ls_lock.rwl_writer_acquire(log)
+        if handle is None:
+            log.cl_stderr("aborting failing over service [%s]",
+                          self.ls_service_name)
+            return -1
+        ret = self.ls_failover_nolock(log)
+        handle.rwh_release()
+
+        return ret
+
+    def ls_recovery_record(self, seconds):
+        """
+        Record the seconds from finding the problem of this service to the
+        recovery
+        """
+        self.ls_recovery_count += 1
+        self.ls_recovery_seconds = seconds
+        self.ls_recovery_total_seconds += seconds
+
     def _ls_mounted_instance(self, log):
         """
         Return the instance that has been mounted
@@ -1214,6 +1510,25 @@ class LustreService(object):
                            si.lsi_nid])
         log.cl_stdout(table)
         status.lss_list(log)
+        log.cl_stdout("%-20s %d succeeded, %d failed",
+                      "Failovers:",
+                      self.ls_failover_count,
+                      self.ls_failover_failures)
+        if self.ls_failover_count > 0:
+            log.cl_stdout("%-20s last %.1f seconds, mean %.1f seconds",
+                          "Failover time:",
+                          self.ls_failover_seconds,
+                          self.ls_failover_total_seconds /
+                          self.ls_failover_count)
+        log.cl_stdout("%-20s %d",
+                      "Recoveries:",
+                      self.ls_recovery_count)
+        if self.ls_recovery_count > 0:
+            log.cl_stdout("%-20s last %.1f seconds, mean %.1f seconds",
+                          "Recovery time:",
+                          self.ls_recovery_seconds,
+                          self.ls_recovery_total_seconds /
+                          self.ls_recovery_count)
         return 0
 
 
@@ -1267,6 +1582,352 @@ class LustreMGSInstance(LustreServiceInstance):
                 raise Exception(reason)
 
 
+class LustreOperation(object):
+    """
+    An operation of LustreOperationGraph
+    """
+    # pylint: disable=too-few-public-methods,too-many-arguments
+    def __init__(self, name, description, funct, args, hostnames,
+                 dependencies):
+        self.lo_name = name
+        # Used in the messages, e.g. "OST [lustre0-OST0000]"
+        self.lo_description = description
+        # Called as funct(log, *args), should return 0 on success
+        self.lo_funct = funct
+        self.lo_args = args
+        # The hostnames that the operation might run commands on
+        self.lo_hostnames = hostnames
+        # The names of the operations that should succeed before this one
+        self.lo_dependencies = dependencies
+        # The seconds that the operation took, None if not finished
+        self.lo_duration = None
+
+
+class LustreOperationHistory(object):
+    """
+    The recorded durations of the operations, used to estimate how long an
+    operation will take
+    """
+    def __init__(self, fpath=None):
+        # The file to save the history, None if not saved
+        self.loh_fpath = fpath
+        # Key: "$operation_name:$name", value: estimated seconds
+        self.loh_seconds = {}
+        self.loh_lock = threading.Lock()
+
+    def loh_load(self, log):
+        """
+        Load the history from the file
+        """
+        if self.loh_fpath is None or not os.path.exists(self.loh_fpath):
+            return 0
+        try:
+            history_file = open(self.loh_fpath)
+            seconds = json.load(history_file)
+            history_file.close()
+        except (IOError, ValueError), error:
+            log.cl_error("failed to load operation history from file [%s]: "
+                         "%s", self.loh_fpath, error)
+            return -1
+        self.loh_lock.acquire()
+        self.loh_seconds = seconds
+        self.loh_lock.release()
+        return 0
+
+    def loh_save(self, log):
+        """
+        Save the history into the file
+        """
+        if self.loh_fpath is None:
+            return 0
+        self.loh_lock.acquire()
+        data = json.dumps(self.loh_seconds, indent=4, sort_keys=True)
+        self.loh_lock.release()
+        try:
+            history_file = open(self.loh_fpath, "w")
+            history_file.write(data)
+            history_file.close()
+        except IOError, error:
+            log.cl_error("failed to save operation history into file [%s]: "
+                         "%s", self.loh_fpath, error)
+            return -1
+        return 0
+
+    def loh_record(self, operation_name, name, seconds):
+        """
+        Record the duration of an operation
+        """
+        key = "%s:%s" % (operation_name, name)
+        self.loh_lock.acquire()
+        if key in self.loh_seconds:
+            seconds = (LUSTRE_OPERATION_HISTORY_WEIGHT * seconds +
+                       (1 - LUSTRE_OPERATION_HISTORY_WEIGHT) *
+                       self.loh_seconds[key])
+        self.loh_seconds[key] = seconds
+        self.loh_lock.release()
+
+    def loh_estimate(self, operation_name, name):
+        """
+        Return the estimated seconds of an operation
+        """
+        key = "%s:%s" % (operation_name, name)
+        self.loh_lock.acquire()
+        seconds = self.loh_seconds.get(key)
+        self.loh_lock.release()
+        if seconds is None:
+            return LUSTRE_OPERATION_DEFAULT_SECONDS.get(operation_name, 10.0)
+        return seconds
+
+
+class LustreOperationGraph(object):
+    """
+    Run operations in parallel in the order of their dependencies. At most
+    host_concurrency operations run on a host at the same time. When an
+    operation fails, no more operations will be started.
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, operation_name,
+                 host_concurrency=LUSTRE_OPERATION_HOST_CONCURRENCY,
+                 progress=False, history=None):
+        # Used in the messages, e.g. "mount"
+        self.lg_operation_name = operation_name
+        # LustreOperationHistory to record the durations, could be None
+        self.lg_history = history
+        self.lg_host_concurrency = max(1, host_concurrency)
+        # Whether to print the progress to the console
+        self.lg_progress = progress
+        # All of the LustreOperation objects
+        self.lg_operations = []
+        # The LustreOperation objects that have not been started
+        self.lg_pending = []
+        # The names of the operations that succeeded
+        self.lg_finished = []
+        # The LustreOperation objects that failed
+        self.lg_failed = []
+        # The number of the running operations
+        self.lg_running = 0
+        # Key: hostname, value: number of the running operations
+        self.lg_host_running = {}
+        self.lg_condition = threading.Condition()
+
+    def lg_add(self, name, description, funct, args, hostnames,
+               dependencies=None):
+        """
+        Add an operation
+        """
+        # pylint: disable=too-many-arguments
+        if dependencies is None:
+            dependencies = []
+        operation = LustreOperation(name, description, funct, args,
+                                    hostnames, dependencies)
+        self.lg_operations.append(operation)
+        self.lg_pending.append(operation)
+
+    def _lg_ready(self, operation):
+        """
+        Whether the operation could be started now.
+        Condition should be held.
+        """
+        for dependency in operation.lo_dependencies:
+            if dependency not in self.lg_finished:
+                return False
+        for hostname in operation.lo_hostnames:
+            if (self.lg_host_running.get(hostname, 0) >=
+                    self.lg_host_concurrency):
+                return False
+        return True
+
+    def _lg_thread(self, log, operation):
+        """
+        Thread that runs an operation
+        """
+        # pylint: disable=bare-except
+        start_time = time.time()
+        try:
+            ret = operation.lo_funct(log, *operation.lo_args)
+        except:
+            log.cl_stderr("exception when trying to %s %s: [%s]",
+                          self.lg_operation_name,
+                          operation.lo_description,
+                          traceback.format_exc())
+            ret = -1
+
+        self.lg_condition.acquire()
+        operation.lo_duration = time.time() - start_time
+        self.lg_running -= 1
+        for hostname in operation.lo_hostnames:
+            self.lg_host_running[hostname] -= 1
+        if ret:
+            log.cl_stderr("failed to %s %s", self.lg_operation_name,
+                          operation.lo_description)
+            self.lg_failed.append(operation)
+        else:
+            self.lg_finished.append(operation.lo_name)
+            if self.lg_history is not None:
+                self.lg_history.loh_record(self.lg_operation_name,
+                                           operation.lo_name,
+                                           operation.lo_duration)
+            if self.lg_progress:
+                log.cl_stdout("finished to %s %s in [%.1f] seconds, "
+                              "[%d/%d] done", self.lg_operation_name,
+                              operation.lo_description,
+                              operation.lo_duration,
+                              len(self.lg_finished),
+                              len(self.lg_operations))
+        self.lg_condition.notifyAll()
+        self.lg_condition.release()
+
+    def lg_run(self, log):
+        """
+        Run all of the operations, return 0 if all of them succeeded
+        """
+        self.lg_condition.acquire()
+        while True:
+            if len(self.lg_failed) == 0 and not log.cl_abort:
+                for operation in self.lg_pending[:]:
+                    if not self._lg_ready(operation):
+                        continue
+                    self.lg_pending.remove(operation)
+                    self.lg_running += 1
+                    for hostname in operation.lo_hostnames:
+                        self.lg_host_running[hostname] = \
+                            self.lg_host_running.get(hostname, 0) + 1
+                    utils.thread_start(self._lg_thread, (log, operation))
+            if self.lg_running == 0:
+                break
+            self.lg_condition.wait()
+        self.lg_condition.release()
+
+        if self.lg_history is not None:
+            self.lg_history.loh_save(log)
+        if len(self.lg_failed) > 0:
+            return -1
+        if len(self.lg_pending) > 0:
+            if log.cl_abort:
+                log.cl_stderr("aborting to %s", self.lg_operation_name)
+            else:
+                log.cl_error("unable to %s %s because of dependencies",
+                             self.lg_operation_name,
+                             self.lg_pending[0].lo_description)
+            return -1
+        return 0
+
+    def lg_plan(self, log):
+        """
+        Print the plan without running any operation, together with the
+        estimated time of the critical path. Return -1 if the dependencies
+        can't be satisfied.
+        """
+        # pylint: disable=too-many-locals,too-many-branches
+        # Key: name, value: (stage, estimated finish time, the dependency
+        # on the critical path)
+        schedule = {}
+        remaining = list(self.lg_operations)
+        while len(remaining) > 0:
+            progressed = False
+            for operation in remaining[:]:
+                stage = 0
+                start = 0
+                critical = None
+                ready = True
+                for dependency in operation.lo_dependencies:
+                    if dependency not in schedule:
+                        ready = False
+                        break
+                    dependency_stage, finish, _ = schedule[dependency]
+                    stage = max(stage, dependency_stage + 1)
+                    if critical is None or finish > start:
+                        start = finish
+                        critical = dependency
+                if not ready:
+                    continue
+                if self.lg_history is None:
+                    seconds = LUSTRE_OPERATION_DEFAULT_SECONDS.get(self.lg_operation_name,
+                                                                   10.0)
+                else:
+                    seconds = self.lg_history.loh_estimate(self.lg_operation_name,
+                                                           operation.lo_name)
+                operation.lo_duration = seconds
+                schedule[operation.lo_name] = (stage, start + seconds,
+                                               critical)
+                remaining.remove(operation)
+                progressed = True
+            if not progressed:
+                log.cl_error("unable to %s %s because of dependencies",
+                             self.lg_operation_name,
+                             remaining[0].lo_description)
+                return -1
+
+        # The operations on a host can't take less time than this
+        host_seconds = {}
+        for operation in self.lg_operations:
+            for hostname in operation.lo_hostnames:
+                host_seconds[hostname] = (host_seconds.get(hostname, 0) +
+                                          float(operation.lo_duration) /
+                                          self.lg_host_concurrency)
+
+        table = prettytable.PrettyTable()
+        table.field_names = ["Stage", "Operation", "Hosts", "Seconds"]
+        operations = sorted(self.lg_operations,
+                            key=lambda operation:
+                            (schedule[operation.lo_name][0],
+                             operation.lo_name))
+        for operation in operations:
+            table.add_row([schedule[operation.lo_name][0],
+                           "%s %s" % (self.lg_operation_name,
+                                      operation.lo_description),
+                           ",".join(operation.lo_hostnames),
+                           "%.1f" % operation.lo_duration])
+        log.cl_stdout(table.get_string())
+        # Reset the durations, since the operations didn't really run
+        for operation in self.lg_operations:
+            operation.lo_duration = None
+
+        if len(self.lg_operations) == 0:
+            log.cl_stdout("nothing to %s", self.lg_operation_name)
+            return 0
+
+        name = max(schedule.keys(), key=lambda name: schedule[name][1])
+        critical_seconds = schedule[name][1]
+        path = []
+        while name is not None:
+            path.insert(0, name)
+            name = schedule[name][2]
+        log.cl_stdout("critical path: %s, [%.1f] seconds",
+                      " -> ".join(path), critical_seconds)
+        busiest = max(host_seconds.keys(),
+                      key=lambda hostname: host_seconds[hostname])
+        log.cl_stdout("busiest host: [%s], [%.1f] seconds with [%d] "
+                      "operations at the same time", busiest,
+                      host_seconds[busiest], self.lg_host_concurrency)
+        log.cl_stdout("estimated time to %s: [%.1f] seconds",
+                      self.lg_operation_name,
+                      max(critical_seconds, host_seconds[busiest]))
+        return 0
+
+    def lg_report(self, log):
+        """
+        Print the time that each finished operation took, slowest first
+        """
+        operations = [operation for operation in self.lg_operations
+                      if operation.lo_duration is not None]
+        operations.sort(key=lambda operation: operation.lo_duration,
+                        reverse=True)
+        table = prettytable.PrettyTable()
+        table.field_names = ["Operation", "Hosts", "Seconds", "Result"]
+        for operation in operations:
+            if operation in self.lg_failed:
+                result = cstr.CSTR_FAILED
+            else:
+                result = "ok"
+            table.add_row(["%s %s" % (self.lg_operation_name,
+                                      operation.lo_description),
+                           ",".join(operation.lo_hostnames),
+                           "%.1f" % operation.lo_duration,
+                           result])
+        log.cl_stdout(table.get_string())
+
+
 class LustreFilesystem(object):
     """
     Information about Lustre file system
@@ -1388,14 +2049,41 @@ class LustreFilesystem(object):
                 return -1
             service = self.lf_mgs_mdt
 
+        # Only the host that mounts the MGS could set the parameter, so try
+        # all of the hosts at the same time
+        hosts = []
+        host_handles = []
         for instance in service.ls_instances.values():
             host = instance.lsi_host
-            ret = host.lsh_set_jobid_var(log, fsname, jobid_var)
-            if ret == 0:
-                log.cl_stdout("set jobid var of file system [%s] to [%s]",
-                              fsname, jobid_var)
+            host_handle = host.lsh_lock.rwl_reader_acquire(log)
+            if host_handle is None:
+                log.cl_stderr("aborting set jobid var of file system [%s] on "
+                              "host [%s]", fsname, host.sh_hostname)
+                continue
+            hosts.append(host)
+            host_handles.append(host_handle)
+
+        command = set_jobid_var_command(fsname, jobid_var)
+        results = ssh_host.run_on_hosts(log, hosts, command)
+        for host_handle in host_handles:
+            host_handle.rwh_release()
+
+        ret = -1
+        for retval in results.values():
+            if retval.cr_exit_status == 0:
+                ret = 0
                 break
-        if ret:
+        if ret == 0:
+            log.cl_stdout("set jobid var of file system [%s] to [%s]",
+                          fsname, jobid_var)
+        else:
+            for hostname, retval in results.iteritems():
+                log.cl_error("failed to run command [%s] on host [%s], "
+                             "ret = [%d], stdout = [%s], stderr = [%s]",
+                             command, hostname,
+                             retval.cr_exit_status,
+                             retval.cr_stdout,
+                             retval.cr_stderr)
             log.cl_stderr("failed to set jobid var of file system [%s] to [%s]",
                           fsname, jobid_var)
 
@@ -1454,68 +2142,131 @@ class LustreFilesystem(object):
                     hosts.append(ost_host)
         return hosts
 
-    def lf_format_nolock(self, log):
+    def lf_format_add(self, log, graph):
         """
-        Format the whole file system, not including the MGS
-        Filesystem and MGS should already been umounted
-        Write lock of the MGS and file system should be held
+        Add the formatting of the MDTs and OSTs into the graph
         """
-        log.cl_stdout("formatting file system [%s]", self.lf_fsname)
+        fsname = self.lf_fsname
         if len(self.lf_mgs_nids()) == 0:
             log.cl_stderr("the MGS nid of Lustre file system [%s] is not "
-                          "configured, not able to format", self.lf_fsname)
+                          "configured, not able to format", fsname)
             return -1
 
         for service_name, mdt in self.lf_mdts.iteritems():
-            ret = mdt.ls_format(log)
-            if ret:
-                log.cl_stderr("failed to format MDT [%s] of Lustre file "
-                              "system [%s]", service_name, self.lf_fsname)
-                return -1
+            graph.lg_add(service_name,
+                         "MDT [%s] of Lustre file system [%s]" %
+                         (service_name, fsname),
+                         mdt.ls_format, (), self._lf_service_hostnames(mdt))
 
         for service_name, ost in self.lf_osts.iteritems():
-            ret = ost.ls_format(log)
-            if ret:
-                log.cl_stderr("failed to format OST [%s] of Lustre file "
-                              "system [%s]", service_name, self.lf_fsname)
-                return -1
+            graph.lg_add(service_name,
+                         "OST [%s] of Lustre file system [%s]" %
+                         (service_name, fsname),
+                         ost.ls_format, (), self._lf_service_hostnames(ost))
+        return 0
+
+    def lf_format_nolock(self, log,
+                         host_concurrency=LUSTRE_FORMAT_HOST_CONCURRENCY):
+        """
+        Format the whole file system, not including the MGS. The MDTs and
+        OSTs are formatted in parallel, at most host_concurrency of them on
+        each host at the same time.
+        Filesystem and MGS should already been umounted
+        Write lock of the MGS and file system should be held
+        """
+        log.cl_stdout("formatting file system [%s]", self.lf_fsname)
+        graph = LustreOperationGraph("format",
+                                     host_concurrency=host_concurrency,
+                                     progress=True)
+        ret = self.lf_format_add(log, graph)
+        if ret:
+            return -1
+
+        ret = graph.lg_run(log)
+        graph.lg_report(log)
+        if ret:
+            log.cl_stderr("failed to format file system [%s]",
+                          self.lf_fsname)
+            return -1
         log.cl_stdout("formatted file system [%s]", self.lf_fsname)
         return 0
 
-    def _lf_mount(self, log):
+    def _lf_service_hostnames(self, service):
         """
-        Mount the whole file system
-        Write lock of the file system should be held
+        Return the hostnames that a service might be operated on
         """
-        log.cl_stdout("mounting file system [%s]", self.lf_fsname)
-        if self.lf_mgs is not None:
-            ret = self.lf_mgs.ls_mount_nolock(log)
-            if ret:
-                log.cl_stderr("failed to mount MGS of Lustre file "
-                              "system [%s]", self.lf_fsname)
-                return -1
+        # pylint: disable=no-self-use
+        return [host.sh_hostname for host in service.ls_hosts()]
 
+    def lf_mount_add(self, graph, mgs_names=None):
+        """
+        Add the mounting of the file system into the graph. The MGS is
+        mounted first, then all MDTs, then all OSTs and at last all
+        clients. If mgs_names is not None, the separate MGS has been added
+        by the caller, and mgs_names are the names of its operations.
+        """
+        fsname = self.lf_fsname
+        if mgs_names is None:
+            mgs_names = []
+            if self.lf_mgs is not None:
+                graph.lg_add(self.lf_mgs.ls_service_name,
+                             "MGS of Lustre file system [%s]" % fsname,
+                             self.lf_mgs.ls_mount_nolock, (),
+                             self._lf_service_hostnames(self.lf_mgs))
+                mgs_names.append(self.lf_mgs.ls_service_name)
+        else:
+            mgs_names = list(mgs_names)
+        if self.lf_mgs_mdt is not None:
+            # The other services can't start until the combined MGS is up
+            mdt = self.lf_mgs_mdt
+            graph.lg_add(mdt.ls_service_name,
+                         "MDT [%s] of Lustre file system [%s]" %
+                         (mdt.ls_service_name, fsname),
+                         mdt.ls_mount, (),
+                         self._lf_service_hostnames(mdt))
+            mgs_names.append(mdt.ls_service_name)
+
+        mdt_names = list(mgs_names)
         for service_name, mdt in self.lf_mdts.iteritems():
-            ret = mdt.ls_mount(log)
-            if ret:
-                log.cl_stderr("failed to mount MDT [%s] of Lustre file "
-                              "system [%s]", service_name, self.lf_fsname)
-                return -1
-
+            if mdt == self.lf_mgs_mdt:
+                continue
+            graph.lg_add(service_name,
+                         "MDT [%s] of Lustre file system [%s]" %
+                         (service_name, fsname),
+                         mdt.ls_mount, (), self._lf_service_hostnames(mdt),
+                         dependencies=mgs_names)
+            mdt_names.append(service_name)
+
+        server_names = list(mdt_names)
         for service_name, ost in self.lf_osts.iteritems():
-            ret = ost.ls_mount(log)
-            if ret:
-                log.cl_stderr("failed to mount OST [%s] of Lustre file "
-                              "system [%s]", service_name, self.lf_fsname)
-                return -1
+            graph.lg_add(service_name,
+                         "OST [%s] of Lustre file system [%s]" %
+                         (service_name, fsname),
+                         ost.ls_mount, (), self._lf_service_hostnames(ost),
+                         dependencies=mdt_names)
+            server_names.append(service_name)
 
         for client_index, client in self.lf_clients.iteritems():
-            ret = client.lc_mount(log)
-            if ret:
-                log.cl_stderr("failed to mount client [%s] of Lustre file "
-                              "system [%s]", client_index, self.lf_fsname)
-                return -1
-        log.cl_stdout("mounted file system [%s]", self.lf_fsname)
+            graph.lg_add("client:%s:%s" % (fsname, client_index),
+                         "client [%s] of Lustre file system [%s]" %
+                         (client_index, fsname),
+                         client.lc_mount, (), [client.lc_host.sh_hostname],
+                         dependencies=server_names)
+
+    def _lf_mount(self, log):
+        """
+        Mount the whole file system in parallel
+        Write lock of the file system should be held
+        """
+        fsname = self.lf_fsname
+        log.cl_stdout("mounting file system [%s]", fsname)
+        graph = LustreOperationGraph("mount")
+        self.lf_mount_add(graph)
+        ret = graph.lg_run(log)
+        if ret:
+            log.cl_stderr("failed to mount file system [%s]", fsname)
+            return -1
+        log.cl_stdout("mounted file system [%s]", fsname)
         return 0
 
     def lf_mount(self, log):
@@ -1602,33 +2353,62 @@ class LustreFilesystem(object):
         return self._lf_mount_or_umount_service(log, service, mount=False,
                                                 hostname=None)
 
-    def lf_umount_nolock(self, log):
+    def lf_umount_add(self, graph):
         """
-        Umount the whole file system
-        Write lock of the file system should be held
+        Add the umounting of the file system, not including the separate
+        MGS, into the graph. All clients are umounted first, then all OSTs
+        and at last all MDTs, with the combined MGS after the other MDTs.
+        Return the names of the added operations.
         """
-        # pylint: disable=too-many-branches
+        fsname = self.lf_fsname
+        client_names = []
         for client_index, client in self.lf_clients.iteritems():
-            ret = client.lc_umount(log)
-            if ret:
-                log.cl_stderr("failed to umount client [%s] of Lustre file "
-                              "system [%s]", client_index, self.lf_fsname)
-                return -1
-
+            name = "client:%s:%s" % (fsname, client_index)
+            graph.lg_add(name,
+                         "client [%s] of Lustre file system [%s]" %
+                         (client_index, fsname),
+                         client.lc_umount, (), [client.lc_host.sh_hostname])
+            client_names.append(name)
+
+        ost_names = []
         for service_name, ost in self.lf_osts.iteritems():
-            ret = ost.ls_umount(log)
-            if ret:
-                log.cl_stderr("failed to umount OST [%s] of Lustre file "
-                              "system [%s]", service_name, self.lf_fsname)
-                return -1
-
+            graph.lg_add(service_name,
+                         "OST [%s] of Lustre file system [%s]" %
+                         (service_name, fsname),
+                         ost.ls_umount, (), self._lf_service_hostnames(ost),
+                         dependencies=client_names)
+            ost_names.append(service_name)
+
+        mdt_names = []
         for service_name, mdt in self.lf_mdts.iteritems():
-            ret = mdt.ls_umount(log)
-            if ret:
-                log.cl_stderr("failed to umount MDT [%s] of Lustre file "
-                              "system [%s]", service_name, self.lf_fsname)
-                return -1
-        return 0
+            if mdt == self.lf_mgs_mdt:
+                continue
+            graph.lg_add(service_name,
+                         "MDT [%s] of Lustre file system [%s]" %
+                         (service_name, fsname),
+                         mdt.ls_umount, (), self._lf_service_hostnames(mdt),
+                         dependencies=client_names + ost_names)
+            mdt_names.append(service_name)
+
+        names = client_names + ost_names + mdt_names
+        if self.lf_mgs_mdt is not None:
+            mdt = self.lf_mgs_mdt
+            graph.lg_add(mdt.ls_service_name,
+                         "MDT [%s] of Lustre file system [%s]" %
+                         (mdt.ls_service_name, fsname),
+                         mdt.ls_umount, (), self._lf_service_hostnames(mdt),
+                         dependencies=names)
+            names.append(mdt.ls_service_name)
+        return names
+
+    def lf_umount_nolock(self, log):
+        """
+        Umount the whole file system in parallel
+        Write lock of the file system should be held
+        """
+        graph = LustreOperationGraph("umount")
+        self.lf_umount_add(graph)
+        return graph.lg_run(log)
 
     def lf_umount(self, log):
         """
@@ -2384,18 +3164,60 @@ def lustre_mdt_id(fsname, mdt_index):
     return "%s:%s" % (fsname, mdt_index)
 
 
+class LustreHostSnapshot(object):
+    """
+    The status of a host shared by the service instances on the host. It is
+    gathered by a single batch of commands.
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, devices):
+        self.lhs_time = time.time()
+        # Key: device, value: whether the device is ZFS
+        self.lhs_devices = devices
+        # The result of reading /proc/mounts
+        self.lhs_mounts_result = None
+        # Key: device, value: result of the command that prints the label
+        self.lhs_label_results = {}
+        # Key: device, value: result of readlink, not including ZFS devices
+        self.lhs_real_device_results = {}
+        # The result of listing zpools, None if no ZFS device
+        self.lhs_zpool_result = None
+        # The names of the imported zpools
+        self.lhs_zpools = []
+
+    def lhs_service_count(self):
+        """
+        Return the number of Lustre services mounted on the host
+        """
+        count = 0
+        for line in self.lhs_mounts_result.cr_stdout.splitlines():
+            fields = line.split()
+            # Skip the Clients
+            if (len(fields) >= 3 and fields[2] == "lustre" and
+                    ":/" not in fields[0]):
+                count += 1
+        return count
+
+
 class LustreServerHost(ssh_host.SSHHost):
     # pylint: disable=too-many-instance-attributes,too-many-public-methods
     """
     Each host being used to run Lustre tests has an object of this
     """
     def __init__(self, hostname, lustre_rpms=None, identity_file=None,
-                 local=False, host_id=None):
+                 local=False, host_id=None, ssh_multiplex=False,
+                 use_agent=False):
         # pylint: disable=too-many-arguments
         super(LustreServerHost, self).__init__(hostname,
                                                identity_file=identity_file,
                                                local=local,
-                                               host_id=host_id)
+                                               host_id=host_id,
+                                               ssh_multiplex=ssh_multiplex)
+        # The resident agent on the host, None if not enabled
+        if use_agent:
+            self.lsh_agent = remote_agent.RemoteAgent(self)
+        else:
+            self.lsh_agent = None
         # key: $fsname:$mnt, value: LustreClient object
         self.lsh_clients = {}
         # Key: ls_service_name, value: LustreOSTInstance object
@@ -2411,10 +3233,363 @@ class LustreServerHost(ssh_host.SSHHost):
         self.lsh_lustre_version_minor = None
         self.lsh_lustre_version_patch = None
         self.lsh_version_value = None
+        # Key: directory on local host, value: the copy of the directory
+        # that has been distributed to this host
+        self.lsh_staged_dirs = {}
+        # The devices that the snapshot covers, key: device, value: whether
+        # the device is ZFS
+        self.lsh_snapshot_devices = {}
+        # The latest LustreHostSnapshot, None if invalidated
+        self.lsh_snapshot = None
+        # Whether a thread is gathering the snapshot
+        self.lsh_snapshot_gathering = False
+        # Increased on each invalidation, a snapshot gathered across an
+        # invalidation might be outdated and should not be used
+        self.lsh_snapshot_generation = 0
+        # Protects the snapshot and wakes up the threads waiting for it
+        self.lsh_snapshot_condition = threading.Condition()
+        # Key: device, value: tuple of (identity, result of the label
+        # command, result of readlink), the real path is None for ZFS.
+        # Protected by lsh_snapshot_condition.
+        self.lsh_device_cache = {}
+        # Increased on each invalidation of the device cache, the labels
+        # got across an invalidation should not be cached
+        self.lsh_device_generation = 0
+        # The watcher reporting the changes on the host, None if not started
+        self.lsh_watcher = None
+        # Called as callback(log, host, event) on the events of the watcher
+        self.lsh_watcher_callback = None
+
+    def lsh_snapshot_invalidate(self):
+        """
+        Invalidate the snapshot, e.g. after mounting/umounting services
+        """
+        self.lsh_snapshot_condition.acquire()
+        self.lsh_snapshot = None
+        self.lsh_snapshot_generation += 1
+        self.lsh_snapshot_condition.release()
+
+    def lsh_device_cache_invalidate(self, device=None):
+        """
+        Invalidate the cached label and real path of a device, or of all
+        devices if device is None, e.g. after formatting the device
+        """
+        self.lsh_snapshot_condition.acquire()
+        if device is None:
+            self.lsh_device_cache = {}
+        elif device in self.lsh_device_cache:
+            del self.lsh_device_cache[device]
+        self.lsh_device_generation += 1
+        self.lsh_snapshot_condition.release()
+
+    def _lsh_device_commands(self, devices):
+        """
+        Return the commands that print the labels and real paths of the
+        devices, each item is a tuple of (device, is_label, command)
+        """
+        device_commands = []
+        for device in sorted(devices.keys()):
+            device_commands.append((device, True,
+                                    self.lsh_lustre_device_label_command(device)))
+            if not devices[device]:
+                device_commands.append((device, False,
+                                        "readlink -f %s" % device))
+        return device_commands
+
+    def _lsh_snapshot_gather(self, log, devices):
+        """
+        Gather the snapshot of the devices in a single batch of commands.
+        The labels and real paths of the devices are static, so they are
+        only got again when the identity of the device changes.
+        """
+        # pylint: disable=too-many-locals,too-many-branches
+        snapshot = LustreHostSnapshot(devices)
+        self.lsh_snapshot_condition.acquire()
+        cache = dict(self.lsh_device_cache)
+        generation = self.lsh_device_generation
+        self.lsh_snapshot_condition.release()
+
+        block_devices = []
+        datasets = []
+        for device, zfs in devices.iteritems():
+            if zfs:
+                datasets.append(device)
+            else:
+                block_devices.append(device)
+        commands = ["cat /proc/mounts"]
+        if len(block_devices) > 0:
+            commands.append(DEVICE_IDENTITY_COMMAND %
+                            " ".join(sorted(block_devices)))
+        if len(datasets) > 0:
+            commands.append(DATASET_IDENTITY_COMMAND %
+                            " ".join(sorted(datasets)))
+            commands.append(ZPOOL_LIST_COMMAND)
+        uncached = {}
+        for device, zfs in devices.iteritems():
+            if device not in cache:
+                uncached[device] = zfs
+        device_commands = self._lsh_device_commands(uncached)
+        commands += [command for _, _, command in device_commands]
+
+        results = self.lsh_run_batch(log, commands)
+        if results is None:
+            log.cl_error("failed to run commands %s on host [%s]",
+                         commands, self.sh_hostname)
+            return None
 
-    def lsh_detect_lustre_version(self, log):
+        snapshot.lhs_mounts_result = results[0]
+        index = 1
+        # Key: device, value: major:minor of block device or GUID of ZFS
+        identities = {}
+        if len(block_devices) > 0:
+            # Missing devices only print error, so ignore the exit status
+            for line in results[index].cr_stdout.splitlines():
+                fields = line.split(" ", 2)
+                if len(fields) == 3 and fields[1] != "":
+                    identities[fields[0]] = fields[1] + " " + fields[2]
+            index += 1
+        if len(datasets) > 0:
+            for line in results[index].cr_stdout.splitlines():
+                fields = line.split("\t")
+                if len(fields) == 2:
+                    identities[fields[0]] = fields[1]
+            retval = results[index + 1]
+            snapshot.lhs_zpool_result = retval
+            if retval.cr_exit_status == 0:
+                for line in retval.cr_stdout.splitlines():
+                    zpool_name = line.strip()
+                    if zpool_name != "":
+                        snapshot.lhs_zpools.append(zpool_name)
+            index += 2
+        device_results = zip(device_commands, results[index:])
+
+        changed = {}
+        for device, zfs in devices.iteritems():
+            if device not in cache:
+                continue
+            identity = identities.get(device)
+            if identity is None or identity != cache[device][0]:
+                log.cl_debug("identity of device [%s] on host [%s] changed "
+                             "from [%s] to [%s]", device, self.sh_hostname,
+                             cache[device][0], identity)
+                changed[device] = zfs
+            else:
+                snapshot.lhs_label_results[device] = cache[device][1]
+                if not zfs:
+                    snapshot.lhs_real_device_results[device] = cache[device][2]
+        if len(changed) > 0:
+            device_commands = self._lsh_device_commands(changed)
+            commands = [command for _, _, command in device_commands]
+            results = self.lsh_run_batch(log, commands)
+            if results is None:
+                log.cl_error("failed to run commands %s on host [%s]",
+                             commands, self.sh_hostname)
+                return None
+            device_results += zip(device_commands, results)
+
+        for (device, is_label, _), retval in device_results:
+            if is_label:
+                snapshot.lhs_label_results[device] = retval
+            else:
+                snapshot.lhs_real_device_results[device] = retval
+
+        self.lsh_snapshot_condition.acquire()
+        if generation != self.lsh_device_generation:
+            # The devices might have been formatted during gathering
+            log.cl_debug("not caching the device labels of host [%s] since "
+                         "the cache was invalidated during gathering",
+                         self.sh_hostname)
+            devices = {}
+        for device, zfs in devices.iteritems():
+            if device not in uncached and device not in changed:
+                continue
+            identity = identities.get(device)
+            label_result = snapshot.lhs_label_results[device]
+            real_device_result = snapshot.lhs_real_device_results.get(device)
+            # The label of a device that has never been mounted since
+            # formatting has the format of $fsname:$service and will change
+            # on the first mount, so do not cache it
+            if (identity is None or label_result.cr_exit_status != 0 or
+                    ":" in label_result.cr_stdout or
+                    (not zfs and real_device_result.cr_exit_status != 0)):
+                if device in self.lsh_device_cache:
+                    del self.lsh_device_cache[device]
+                continue
+            self.lsh_device_cache[device] = (identity, label_result,
+                                             real_device_result)
+        self.lsh_snapshot_condition.release()
+        return snapshot
+
+    def lsh_snapshot_get(self, log, device, zfs,
+                         max_age=LUSTRE_HOST_SNAPSHOT_MAX_AGE):
         """
-        Detect the Lustre version
+        Return a snapshot that covers the device and is not older than
+        max_age. If another thread is gathering the snapshot, wait for it
+        rather than gathering at the same time. Return None on error.
+        A snapshot gathered across an invalidation is dropped and gathered
+        again, since it might miss the changes that caused the
+        invalidation.
+        """
+        # pylint: disable=too-many-arguments
+        self.lsh_snapshot_condition.acquire()
+        self.lsh_snapshot_devices[device] = zfs
+        while True:
+            snapshot = self.lsh_snapshot
+            if (snapshot is not None and device in snapshot.lhs_devices and
+                    time.time() - snapshot.lhs_time <= max_age):
+                self.lsh_snapshot_condition.release()
+                return snapshot
+            if self.lsh_snapshot_gathering:
+                self.lsh_snapshot_condition.wait()
+                continue
+            self.lsh_snapshot_gathering = True
+            devices = dict(self.lsh_snapshot_devices)
+            generation = self.lsh_snapshot_generation
+            self.lsh_snapshot_condition.release()
+
+            snapshot = self._lsh_snapshot_gather(log, devices)
+
+            self.lsh_snapshot_condition.acquire()
+            self.lsh_snapshot_gathering = False
+            self.lsh_snapshot_condition.notifyAll()
+            if snapshot is None:
+                break
+            if generation == self.lsh_snapshot_generation:
+                self.lsh_snapshot = snapshot
+                break
+            log.cl_debug("dropping the snapshot of host [%s] since it was "
+                         "invalidated during gathering", self.sh_hostname)
+        self.lsh_snapshot_condition.release()
+        return snapshot
+
+    def _lsh_agent_call(self, log, request):
+        """
+        Send a request to the agent, return None if the agent is not usable
+        """
+        if self.lsh_agent is None:
+            return None
+        return self.lsh_agent.ra_call(log, request)
+
+    def lsh_agent_stop(self, log):
+        """
+        Stop the agent on the host
+        """
+        if self.lsh_agent is None:
+            return 0
+        return self.lsh_agent.ra_stop(log)
+
+    def _lsh_watcher_event(self, log, host, event):
+        """
+        Invalidate the snapshot on the events of the watcher, then call the
+        callback
+        """
+        # pylint: disable=unused-argument
+        self.lsh_snapshot_invalidate()
+        self.lsh_watcher_callback(log, self, event)
+
+    def lsh_watcher_start(self, log, callback):
+        """
+        Start the watcher that reports the changes of the Lustre mounts,
+        the Lustre targets and the zpools on the host
+        """
+        if self.lsh_watcher is not None:
+            return 0
+        self.lsh_watcher_callback = callback
+        self.lsh_watcher = remote_watcher.RemoteWatcher(self,
+                                                        self._lsh_watcher_event)
+        return self.lsh_watcher.rw_start(log)
+
+    def lsh_watcher_alive(self):
+        """
+        Whether the changes on the host are being reported by the watcher
+        """
+        if self.lsh_watcher is None:
+            return False
+        return self.lsh_watcher.rw_alive()
+
+    def lsh_watcher_stop(self, log):
+        """
+        Stop the watcher on the host
+        """
+        if self.lsh_watcher is None:
+            return 0
+        return self.lsh_watcher.rw_stop(log)
+
+    def lsh_run(self, log, command):
+        """
+        Run a short command on the host through the agent if possible,
+        otherwise fall back to sh_run
+        """
+        response = self._lsh_agent_call(log, {"operation":
+                                              remote_agent.REMOTE_AGENT_OPERATION_RUN,
+                                              "command": command})
+        if response is None:
+            return self.sh_run(log, command)
+        retval = remote_agent.response2result(response)
+        utils.COMMAND_STATISTICS.cst_record(self.sh_hostname, command, retval)
+        log.cl_debug("ran [%s] on host [%s] through agent, ret = [%d], "
+                     "stdout = [%s], stderr = [%s]",
+                     command, self.sh_hostname, retval.cr_exit_status,
+                     retval.cr_stdout, retval.cr_stderr)
+        return retval
+
+    def lsh_run_batch(self, log, commands):
+        """
+        Run a list of short commands on the host through the agent if
+        possible, otherwise fall back to sh_run_batch
+        """
+        response = self._lsh_agent_call(log, {"operation":
+                                              remote_agent.REMOTE_AGENT_OPERATION_BATCH,
+                                              "commands": commands})
+        if response is None:
+            return self.sh_run_batch(log, commands)
+        results = []
+        for command, command_response in zip(commands, response["results"]):
+            retval = remote_agent.response2result(command_response)
+            utils.COMMAND_STATISTICS.cst_record(self.sh_hostname, command,
+                                                retval)
+            log.cl_debug("ran [%s] on host [%s] through agent, ret = [%d], "
+                         "stdout = [%s], stderr = [%s]",
+                         command, self.sh_hostname, retval.cr_exit_status,
+                         retval.cr_stdout, retval.cr_stderr)
+            results.append(retval)
+        return results
+
+    def lsh_lctl_get_param(self, log, param):
+        """
+        Return the value of a Lustre parameter
+        """
+        command = "lctl get_param -n %s" % param
+        retval = self.lsh_run(log, command)
+        if retval.cr_exit_status:
+            log.cl_error("failed to run command [%s] on host [%s], "
+                         "ret = [%d], stdout = [%s], stderr = [%s]",
+                         command, self.sh_hostname,
+                         retval.cr_exit_status,
+                         retval.cr_stdout,
+                         retval.cr_stderr)
+            return -1, None
+        return 0, retval.cr_stdout
+
+    def lsh_lctl_set_param(self, log, param, value):
+        """
+        Set the value of a Lustre parameter
+        """
+        command = lctl_set_param_command(param, value)
+        retval = self.lsh_run(log, command)
+        if retval.cr_exit_status:
+            log.cl_error("failed to run command [%s] on host [%s], "
+                         "ret = [%d], stdout = [%s], stderr = [%s]",
+                         command, self.sh_hostname,
+                         retval.cr_exit_status,
+                         retval.cr_stdout,
+                         retval.cr_stderr)
+            return -1
+        return 0
+
+    def _lsh_lustre_version_string(self, log):
+        """
+        Return the Lustre version string, None on error
         """
         command = ("lctl lustre_build_version")
         retval = self.sh_run(log, command)
@@ -2425,8 +3600,30 @@ class LustreServerHost(ssh_host.SSHHost):
                          retval.cr_exit_status,
                          retval.cr_stdout,
                          retval.cr_stderr)
+            return None
+        return retval.cr_stdout.strip()
+
+    def sh_facts_invalidate(self, log):
+        """
+        Invalidate all of the cached facts, including the Lustre version,
+        the snapshot and the cached device labels
+        """
+        super(LustreServerHost, self).sh_facts_invalidate(log)
+        self.lsh_lustre_version_major = None
+        self.lsh_lustre_version_minor = None
+        self.lsh_lustre_version_patch = None
+        self.lsh_version_value = None
+        self.lsh_snapshot_invalidate()
+        self.lsh_device_cache_invalidate()
+
+    def lsh_detect_lustre_version(self, log):
+        """
+        Detect the Lustre version
+        """
+        lustre_version_string = self.sh_cached_fact(log, HOST_FACT_LUSTRE_VERSION,
+                                                    self._lsh_lustre_version_string)
+        if lustre_version_string is None:
             return -1
-        lustre_version_string = retval.cr_stdout.strip()
         version_pattern = (r"^.+(?P<major>\d+)\.(?P<minor>\d+)\.(?P<patch>\d+).+$")
         version_regular = re.compile(version_pattern)
         match = version_regular.match(lustre_version_string)
@@ -2446,17 +3643,26 @@ class LustreServerHost(ssh_host.SSHHost):
                      self.lsh_version_value)
         return 0
 
-    def _lsh_enable_tbf(self, log, param_path, tbf_type):
+    def lsh_enable_tbf_command(self, param_path, tbf_type):
         """
-        Change the NRS policy to TBF
+        Return the command to change the NRS policy to TBF
         param_path example: ost.OSS.ost_io
         """
+        # pylint: disable=no-self-use
         if tbf_type == TBF_TYPE_GENERAL:
             command = ('lctl set_param %s.nrs_policies="tbf"' %
                        (param_path))
         else:
             command = ('lctl set_param %s.nrs_policies="tbf %s"' %
                        (param_path, tbf_type))
+        return command
+
+    def _lsh_enable_tbf(self, log, param_path, tbf_type):
+        """
+        Change the NRS policy to TBF
+        param_path example: ost.OSS.ost_io
+        """
+        command = self.lsh_enable_tbf_command(param_path, tbf_type)
         retval = self.sh_run(log, command)
         if retval.cr_exit_status != 0:
             log.cl_error("failed to run command [%s] on host [%s], "
@@ -2496,25 +3702,29 @@ class LustreServerHost(ssh_host.SSHHost):
         """
         Change the all MDT related NRS policies to TBF
         """
-        ret = self.lsh_enable_mdt_tbf(log, tbf_type)
-        if ret:
-            log.cl_error("failed to enable TBF policy on path [%s] of host "
-                         "[%s]", PARAM_PATH_MDT, self.sh_hostname)
-            return ret
-
-        ret = self.lsh_enable_mdt_readpage_tbf(log, tbf_type)
-        if ret:
-            log.cl_error("failed to enable TBF policy on path [%s] of host "
-                         "[%s]", PARAM_PATH_MDT_READPAGE,
-                         self.sh_hostname)
-            return ret
+        param_paths = [PARAM_PATH_MDT, PARAM_PATH_MDT_READPAGE,
+                       PARAM_PATH_MDT_SETATTR]
+        commands = []
+        for param_path in param_paths:
+            commands.append(self.lsh_enable_tbf_command(param_path,
+                                                        tbf_type))
+        results = self.sh_run_batch(log, commands)
+        if results is None:
+            log.cl_error("failed to enable TBF policy on paths %s of host "
+                         "[%s]", param_paths, self.sh_hostname)
+            return -1
 
-        ret = self.lsh_enable_mdt_setattr_tbf(log, tbf_type)
-        if ret:
-            log.cl_error("failed to enable TBF policy on path [%s] of host "
-                         "[%s]", PARAM_PATH_MDT_SETATTR,
-                         self.sh_hostname)
-            return ret
+        for param_path, command, retval in zip(param_paths, commands, results):
+            if retval.cr_exit_status != 0:
+                log.cl_error("failed to run command [%s] on host [%s], "
+                             "ret = [%d], stdout = [%s], stderr = [%s]",
+                             command, self.sh_hostname,
+                             retval.cr_exit_status,
+                             retval.cr_stdout,
+                             retval.cr_stderr)
+                log.cl_error("failed to enable TBF policy on path [%s] of "
+                             "host [%s]", param_path, self.sh_hostname)
+                return -1
         return 0
 
     def _lsh_enable_fifo(self, log, param_path):
@@ -2587,8 +3797,7 @@ class LustreServerHost(ssh_host.SSHHost):
         """
         Set the job ID variable
         """
-        command = ("lctl conf_param %s.sys.jobid_var=%s" %
-                   (fsname, jobid_var))
+        command = set_jobid_var_command(fsname, jobid_var)
         retval = self.sh_run(log, command)
         if retval.cr_exit_status != 0:
             log.cl_error("failed to run command [%s] on host [%s], "
@@ -2620,15 +3829,9 @@ class LustreServerHost(ssh_host.SSHHost):
         param_path example: ost.OSS.ost_io
         """
         rule_list = []
-        command = "lctl get_param -n %s.nrs_tbf_rule" % param_path
-        retval = self.sh_run(log, command)
-        if retval.cr_exit_status != 0:
-            log.cl_error("failed to run command [%s] on host [%s], "
-                         "ret = [%d], stdout = [%s], stderr = [%s]",
-                         command, self.sh_hostname,
-                         retval.cr_exit_status,
-                         retval.cr_stdout,
-                         retval.cr_stderr)
+        ret, output = self.lsh_lctl_get_param(log,
+                                              "%s.nrs_tbf_rule" % param_path)
+        if ret:
             return -1, rule_list
 
         cpt_pattern = (r"^CPT \d+:$")
@@ -2637,7 +3840,7 @@ class LustreServerHost(ssh_host.SSHHost):
         rule_pattern = (r"^(?P<name>\S+) .+$")
         rule_regular = re.compile(rule_pattern)
 
-        lines = retval.cr_stdout.splitlines()
+        lines = output.splitlines()
         for line in lines:
             if line == "regular_requests:":
                 continue
@@ -2689,6 +3892,17 @@ class LustreServerHost(ssh_host.SSHHost):
         param_path example: ost.OSS.ost_io
         name: rule name
         """
+        ret = self.lsh_check_tbf_rule_support(log)
+        if ret:
+            return -1
+        return self.lsh_lctl_set_param(log, "%s.nrs_tbf_rule" % param_path,
+                                       tbf_rule_start_value(name, expression,
+                                                            rate))
+
+    def lsh_check_tbf_rule_support(self, log):
+        """
+        Return 0 if the TBF rules are supported properly on this host
+        """
         if self.lsh_version_value is None:
             ret = self.lsh_detect_lustre_version(log)
             if ret:
@@ -2696,23 +3910,10 @@ class LustreServerHost(ssh_host.SSHHost):
                              self.sh_hostname)
                 return -1
 
-        if self.lsh_version_value >= version_value(2, 8, 54):
-            command = ('lctl set_param %s.nrs_tbf_rule='
-                       '"start %s %s rate=%d"' %
-                       (param_path, name, expression, rate))
-        else:
+        if self.lsh_version_value < version_value(2, 8, 54):
             log.cl_error("TBF is not supported properly in this Lustre "
                          "version")
             return -1
-        retval = self.sh_run(log, command)
-        if retval.cr_exit_status != 0:
-            log.cl_error("failed to run command [%s] on host [%s], "
-                         "ret = [%d], stdout = [%s], stderr = [%s]",
-                         command, self.sh_hostname,
-                         retval.cr_exit_status,
-                         retval.cr_stdout,
-                         retval.cr_stderr)
-            return -1
         return 0
 
     def lsh_start_ost_io_tbf_rule(self, log, name, expression, rate):
@@ -2747,18 +3948,8 @@ class LustreServerHost(ssh_host.SSHHost):
         """
         Start a TBF rule
         """
-        command = ('lctl set_param %s.nrs_tbf_rule='
-                   '"stop %s"' % (param_path, name))
-        retval = self.sh_run(log, command)
-        if retval.cr_exit_status != 0:
-            log.cl_error("failed to run command [%s] on host [%s], "
-                         "ret = [%d], stdout = [%s], stderr = [%s]",
-                         command, self.sh_hostname,
-                         retval.cr_exit_status,
-                         retval.cr_stdout,
-                         retval.cr_stderr)
-            return -1
-        return 0
+        return self.lsh_lctl_set_param(log, "%s.nrs_tbf_rule" % param_path,
+                                       tbf_rule_stop_value(name))
 
     def lsh_stop_ost_io_tbf_rule(self, log, name):
         """
@@ -2824,7 +4015,7 @@ class LustreServerHost(ssh_host.SSHHost):
                 log.cl_error("failed to install fuser")
                 self.lsh_fuser_install_failed = True
                 return -1
-            self.sh_cached_has_commands["fuser"] = True
+            self.sh_has_command_set("fuser")
 
         command = ("fuser -km %s" % (fpath))
         retval = self.sh_run(log, command)
@@ -2879,6 +4070,15 @@ class LustreServerHost(ssh_host.SSHHost):
         self.lsh_clients[client_id] = client
         return 0
 
+    def lsh_lustre_device_label_command(self, device):
+        """
+        Return the command that prints the label of a lustre device
+        """
+        # pylint: disable=no-self-use
+        return ("e2label %s 2>/dev/null || "
+                "zfs get -H lustre:svname %s | awk {'print $3'}" %
+                (device, device))
+
     def lsh_lustre_device_label(self, log, device):
         """
         Run e2label on a lustre device
@@ -3094,6 +4294,7 @@ class LustreServerHost(ssh_host.SSHHost):
         for mdt in mdts.values():
             command = ("umount %s" % mdt.lsi_mnt)
             retval = self.sh_run(log, command)
+            self.lsh_snapshot_invalidate()
             if retval.cr_exit_status:
                 log.cl_stderr("failed to run command [%s] on host [%s], "
                               "ret = [%d], stdout = [%s], stderr = [%s]",
@@ -3107,6 +4308,7 @@ class LustreServerHost(ssh_host.SSHHost):
         for ost in osts.values():
             command = ("umount %s" % ost.lsi_mnt)
             retval = self.sh_run(log, command)
+            self.lsh_snapshot_invalidate()
             if retval.cr_exit_status:
                 log.cl_stderr("failed to run command [%s] on host [%s], "
                               "ret = [%d], stdout = [%s], stderr = [%s]",
@@ -3125,6 +4327,7 @@ class LustreServerHost(ssh_host.SSHHost):
         Uninstall Lustre RPMs
         """
         log.cl_stdout("uninstalling Lustre RPMs on host [%s]", self.sh_hostname)
+        self.sh_facts_invalidate(log)
 
         ret = self.sh_run(log, "rpm --rebuilddb")
         if ret.cr_exit_status != 0:
@@ -3204,13 +4407,13 @@ class LustreServerHost(ssh_host.SSHHost):
 
         zfs_rpms = ["libnvpair1", "libuutil1", "libzfs2", "libzpool2",
                     "kmod-spl", "kmod-zfs", "spl", "zfs"]
-        rpm_string = ""
-        for zfs_rpm in zfs_rpms:
-            retval = self.sh_run(log, "rpm -qi %s" % zfs_rpm)
-            if retval.cr_exit_status == 0:
-                if rpm_string != "":
-                    rpm_string += " "
-                rpm_string += zfs_rpm
+        installed = self.sh_rpms_installed(log, zfs_rpms)
+        if installed is None:
+            log.cl_stderr("failed to query ZFS RPMs on host [%s]",
+                          self.sh_hostname)
+            return -1
+        rpm_string = " ".join([zfs_rpm for zfs_rpm in zfs_rpms
+                               if installed[zfs_rpm]])
 
         if rpm_string != "":
             retval = self.sh_run(log, "rpm -e --nodeps %s" % rpm_string)
@@ -3309,6 +4512,31 @@ class LustreServerHost(ssh_host.SSHHost):
                       self.sh_hostname)
         return 0
 
+    def lsh_send_dir(self, log, local_dir, workspace):
+        """
+        Send a directory on local host to workspace on this host. If the
+        directory has already been distributed to this host, copy it
+        locally instead.
+        """
+        staged_dir = self.lsh_staged_dirs.get(local_dir.rstrip("/"))
+        if staged_dir is None:
+            return self.sh_send_file(log, local_dir, workspace)
+
+        dest_dir = workspace + "/" + os.path.basename(staged_dir)
+        command = ("rm -fr %s && cp -a %s %s" %
+                   (dest_dir, staged_dir, workspace))
+        retval = self.sh_run(log, command)
+        if retval.cr_exit_status:
+            log.cl_error("failed to run command [%s] on host [%s], "
+                         "ret = [%d], stdout = [%s], stderr = [%s]",
+                         command,
+                         self.sh_hostname,
+                         retval.cr_exit_status,
+                         retval.cr_stdout,
+                         retval.cr_stderr)
+            return -1
+        return 0
+
     def lsh_install_e2fsprogs(self, log, workspace):
         """
         Install e2fsprogs RPMs for Lustre
@@ -3332,7 +4560,7 @@ class LustreServerHost(ssh_host.SSHHost):
         host_copying_rpm_dir = workspace + "/" + basename
         host_e2fsprogs_rpm_dir = workspace + "/" + "e2fsprogs_rpms"
 
-        ret = self.sh_send_file(log, e2fsprogs_dir, workspace)
+        ret = self.lsh_send_dir(log, e2fsprogs_dir, workspace)
         if ret:
             log.cl_stderr("failed to send Lustre RPMs [%s] on local host to "
                           "directory [%s] on host [%s]",
@@ -3415,6 +4643,7 @@ class LustreServerHost(ssh_host.SSHHost):
         # pylint: disable=too-many-return-statements,too-many-branches
         # pylint: disable=too-many-statements
         lustre_rpms = self.lsh_lustre_rpms
+        self.sh_facts_invalidate(log)
         command = ("mkdir -p %s" % workspace)
         retval = self.sh_run(log, command)
         if retval.cr_exit_status:
@@ -3431,7 +4660,7 @@ class LustreServerHost(ssh_host.SSHHost):
         host_copying_rpm_dir = workspace + "/" + basename
         host_lustre_rpm_dir = workspace + "/" + "lustre_rpms"
 
-        ret = self.sh_send_file(log, lustre_rpms.lr_rpm_dir, workspace)
+        ret = self.lsh_send_dir(log, lustre_rpms.lr_rpm_dir, workspace)
         if ret:
             log.cl_stderr("failed to send Lustre RPMs [%s] on local host to "
                           "directory [%s] on host [%s]",
@@ -3635,20 +4864,34 @@ class LustreServerHost(ssh_host.SSHHost):
         log.cl_stdout("reinstalled Lustre RPMs on host [%s]", self.sh_hostname)
         return 0
 
-    def lsh_can_skip_install(self, log):
+    def lsh_lustre_rpm_names(self, log):
         """
-        Check whether the install of Lustre RPMs could be skipped
+        Return the names of the Lustre RPMs without the .rpm subfix
         """
-        lustre_rpms = self.lsh_lustre_rpms
-        for rpm_name in lustre_rpms.lr_rpm_names.values():
-            log.cl_debug("checking whether RPM [%s] is installed on "
-                         "host [%s]", rpm_name, self.sh_hostname)
+        names = []
+        for rpm_name in self.lsh_lustre_rpms.lr_rpm_names.values():
             name, ext = os.path.splitext(rpm_name)
             if ext != ".rpm":
                 log.cl_debug("RPM [%s] does not have .rpm subfix,"
                              "go on anyway", rpm_name)
-            retval = self.sh_run(log, "rpm -qi %s" % name)
-            if retval.cr_exit_status != 0:
+            names.append(name)
+        return names
+
+    def lsh_can_skip_install(self, log):
+        """
+        Check whether the install of Lustre RPMs could be skipped
+        """
+        rpm_names = self.lsh_lustre_rpm_names(log)
+        log.cl_debug("checking whether RPMs %s are installed on host [%s]",
+                     rpm_names, self.sh_hostname)
+        installed = self.sh_rpms_installed(log, rpm_names)
+        if installed is None:
+            log.cl_stdout("failed to check RPMs on host [%s], will not skip "
+                          "install", self.sh_hostname)
+            return False
+
+        for rpm_name in rpm_names:
+            if not installed[rpm_name]:
                 log.cl_stdout("RPM [%s] is not installed on host [%s], "
                               "will not skip install",
                               rpm_name, self.sh_hostname)
@@ -4234,12 +5477,13 @@ def check_hsm_state(log, fpath, states, archive_id=0, host=None):
 
 
 def wait_hsm_state(log, fpath, states, archive_id=0, host=None,
-                   timeout=90, sleep_interval=1):
+                   timeout=90, sleep_interval=1, max_interval=8):
     """
     Wait util the HSM state changes to the expected state
     """
     # pylint: disable=too-many-arguments
-    waited = 0
+    time_start = time.time()
+    backoff = utils.Backoff(sleep_interval, max_interval)
     expected_state = HSMState(states, archive_id=archive_id)
     while True:
         state = lfs_hsm_state(log, fpath, host=host)
@@ -4250,9 +5494,8 @@ def wait_hsm_state(log, fpath, states, archive_id=0, host=None,
             log.cl_debug("expected HSM states [%s]", expected_state.hs_string())
             return 0
 
-        if waited < timeout:
-            waited += sleep_interval
-            time.sleep(sleep_interval)
+        if time.time() - time_start < timeout:
+            backoff.bo_sleep(time_start + timeout)
             continue
         log.cl_error("timeout when waiting the hsm state, expected [%s], "
                      "got [%s]", expected_state.hs_string(), state.hs_string())
@@ -4339,6 +5582,81 @@ class LustreFID(object):
                  self.lf_fid_string))
 
 
+def lustre_ha_conflicts(services):
+    """
+    Return the dict that could be used as the conflicts of reboot, the
+    hosts that share a service should not be down at the same time
+    """
+    conflicts = {}
+    for service in services:
+        hostnames = [host.sh_hostname for host in service.ls_hosts()]
+        for hostname in hostnames:
+            if hostname not in conflicts:
+                conflicts[hostname] = set()
+            for other in hostnames:
+                if other != hostname:
+                    conflicts[hostname].add(other)
+    return conflicts
+
+
+def lustre_rpms_distribute(log, workspace, hosts):
+    """
+    Distribute the Lustre and e2fsprogs RPMs to the hosts in a tree so that
+    the installation on the hosts does not need to send them from local
+    host one by one
+    """
+    hosts_by_rpms = {}
+    for host in hosts:
+        lustre_rpms = host.lsh_lustre_rpms
+        if lustre_rpms is None:
+            continue
+        distribution_id = lustre_rpms.lr_distribution_id
+        if distribution_id not in hosts_by_rpms:
+            hosts_by_rpms[distribution_id] = (lustre_rpms, [])
+        hosts_by_rpms[distribution_id][1].append(host)
+
+    for distribution_id, (lustre_rpms, rpm_hosts) in hosts_by_rpms.iteritems():
+        dest_parent = workspace + "/" + distribution_id
+        for local_dir in [lustre_rpms.lr_rpm_dir,
+                          lustre_rpms.lr_e2fsprogs_rpm_dir]:
+            local_dir = local_dir.rstrip("/")
+            ret = distribute.distribute(log, local_dir, dest_parent,
+                                        rpm_hosts)
+            if ret:
+                log.cl_error("failed to distribute [%s] to hosts",
+                             local_dir)
+                return -1
+            staged_dir = dest_parent + "/" + os.path.basename(local_dir)
+            for host in rpm_hosts:
+                host.lsh_staged_dirs[local_dir] = staged_dir
+    return 0
+
+
+def lustre_hosts_need_install(log, hosts):
+    """
+    Return the hosts that do not have all of their Lustre RPMs installed.
+    The RPMs are checked on all the hosts in parallel.
+    """
+    host_dict = {}
+    for host in hosts:
+        names = host.lsh_lustre_rpm_names(log)
+        command = "rpm -q " + " ".join(sorted(names))
+        if command not in host_dict:
+            host_dict[command] = []
+        host_dict[command].append(host)
+
+    install_hosts = []
+    for command, command_hosts in host_dict.iteritems():
+        host_results = ssh_host.run_on_hosts(log, command_hosts, command)
+        for host in command_hosts:
+            retval = host_results[host.sh_hostname]
+            if retval.cr_exit_status != 0:
+                log.cl_stdout("Lustre RPMs are not all installed on host "
+                              "[%s], will not skip install", host.sh_hostname)
+                install_hosts.append(host)
+    return install_hosts
+
+
 def host_lustre_prepare(log, workspace, host, lazy_prepare=False):
     """
     wrapper of lsh_lustre_prepare for parrallism
@@ -5,11 +5,11 @@
 """
 Lustre test library
 """
+import threading
 import time
 
 # Local libs
 from pylcommon import utils
-from pylcommon import watched_io
 
 MULTIOP = "/usr/lib64/lustre/tests/multiop"
 PAUSING = "PAUSING\n"
@@ -37,6 +37,7 @@ class Multiop(object):
     """
     multiop process on a host
     """
+    # pylint: disable=too-many-instance-attributes
     def __init__(self, host, fpath, args, stdout_file, stderr_file):
         # pylint: disable=too-many-arguments
         self.mop_host = host
@@ -46,6 +47,8 @@ class Multiop(object):
         self.mop_retval = None
         self.mop_stdout = ""
         self.mop_exited = False
+        # Notified when new stdout comes or the process exits
+        self.mop_condition = threading.Condition()
 
     def mop_wait_pausing(self, log):
         """
@@ -53,71 +56,68 @@ class Multiop(object):
         """
         return self._mop_wait_output(log, PAUSING)
 
-    def _mop_wait_output(self, log, expected, timeout=60, sleep_interval=1):
+    def _mop_wait_output(self, log, expected, timeout=60):
         """
         Wait until the output is expected
         """
-        waited = 0
-        while True:
-            if self.mop_stdout == expected:
-                log.cl_debug("got expected output [%s]", expected)
-                return 0
-
-            if waited < timeout:
-                waited += sleep_interval
-                time.sleep(sleep_interval)
-                continue
-            log.cl_error("timeout when waiting output, expected [%s], "
-                         "got [%s]", expected, self.mop_stdout)
-            return -1
-        return -1
+        deadline = time.time() + timeout
+        self.mop_condition.acquire()
+        while self.mop_stdout != expected:
+            time_left = deadline - time.time()
+            if time_left <= 0:
+                log.cl_error("timeout when waiting output, expected [%s], "
+                             "got [%s]", expected, self.mop_stdout)
+                self.mop_condition.release()
+                return -1
+            self.mop_condition.wait(time_left)
+        self.mop_condition.release()
+        log.cl_debug("got expected output [%s]", expected)
+        return 0
 
-    def mop_watcher_stdout(self, args, new_log):
+    def _mop_stdout_line(self, log, line):
         """
-        log watcher of stdout
+        Called when a line of stdout comes
         """
-        # pylint: disable=unused-argument
-        log = args["log"]
-        if len(new_log) == 0:
-            return
-        self.mop_stdout += new_log
         log.cl_debug("stdout of multiop [%s]: [%s]", self.mop_command,
-                     new_log)
+                     line)
+        self.mop_condition.acquire()
+        self.mop_stdout += line + "\n"
+        self.mop_condition.notify_all()
+        self.mop_condition.release()
 
-    def mop_watcher_stderr(self, args, new_log):
+    def _mop_stderr_line(self, log, line):
         """
-        log wather of stderr
+        Called when a line of stderr comes
         """
-        log = args["log"]
-        # pylint: disable=unused-argument
-        if len(new_log) == 0:
-            return
         log.cl_debug("stderr of multiop [%s]: [%s]", self.mop_command,
-                     new_log)
+                     line)
 
     def _mop_thread_main(self, log):
         """
         Thread of running multiop
         """
         host = self.mop_host
-        args = {}
-        args["log"] = log
-        stdout_fd = watched_io.watched_io_open(self.mop_stdout_file,
-                                               self.mop_watcher_stdout, args)
-        stderr_fd = watched_io.watched_io_open(self.mop_stderr_file,
-                                               self.mop_watcher_stderr, args)
+        stdout_fd = open(self.mop_stdout_file, "w")
+        stderr_fd = open(self.mop_stderr_file, "w")
         log.cl_debug("start to run command [%s] on host [%s]",
                      self.mop_command, host.sh_hostname)
         retval = host.sh_run(log, self.mop_command, stdout_tee=stdout_fd,
                              stderr_tee=stderr_fd, return_stdout=False,
-                             return_stderr=False, timeout=None, flush_tee=True)
+                             return_stderr=False, timeout=None, flush_tee=True,
+                             stdout_line_func=lambda line:
+                             self._mop_stdout_line(log, line),
+                             stderr_line_func=lambda line:
+                             self._mop_stderr_line(log, line))
         stdout_fd.close()
         stderr_fd.close()
 
         log.cl_debug("thread of multiop [%s] is exiting",
                      self.mop_command)
+        self.mop_condition.acquire()
         self.mop_retval = retval
         self.mop_exited = True
+        self.mop_condition.notify_all()
+        self.mop_condition.release()
 
     def mop_start(self, log):
         """
@@ -138,21 +138,21 @@ class Multiop(object):
         return self.mop_host.sh_pkill(log, self.mop_command,
                                       special_signal="USR1")
 
-    def mop_wait_exit(self, log, timeout=60, sleep_interval=1, quiet=False):
+    def mop_wait_exit(self, log, timeout=60, quiet=False):
         """
         Wait until the process exits
         """
-        waited = 0
-        while True:
-            if self.mop_exited:
-                log.cl_debug("multiop thread exited")
-                return 0
-
-            if waited < timeout:
-                waited += sleep_interval
-                time.sleep(sleep_interval)
-                continue
-            if not quiet:
-                log.cl_error("timeout when waiting the multiop thread to exit")
-            return -1
-        return -1
+        deadline = time.time() + timeout
+        self.mop_condition.acquire()
+        while not self.mop_exited:
+            time_left = deadline - time.time()
+            if time_left <= 0:
+                self.mop_condition.release()
+                if not quiet:
+                    log.cl_error("timeout when waiting the multiop thread to "
+                                 "exit")
+                return -1
+            self.mop_condition.wait(time_left)
+        self.mop_condition.release()
+        log.cl_debug("multiop thread exited")
+        return 0
@@ -185,7 +185,7 @@ class SharedDisk(object):
         command = "readlink -f %s" % device_link
         expect_stdout = new_device + "\n"
         ret = host.sh_wait_update(log, command, expect_exit_status=0,
-                                  expect_stdout=expect_stdout)
+                                  expect_stdout=expect_stdout, remote=True)
         if ret:
             log.cl_error("created wrong symlink [%s] on host "
                          "[%s], expected [%s]",
@@ -991,7 +991,8 @@ def vm_install(log, workspace, server_host, iso_path, hostname, internet, dns,
     command = ("sshpass -p password ssh -o StrictHostKeyChecking=no "
                "root@%s hostname" % (host_ip))
     ret = server_host.sh_wait_update(log, command, expect_exit_status=0,
-                                     expect_stdout=expect_stdout)
+                                     expect_stdout=expect_stdout,
+                                     remote=True)
     if ret:
         log.cl_error("failed to wait host [%s] up", hostname)
         return -1
@@ -1198,6 +1199,13 @@ def lvirt_vm_reboot(log, host, hostserver):
     if ret == 0:
         return 0
     # reboot failed? try hard reset
+    return lvirt_vm_reset(log, host, hostserver)
+
+
+def lvirt_vm_reset(log, host, hostserver):
+    """
+    Hard reset the guest vm on hostserver and wait until it is up
+    """
     command = "virsh reset %s" % host.sh_hostname
     retval = hostserver.sh_run(log, command)
     if retval.cr_exit_status != 0:
@@ -1216,6 +1224,22 @@ def lvirt_vm_reboot(log, host, hostserver):
     return 0
 
 
+def lvirt_vms_reboot(log, hosts, hosts_servers_mapping):
+    """
+    Reboot the guest vms in parallel, hard reset the ones failed to reboot
+    """
+    orchestrator = ssh_host.RebootOrchestrator(hosts)
+    orchestrator.ro_run(log)
+    for host in orchestrator.ro_failed:
+        ret = lvirt_vm_reset(log, host,
+                             hosts_servers_mapping[host.sh_hostname])
+        if ret:
+            log.cl_error("failed to reboot host [%s]",
+                         host.sh_hostname)
+            return -1
+    return 0
+
+
 def parse_templates_config(log, workspace, config, config_fpath, hosts=None):
     """
     Parse the template configurations
@@ -1638,13 +1662,10 @@ def lvirt_vm_install(log, workspace, config, config_fpath):
             if host not in reboot_hosts:
                 reboot_hosts.append(host)
 
-    for host in reboot_hosts:
-        ret = lvirt_vm_reboot(log, host,
-                              hosts_servers_mapping[host.sh_hostname])
-        if ret:
-            log.cl_error("failed to reboot host [%s]",
-                         host.sh_hostname)
-            return -1
+    ret = lvirt_vms_reboot(log, reboot_hosts, hosts_servers_mapping)
+    if ret:
+        log.cl_error("failed to reboot hosts")
+        return -1
 
     for host in vm_hosts:
         # Destroy all ZFS pool
@@ -0,0 +1,276 @@
+# Copyright (c) 2018 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Resident agent that runs on a remote host and serves requests from the
+local host through a single SSH session
+
+Each request and response is a JSON object in a single line. This avoids
+forking a new SSH process for each operation on the remote host.
+"""
+import base64
+import json
+import os
+import select
+import subprocess
+import threading
+import time
+
+# local libs
+from pylcommon import utils
+from pylcommon import ssh_host
+
+# The time to wait for the agent to start up
+REMOTE_AGENT_START_TIMEOUT = 30
+# The minimum interval to restart the agent after it died
+REMOTE_AGENT_RESTART_INTERVAL = 60
+# The operations supported by the agent
+REMOTE_AGENT_OPERATION_RUN = "run"
+REMOTE_AGENT_OPERATION_BATCH = "batch"
+REMOTE_AGENT_OPERATION_EXIT = "exit"
+
+# The source code of the agent running on the remote host, should work with
+# both Python 2 and Python 3
+REMOTE_AGENT_SOURCE = r'''
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+def _text(data):
+    if isinstance(data, bytes):
+        return data.decode("utf-8", "replace")
+    return data
+
+
+def _result(exit_status, stdout, stderr, start):
+    return {"exit_status": exit_status, "stdout": _text(stdout),
+            "stderr": _text(stderr), "duration": time.time() - start}
+
+
+def _run(command):
+    start = time.time()
+    env = dict(os.environ)
+    env["LANG"] = "en_US.UTF-8"
+    try:
+        devnull = open(os.devnull, "rb")
+        process = subprocess.Popen(command, shell=True,
+                                   executable="/bin/bash", stdin=devnull,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   close_fds=True, env=env)
+        stdout, stderr = process.communicate()
+        devnull.close()
+    except OSError as error:
+        return _result(-1, "", str(error), start)
+    return _result(process.returncode, stdout, stderr, start)
+
+
+def _handle(request):
+    operation = request.get("operation")
+    if operation == "run":
+        result = _run(request["command"])
+    elif operation == "batch":
+        start = time.time()
+        result = _result(0, "", "", start)
+        result["results"] = [_run(command) for command in request["commands"]]
+        result["duration"] = time.time() - start
+    else:
+        result = _result(-1, "", "unknown operation", time.time())
+    result["id"] = request.get("id")
+    return result
+
+
+def main():
+    sys.stdout.write(json.dumps({"id": 0, "ready": True}) + "\n")
+    sys.stdout.flush()
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        request = json.loads(line)
+        if request.get("operation") == "exit":
+            break
+        sys.stdout.write(json.dumps(_handle(request)) + "\n")
+        sys.stdout.flush()
+
+main()
+'''
+
+
+def _response_string(value):
+    """
+    JSON returns unicode, convert it back to str
+    """
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+def response2result(response):
+    """
+    Convert a response of the agent to CommandResult
+    """
+    return utils.CommandResult(stdout=_response_string(response["stdout"]),
+                               stderr=_response_string(response["stderr"]),
+                               exit_status=response["exit_status"],
+                               duration=response["duration"])
+
+
+class RemoteAgent(object):
+    """
+    The local side of the agent running on a remote host
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, host):
+        self.ra_host = host
+        self.ra_process = None
+        self.ra_buffer = ""
+        self.ra_request_id = 0
+        # The last time the agent failed to start or died
+        self.ra_fail_time = 0
+        # Only one request could be in flight, the other requests fall back
+        # to normal commands while the agent is busy
+        self.ra_lock = threading.Lock()
+
+    def _ra_kill(self, log):
+        """
+        Kill the agent, the lock should be held
+        """
+        if self.ra_process is None:
+            return
+        log.cl_debug("killing the agent on host [%s]",
+                     self.ra_host.sh_hostname)
+        utils.nuke_subprocess(self.ra_process)
+        self.ra_process = None
+        self.ra_buffer = ""
+        self.ra_fail_time = time.time()
+
+    def _ra_read_line(self, timeout):
+        """
+        Read a line from the agent, return None on timeout or EOF
+        """
+        deadline = time.time() + timeout
+        fd = self.ra_process.stdout.fileno()
+        while True:
+            index = self.ra_buffer.find("\n")
+            if index >= 0:
+                line = self.ra_buffer[:index]
+                self.ra_buffer = self.ra_buffer[index + 1:]
+                return line
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if not readable:
+                return None
+            data = os.read(fd, 65536)
+            if not data:
+                return None
+            self.ra_buffer += data
+
+    def _ra_start(self, log):
+        """
+        Start the agent, the lock should be held
+        """
+        host = self.ra_host
+        source = base64.b64encode(REMOTE_AGENT_SOURCE)
+        command = ("python -c \"import base64; exec(base64.b64decode('%s'))\"" %
+                   source)
+        if not host.sh_local:
+            command = ssh_host.ssh_command(host.sh_hostname, command,
+                                           identity_file=host.sh_identity_file,
+                                           control_path=host.sh_control_path)
+        log.cl_debug("starting the agent on host [%s]", host.sh_hostname)
+        devnull = open(os.devnull, "w")
+        try:
+            self.ra_process = subprocess.Popen(command, shell=True,
+                                               executable="/bin/bash",
+                                               stdin=subprocess.PIPE,
+                                               stdout=subprocess.PIPE,
+                                               stderr=devnull,
+                                               close_fds=True)
+        except OSError, error:
+            log.cl_debug("failed to start the agent on host [%s]: %s",
+                         host.sh_hostname, error)
+            self.ra_fail_time = time.time()
+            return -1
+        finally:
+            devnull.close()
+
+        line = self._ra_read_line(REMOTE_AGENT_START_TIMEOUT)
+        if line is None:
+            log.cl_debug("the agent on host [%s] failed to start",
+                         host.sh_hostname)
+            self._ra_kill(log)
+            return -1
+        log.cl_debug("started the agent on host [%s]", host.sh_hostname)
+        return 0
+
+    def ra_call(self, log, request, timeout=ssh_host.LONGEST_SIMPLE_COMMAND_TIME):
+        """
+        Send a request to the agent and return the response. Start the agent
+        if necessary. Return None if the agent is not usable or is busy
+        serving another request, in which case the caller should fall back
+        to normal commands.
+        """
+        if not self.ra_lock.acquire(False):
+            log.cl_debug("the agent on host [%s] is busy, falling back to "
+                         "normal command", self.ra_host.sh_hostname)
+            return None
+        if self.ra_process is None:
+            if (time.time() - self.ra_fail_time <
+                    REMOTE_AGENT_RESTART_INTERVAL):
+                self.ra_lock.release()
+                return None
+            ret = self._ra_start(log)
+            if ret:
+                self.ra_lock.release()
+                return None
+
+        self.ra_request_id += 1
+        request["id"] = self.ra_request_id
+        try:
+            self.ra_process.stdin.write(json.dumps(request) + "\n")
+            self.ra_process.stdin.flush()
+        except (IOError, OSError), error:
+            log.cl_debug("failed to send request to the agent on host [%s]: "
+                         "%s", self.ra_host.sh_hostname, error)
+            self._ra_kill(log)
+            self.ra_lock.release()
+            return None
+
+        line = self._ra_read_line(timeout)
+        response = None
+        if line is not None:
+            try:
+                response = json.loads(line)
+            except ValueError:
+                log.cl_debug("invalid response [%s] of the agent on host "
+                             "[%s]", line, self.ra_host.sh_hostname)
+        if response is None or response.get("id") != self.ra_request_id:
+            log.cl_debug("no valid response from the agent on host [%s] for "
+                         "request %s", self.ra_host.sh_hostname, request)
+            self._ra_kill(log)
+            response = None
+        self.ra_lock.release()
+        return response
+
+    def ra_stop(self, log):
+        """
+        Stop the agent
+        """
+        self.ra_lock.acquire()
+        if self.ra_process is not None:
+            try:
+                self.ra_process.stdin.write(json.dumps({"operation":
+                                                        REMOTE_AGENT_OPERATION_EXIT}) +
+                                            "\n")
+                self.ra_process.stdin.close()
+            except (IOError, OSError):
+                pass
+            self._ra_kill(log)
+        self.ra_lock.release()
+        return 0
@@ -0,0 +1,330 @@
+# Copyright (c) 2018 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Watcher that runs on a remote host and reports the changes of the Lustre
+mounts, the Lustre targets and the imported zpools through a single SSH
+session
+
+Each event is a JSON object in a single line. The watcher also sends
+heartbeats, so a watcher that has no heartbeat for a while is considered
+dead, and the status should be checked by polling again.
+"""
+import base64
+import json
+import os
+import select
+import subprocess
+import threading
+import time
+
+# local libs
+from pylcommon import utils
+from pylcommon import ssh_host
+
+# The interval of the heartbeats sent by the watcher
+REMOTE_WATCHER_HEARTBEAT_INTERVAL = 5
+# The watcher is considered dead if nothing is received for this long
+REMOTE_WATCHER_HEARTBEAT_TIMEOUT = REMOTE_WATCHER_HEARTBEAT_INTERVAL * 3
+# The minimum interval to restart the watcher after it died
+REMOTE_WATCHER_RESTART_INTERVAL = 10
+# The event sent when the watcher starts or dies, the status might have
+# changed without any event
+REMOTE_WATCHER_EVENT_RESET = "reset"
+REMOTE_WATCHER_EVENT_HEARTBEAT = "heartbeat"
+REMOTE_WATCHER_EVENT_MOUNTS = "mounts"
+REMOTE_WATCHER_EVENT_TARGETS = "targets"
+REMOTE_WATCHER_EVENT_ZPOOLS = "zpools"
+
+# The source code of the watcher running on the remote host, should work
+# with both Python 2 and Python 3.
+#
+# The changes of /proc/self/mounts wake up poll() with POLLPRI, so mounting
+# and umounting are noticed immediately. The Lustre target states and the
+# zpools have no such notification, so they are sampled every second.
+REMOTE_WATCHER_SOURCE = r'''
+import json
+import os
+import select
+import subprocess
+import sys
+import time
+
+HEARTBEAT_INTERVAL = %d
+SAMPLE_INTERVAL = 1
+TARGET_FILES = ["/sys/kernel/debug/lustre/devices", "/proc/fs/lustre/devices"]
+
+
+def _read(path):
+    try:
+        fd = open(path, "r")
+        data = fd.read()
+        fd.close()
+    except (IOError, OSError):
+        return None
+    return data
+
+
+def _mounts():
+    data = _read("/proc/self/mounts")
+    if data is None:
+        return None
+    mounts = []
+    for line in data.splitlines():
+        fields = line.split()
+        if len(fields) >= 3 and fields[2] in ("lustre", "zfs"):
+            mounts.append(" ".join(fields[:3]))
+    return sorted(mounts)
+
+
+def _targets():
+    for path in TARGET_FILES:
+        data = _read(path)
+        if data is None:
+            continue
+        targets = []
+        for line in data.splitlines():
+            # The last field is the reference count, which changes often
+            fields = line.split()
+            if len(fields) >= 4:
+                targets.append(" ".join(fields[1:4]))
+        return sorted(targets)
+    return []
+
+
+def _zpools():
+    if not os.path.exists("/dev/zfs"):
+        return []
+    try:
+        devnull = open(os.devnull, "r+b")
+        process = subprocess.Popen(["zpool", "list", "-H", "-o", "name"],
+                                   stdin=devnull, stdout=subprocess.PIPE,
+                                   stderr=devnull, close_fds=True)
+        stdout = process.communicate()[0]
+        devnull.close()
+    except OSError:
+        return None
+    if process.returncode:
+        return None
+    if isinstance(stdout, bytes):
+        stdout = stdout.decode("utf-8", "replace")
+    return sorted(stdout.split())
+
+
+def _send(event, value):
+    sys.stdout.write(json.dumps({"event": event, "value": value,
+                                 "time": time.time()}) + "\n")
+    sys.stdout.flush()
+
+
+def main():
+    mounts_fd = os.open("/proc/self/mounts", os.O_RDONLY)
+    poller = select.poll()
+    poller.register(mounts_fd, select.POLLPRI | select.POLLERR)
+    stdin_fd = sys.stdin.fileno()
+    poller.register(stdin_fd, select.POLLIN | select.POLLHUP)
+    samplers = [("mounts", _mounts), ("targets", _targets),
+                ("zpools", _zpools)]
+    values = {}
+    last_heartbeat = 0
+    last_sample = 0
+    _send("reset", None)
+    while True:
+        now = time.time()
+        mounts_changed = False
+        for fd, _ in poller.poll(SAMPLE_INTERVAL * 1000):
+            if fd == mounts_fd:
+                mounts_changed = True
+            elif not os.read(stdin_fd, 4096):
+                # The local side has gone
+                return
+        if mounts_changed:
+            # Read the file to wait for the next change
+            os.lseek(mounts_fd, 0, os.SEEK_SET)
+            while os.read(mounts_fd, 65536):
+                pass
+        elif now - last_sample < SAMPLE_INTERVAL:
+            continue
+        last_sample = now
+        for event, sampler in samplers:
+            value = sampler()
+            if value is None or values.get(event) == value:
+                continue
+            values[event] = value
+            _send(event, value)
+        if now - last_heartbeat >= HEARTBEAT_INTERVAL:
+            last_heartbeat = now
+            _send("heartbeat", None)
+
+main()
+''' % REMOTE_WATCHER_HEARTBEAT_INTERVAL
+
+
+class RemoteWatcher(object):
+    """
+    The local side of the watcher running on a remote host. The callback is
+    called as callback(log, host, event) in the thread of the watcher.
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, host, callback):
+        self.rw_host = host
+        self.rw_callback = callback
+        self.rw_process = None
+        self.rw_buffer = ""
+        self.rw_running = False
+        # The last time anything was received from the watcher
+        self.rw_receive_time = 0
+        # Protects rw_process and rw_running
+        self.rw_condition = threading.Condition()
+
+    def rw_alive(self):
+        """
+        Whether the watcher is running and has sent heartbeats recently
+        """
+        return bool(self.rw_process is not None and
+                    time.time() - self.rw_receive_time <
+                    REMOTE_WATCHER_HEARTBEAT_TIMEOUT)
+
+    def _rw_start_process(self, log):
+        """
+        Start the watcher process, return None on failure
+        """
+        host = self.rw_host
+        source = base64.b64encode(REMOTE_WATCHER_SOURCE)
+        command = ("python -c \"import base64; exec(base64.b64decode('%s'))\"" %
+                   source)
+        if not host.sh_local:
+            command = ssh_host.ssh_command(host.sh_hostname, command,
+                                           identity_file=host.sh_identity_file,
+                                           control_path=host.sh_control_path)
+        log.cl_debug("starting the watcher on host [%s]", host.sh_hostname)
+        devnull = open(os.devnull, "w")
+        try:
+            process = subprocess.Popen(command, shell=True,
+                                       executable="/bin/bash",
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       stderr=devnull,
+                                       close_fds=True)
+        except OSError, error:
+            log.cl_debug("failed to start the watcher on host [%s]: %s",
+                         host.sh_hostname, error)
+            return None
+        finally:
+            devnull.close()
+        self.rw_condition.acquire()
+        self.rw_process = process
+        self.rw_buffer = ""
+        self.rw_receive_time = time.time()
+        self.rw_condition.release()
+        return process
+
+    def _rw_kill(self, log):
+        """
+        Kill the watcher process
+        """
+        self.rw_condition.acquire()
+        if self.rw_process is not None:
+            log.cl_debug("killing the watcher on host [%s]",
+                         self.rw_host.sh_hostname)
+            utils.nuke_subprocess(self.rw_process)
+            self.rw_process = None
+        self.rw_condition.release()
+
+    def _rw_read_line(self, process, timeout):
+        """
+        Read a line from the watcher, return None on timeout or EOF
+        """
+        deadline = time.time() + timeout
+        fd = process.stdout.fileno()
+        while True:
+            index = self.rw_buffer.find("\n")
+            if index >= 0:
+                line = self.rw_buffer[:index]
+                self.rw_buffer = self.rw_buffer[index + 1:]
+                return line
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if not readable:
+                return None
+            data = os.read(fd, 65536)
+            if not data:
+                return None
+            self.rw_buffer += data
+
+    def _rw_receive(self, log, process):
+        """
+        Receive the events until the watcher dies or is stopped
+        """
+        hostname = self.rw_host.sh_hostname
+        while self.rw_running:
+            line = self._rw_read_line(process,
+                                      REMOTE_WATCHER_HEARTBEAT_TIMEOUT)
+            if line is None:
+                if self.rw_running:
+                    log.cl_info("lost the watcher on host [%s]", hostname)
+                return
+            try:
+                event = json.loads(line)
+            except ValueError:
+                log.cl_debug("invalid event [%s] of the watcher on host [%s]",
+                             line, hostname)
+                return
+            self.rw_receive_time = time.time()
+            event_type = event.get("event")
+            if event_type == REMOTE_WATCHER_EVENT_HEARTBEAT:
+                continue
+            log.cl_debug("event [%s] from the watcher on host [%s]: %s",
+                         event_type, hostname, event.get("value"))
+            self.rw_callback(log, self.rw_host, event_type)
+
+    def _rw_thread(self, log):
+        """
+        Thread that keeps the watcher running and dispatches the events
+        """
+        hostname = self.rw_host.sh_hostname
+        log.cl_debug("starting thread of the watcher on host [%s]", hostname)
+        while self.rw_running:
+            start_time = time.time()
+            process = self._rw_start_process(log)
+            if process is not None:
+                self._rw_receive(log, process)
+                self._rw_kill(log)
+                # The events might have been lost, no need to report if
+                # the watcher is being stopped
+                if self.rw_running:
+                    self.rw_callback(log, self.rw_host,
+                                     REMOTE_WATCHER_EVENT_RESET)
+            self.rw_condition.acquire()
+            remaining = (start_time + REMOTE_WATCHER_RESTART_INTERVAL -
+                         time.time())
+            if self.rw_running and remaining > 0:
+                self.rw_condition.wait(remaining)
+            self.rw_condition.release()
+        log.cl_debug("thread of the watcher on host [%s] exited", hostname)
+
+    def rw_start(self, log):
+        """
+        Start the watcher in the background
+        """
+        self.rw_condition.acquire()
+        if self.rw_running:
+            self.rw_condition.release()
+            return 0
+        self.rw_running = True
+        self.rw_condition.release()
+        utils.thread_start(self._rw_thread, (log, ))
+        return 0
+
+    def rw_stop(self, log):
+        """
+        Stop the watcher
+        """
+        self.rw_condition.acquire()
+        self.rw_running = False
+        self.rw_condition.notifyAll()
+        self.rw_condition.release()
+        self._rw_kill(log)
+        return 0
@@ -10,16 +10,20 @@ since this might cause failure of commands that uses this
 library to install python packages.
 """
 
+import base64
+import errno
 import time
 import os
+import pipes
 import glob
 import shutil
 import re
 import stat
+import tempfile
+import threading
 
 # local libs
 from pylcommon import utils
-from pylcommon import watched_io
 
 
 # OS distribution RHEL6/CentOS6
@@ -39,6 +43,44 @@ LONGEST_TIME_YUM_INSTALL = LONGEST_SIMPLE_COMMAND_TIME * 2
 LONGEST_TIME_RPM_INSTALL = LONGEST_SIMPLE_COMMAND_TIME * 2
 # The longest time that a issue reboot would stop the SSH server
 LONGEST_TIME_ISSUE_REBOOT = 10
+# The private directory to save the control sockets of SSH master
+# connections, created by ssh_control_dir()
+SSH_CONTROL_DIR = None
+SSH_CONTROL_DIR_LOCK = threading.Lock()
+# The time that an idle SSH master connection will stay after last use
+SSH_CONTROL_PERSIST = 600
+# The interval to check whether a SSH master connection is still alive
+SSH_CONTROL_CHECK_INTERVAL = 60
+# The max interval and jitter of checking whether a host is up
+WAIT_REBOOT_MAX_INTERVAL = 8
+WAIT_REBOOT_JITTER = 0.2
+# The command that prints the boot time of a host in seconds since epoch
+UPTIME_COMMAND = ("expr $(date +%s) - $(cat /proc/uptime | "
+                  "awk -F . '{print $1}')")
+# The max number of hosts that reboot at the same time by default
+REBOOT_WAVE_SIZE = 16
+# The timeout of checking whether a rebooting host is up
+REBOOT_CHECK_TIMEOUT = 10
+# The number of processes that calculate checksums on a host in parallel
+CHECKSUM_PARALLELISM = 4
+# The max number of files that each checksum process calculates
+CHECKSUM_FILES_PER_PROCESS = 16
+# The exit status of xargs when some of the invocations failed
+XARGS_PARTIAL_FAILURE = 123
+# The paths that have nothing for shell to expand, operations on these
+# paths could be done in-process on local host
+PLAIN_PATH_PATTERN = r"^[\w./+@:,=-]+$"
+PLAIN_PATH_REGULAR = re.compile(PLAIN_PATH_PATTERN)
+# The exit status of ssh when failed to connect to the host
+SSH_CONNECTION_FAILURE = 255
+# The number of consecutive connection failures that opens the circuit
+# breaker of a host
+SSH_BREAKER_THRESHOLD = 3
+# The min/max seconds to fast fail commands before probing the host again
+SSH_BREAKER_BACKOFF_MIN = 10
+SSH_BREAKER_BACKOFF_MAX = 300
+# The timeout of probing whether the host is up
+SSH_BREAKER_PROBE_TIMEOUT = 10
 
 
 def sh_escape(command):
@@ -92,25 +134,69 @@ def scp_remote_escape(filename):
     return sh_escape("".join(new_name))
 
 
-def make_ssh_command(login_name="root", identity_file=None):
+def ssh_control_dir():
+    """
+    Return the directory to save the control sockets, create it if
+    necessary. The directory is only accessible by the current user, so
+    other users can not hijack the master connections. Return None on
+    failure.
+    """
+    # pylint: disable=global-statement
+    global SSH_CONTROL_DIR
+    SSH_CONTROL_DIR_LOCK.acquire()
+    if SSH_CONTROL_DIR is None:
+        try:
+            SSH_CONTROL_DIR = tempfile.mkdtemp(prefix="clownfish_ssh_")
+        except (IOError, OSError):
+            pass
+    control_dir = SSH_CONTROL_DIR
+    SSH_CONTROL_DIR_LOCK.release()
+    return control_dir
+
+
+def ssh_control_dir_remove():
+    """
+    Remove the directory of the control sockets, the master connections
+    should have been stopped
+    """
+    # pylint: disable=global-statement
+    global SSH_CONTROL_DIR
+    SSH_CONTROL_DIR_LOCK.acquire()
+    if SSH_CONTROL_DIR is not None:
+        shutil.rmtree(SSH_CONTROL_DIR, ignore_errors=True)
+        SSH_CONTROL_DIR = None
+    SSH_CONTROL_DIR_LOCK.release()
+
+
+def make_ssh_command(login_name="root", identity_file=None,
+                     control_path=None):
     """
     Return the ssh cmd string
+
+    If control_path is not None, the command will try to reuse the master
+    connection listening on that socket. If the master connection does not
+    exist, ssh will fall back to creating a new connection.
     """
     extra_option = ""
     if identity_file is not None:
         extra_option = ("-i %s" % identity_file)
+    if control_path is not None:
+        extra_option += (" -o ControlMaster=no -o ControlPath=%s" %
+                         control_path)
     full_command = ("ssh -a -x -l %s -o StrictHostKeyChecking=no "
                     "-o BatchMode=yes %s" %
                     (login_name, extra_option))
     return full_command
 
 
-def ssh_command(hostname, command, login_name="root", identity_file=None):
+def ssh_command(hostname, command, login_name="root", identity_file=None,
+                control_path=None):
     """
     Return the ssh command on a remote host
     """
     ssh_string = make_ssh_command(login_name=login_name,
-                                  identity_file=identity_file)
+                                  identity_file=identity_file,
+                                  control_path=control_path)
     full_command = ("%s %s \"LANG=en_US.UTF-8 %s\"" %
                     (ssh_string, hostname, sh_escape(command)))
     return full_command
@@ -119,20 +205,195 @@ def ssh_command(hostname, command, login_name="root", identity_file=None):
 def ssh_run(hostname, command, login_name="root", timeout=None,
             stdout_tee=None, stderr_tee=None, stdin=None,
             return_stdout=True, return_stderr=True,
-            quit_func=None, identity_file=None, flush_tee=False):
+            quit_func=None, identity_file=None, flush_tee=False,
+            control_path=None, stdout_line_func=None, stderr_line_func=None):
     """
     Use ssh to run command on a remote host
+    The result is not recorded in the statistics, the caller should record
+    it under the hostname.
     """
     # pylint: disable=too-many-arguments
     if not isinstance(command, basestring):
         stderr = "type of command argument is not a basestring"
         return utils.CommandResult(stderr=stderr, exit_status=-1)
 
-    full_command = ssh_command(hostname, command, login_name, identity_file)
+    full_command = ssh_command(hostname, command, login_name, identity_file,
+                               control_path=control_path)
     return utils.run(full_command, timeout=timeout, stdout_tee=stdout_tee,
                      stderr_tee=stderr_tee, stdin=stdin,
                      return_stdout=return_stdout, return_stderr=return_stderr,
-                     quit_func=quit_func, flush_tee=flush_tee)
+                     quit_func=quit_func, flush_tee=flush_tee,
+                     stdout_line_func=stdout_line_func,
+                     stderr_line_func=stderr_line_func,
+                     stats_hostname=None)
+
+
+def argv_command(argv):
+    """
+    Return the shell command that runs the program with the arguments
+    """
+    return " ".join([pipes.quote(arg) for arg in argv])
+
+
+def plain_path(path):
+    """
+    Whether the path has nothing for shell to expand
+    """
+    return PLAIN_PATH_REGULAR.match(path) is not None
+
+
+def run_on_hosts(log, hosts, command, parallelism=32,
+                 timeout=LONGEST_SIMPLE_COMMAND_TIME, quit_func=None,
+                 circuit_breaker=True):
+    """
+    Run a command on a list of hosts in parallel from a single thread.
+    Return a dict with hostname as key and CommandResult as value.
+    If circuit_breaker is False, the command will be run even if the
+    circuit breakers of the hosts are open.
+    """
+    # pylint: disable=too-many-arguments
+    if len(hosts) == 0:
+        return {}
+    host_results = {}
+    jobs = []
+    job_hosts = []
+    for host in hosts:
+        if circuit_breaker:
+            retval = host.sh_breaker_check(log)
+        else:
+            retval = None
+        if retval is not None:
+            log.cl_debug("skipped [%s] on host [%s]: %s", command,
+                         host.sh_hostname, retval.cr_stderr)
+            host_results[host.sh_hostname] = retval
+            continue
+        log.cl_debug("starting [%s] on host [%s]", command, host.sh_hostname)
+        jobs.append(host.sh_command_job(command, timeout=timeout))
+        job_hosts.append(host)
+    results = utils.run_jobs(jobs, quit_func=quit_func,
+                             parallelism=parallelism)
+    for host, retval in zip(job_hosts, results):
+        log.cl_debug("ran [%s] on host [%s], ret = [%d], stdout = [%s], "
+                     "stderr = [%s]",
+                     command, host.sh_hostname, retval.cr_exit_status,
+                     retval.cr_stdout_summary(), retval.cr_stderr_summary())
+        utils.COMMAND_STATISTICS.cst_record(host.sh_hostname, command, retval)
+        host.sh_breaker_record(log, retval)
+        host_results[host.sh_hostname] = retval
+    return host_results
+
+
+def group_results(host_results):
+    """
+    Group the hosts that have identical results, like dshbak -c.
+    The argument is the dict returned by run_on_hosts(). Return a list of
+    (hostnames, CommandResult), largest group first.
+    """
+    groups = {}
+    for hostname, retval in host_results.iteritems():
+        key = (retval.cr_exit_status, retval.cr_stdout, retval.cr_stderr)
+        if key not in groups:
+            groups[key] = ([], retval)
+        groups[key][0].append(hostname)
+    grouped = []
+    for hostnames, retval in groups.values():
+        hostnames.sort()
+        grouped.append((hostnames, retval))
+    grouped.sort(key=lambda group: (-len(group[0]), group[0]))
+    return grouped
+
+
+# The names of the host facts that could be cached
+HOST_FACT_DISTRO = "distro"
+HOST_FACT_KERNEL_VERSION = "kernel_version"
+HOST_FACT_SELINUX_STATUS = "selinux_status"
+HOST_FACT_YUM_REPO_IDS = "yum_repo_ids"
+HOST_FACT_HAS_COMMAND_PREFIX = "has_command:"
+# The seconds that a host fact could be cached, None means cached until
+# reboot. The facts not in this dict use HOST_FACT_DEFAULT_TTL.
+HOST_FACT_TTLS = {HOST_FACT_DISTRO: None,
+                  HOST_FACT_KERNEL_VERSION: None,
+                  HOST_FACT_SELINUX_STATUS: 60,
+                  HOST_FACT_YUM_REPO_IDS: 300}
+HOST_FACT_DEFAULT_TTL = 3600
+
+
+class HostFactCache(object):
+    """
+    The cache of the facts of a host, each fact has its own TTL. The whole
+    cache should be invalidated when the host reboots.
+    """
+    def __init__(self):
+        # Key: fact name, Value: (value, expire time or None)
+        self.hfc_facts = {}
+        # Key: fact name, Value: [hits, misses]
+        self.hfc_counters = {}
+        self.hfc_lock = threading.Lock()
+
+    def _hfc_count(self, name, hit):
+        """
+        Update the hit/miss counters, the lock should be held
+        """
+        if name not in self.hfc_counters:
+            self.hfc_counters[name] = [0, 0]
+        if hit:
+            self.hfc_counters[name][0] += 1
+        else:
+            self.hfc_counters[name][1] += 1
+
+    def hfc_get(self, name):
+        """
+        Return (True, value) if the fact is cached, otherwise (False, None)
+        """
+        self.hfc_lock.acquire()
+        if name in self.hfc_facts:
+            value, expire_time = self.hfc_facts[name]
+            if expire_time is None or time.time() < expire_time:
+                self._hfc_count(name, True)
+                self.hfc_lock.release()
+                return True, value
+            del self.hfc_facts[name]
+        self._hfc_count(name, False)
+        self.hfc_lock.release()
+        return False, None
+
+    def hfc_set(self, name, value):
+        """
+        Cache a fact
+        """
+        if name in HOST_FACT_TTLS:
+            ttl = HOST_FACT_TTLS[name]
+        else:
+            ttl = HOST_FACT_DEFAULT_TTL
+        if ttl is None:
+            expire_time = None
+        else:
+            expire_time = time.time() + ttl
+        self.hfc_lock.acquire()
+        self.hfc_facts[name] = (value, expire_time)
+        self.hfc_lock.release()
+
+    def hfc_invalidate(self, name=None):
+        """
+        Invalidate a fact, or all facts if name is None
+        """
+        self.hfc_lock.acquire()
+        if name is None:
+            self.hfc_facts = {}
+        elif name in self.hfc_facts:
+            del self.hfc_facts[name]
+        self.hfc_lock.release()
+
+    def hfc_stats(self):
+        """
+        Return a dict with fact name as key and (hits, misses) as value
+        """
+        self.hfc_lock.acquire()
+        stats = {}
+        for name, counters in self.hfc_counters.iteritems():
+            stats[name] = (counters[0], counters[1])
+        self.hfc_lock.release()
+        return stats
 
 
 class SSHHost(object):
@@ -140,21 +401,249 @@ class SSHHost(object):
     Each SSH host has an object of SSHHost
     """
     # pylint: disable=too-many-public-methods,too-many-instance-attributes
-    def __init__(self, hostname, identity_file=None, local=False, host_id=None):
+    def __init__(self, hostname, identity_file=None, local=False, host_id=None,
+                 ssh_multiplex=False):
+        # pylint: disable=too-many-arguments
         self.sh_hostname = hostname
         self.sh_identity_file = identity_file
         self.sh_local = local
-        self.sh_cached_distro = None
-        # Key: command name, Value: True/False
-        self.sh_cached_has_commands = {}
+        # The cached facts of the host, invalidated on reboot
+        self.sh_fact_cache = HostFactCache()
         self.sh_host_id = host_id
         self.sh_latest_uptime = 0
+        # Whether to reuse a persistent SSH master connection
+        self.sh_ssh_multiplex = ssh_multiplex and not local
+        # The socket of the SSH master connection
+        self.sh_control_path = None
+        # The last time that the SSH master connection is known to be alive
+        self.sh_control_check_time = 0
+        # Protect the starting/stopping of the SSH master connection
+        self.sh_control_lock = threading.Lock()
+        # The number of consecutive connection failures
+        self.sh_breaker_failures = 0
+        # Whether the circuit breaker is open, i.e. commands fast fail
+        self.sh_breaker_open = False
+        # The time to probe the host again when the breaker is open
+        self.sh_breaker_retry_time = 0
+        self.sh_breaker_backoff = SSH_BREAKER_BACKOFF_MIN
+        # Whether a thread is probing the host
+        self.sh_breaker_probing = False
+        self.sh_breaker_lock = threading.Lock()
+
+    def sh_breaker_check(self, log):
+        """
+        Return None if commands could be run on the host. If the circuit
+        breaker is open, return a failed CommandResult immediately instead
+        of waiting for the SSH timeout. When the back-off window expires,
+        one caller probes the host and closes the breaker if it is up.
+        """
+        if self.sh_local:
+            return None
+        self.sh_breaker_lock.acquire()
+        if not self.sh_breaker_open:
+            self.sh_breaker_lock.release()
+            return None
+        if (self.sh_breaker_probing or
+                time.time() < self.sh_breaker_retry_time):
+            self.sh_breaker_lock.release()
+            return self._sh_breaker_result()
+        self.sh_breaker_probing = True
+        self.sh_breaker_lock.release()
+
+        log.cl_debug("probing whether host [%s] is up", self.sh_hostname)
+        # sh_is_up() records the result, which closes the breaker if
+        # succeeded
+        is_up = self.sh_is_up(log, timeout=SSH_BREAKER_PROBE_TIMEOUT)
+
+        self.sh_breaker_lock.acquire()
+        self.sh_breaker_probing = False
+        if not is_up:
+            self.sh_breaker_open = True
+            self.sh_breaker_retry_time = (time.time() +
+                                          self.sh_breaker_backoff)
+            log.cl_debug("host [%s] is still unreachable, fast failing "
+                         "commands for [%d] seconds", self.sh_hostname,
+                         self.sh_breaker_backoff)
+            self.sh_breaker_backoff = min(self.sh_breaker_backoff * 2,
+                                          SSH_BREAKER_BACKOFF_MAX)
+        self.sh_breaker_lock.release()
+        if is_up:
+            return None
+        return self._sh_breaker_result()
+
+    def _sh_breaker_result(self):
+        """
+        Return the result of a command that fast fails
+        """
+        stderr = ("host [%s] is unreachable, circuit breaker is open" %
+                  self.sh_hostname)
+        return utils.CommandResult(stderr=stderr,
+                                   exit_status=SSH_CONNECTION_FAILURE)
+
+    def sh_breaker_record(self, log, retval):
+        """
+        Update the circuit breaker according to the result of a command
+        """
+        if self.sh_local:
+            return
+        # A command that timed out could just be a slow command, e.g. a
+        # stuck mount, so it tells nothing about the connection
+        if retval.cr_timeout:
+            return
+        failed = retval.cr_exit_status == SSH_CONNECTION_FAILURE
+        self.sh_breaker_lock.acquire()
+        if not failed:
+            if self.sh_breaker_open:
+                log.cl_debug("host [%s] is reachable again, closing the "
+                             "circuit breaker", self.sh_hostname)
+            self.sh_breaker_failures = 0
+            self.sh_breaker_open = False
+            self.sh_breaker_backoff = SSH_BREAKER_BACKOFF_MIN
+        else:
+            self.sh_breaker_failures += 1
+            if (not self.sh_breaker_open and
+                    self.sh_breaker_failures >= SSH_BREAKER_THRESHOLD):
+                log.cl_debug("[%d] consecutive connection failures on host "
+                             "[%s], opening the circuit breaker",
+                             self.sh_breaker_failures, self.sh_hostname)
+                self.sh_breaker_open = True
+                # Probe on next command to avoid false alarm
+                self.sh_breaker_retry_time = 0
+        self.sh_breaker_lock.release()
+
+    def _sh_control_socket(self, login_name="root"):
+        """
+        Return the path of the control socket for the login name, None if
+        the directory of control sockets can not be created
+        """
+        control_dir = ssh_control_dir()
+        if control_dir is None:
+            return None
+        return "%s/%s@%s" % (control_dir, login_name, self.sh_hostname)
+
+    def _sh_control_command(self, operation):
+        """
+        Return the command to control the SSH master connection
+        """
+        ssh_string = make_ssh_command(identity_file=self.sh_identity_file)
+        return ("%s -o ControlPath=%s -O %s %s" %
+                (ssh_string, self._sh_control_socket(), operation,
+                 self.sh_hostname))
+
+    def sh_control_check(self, log):
+        """
+        Check whether the SSH master connection is alive, return 0 if alive
+        """
+        command = self._sh_control_command("check")
+        ret = utils.run(command, timeout=LONGEST_SIMPLE_COMMAND_TIME)
+        if ret.cr_exit_status:
+            log.cl_debug("SSH master connection to host [%s] is not alive, "
+                         "ret = [%d], stdout = [%s], stderr = [%s]",
+                         self.sh_hostname, ret.cr_exit_status,
+                         ret.cr_stdout, ret.cr_stderr)
+            return -1
+        self.sh_control_check_time = time.time()
+        return 0
+
+    def _sh_control_start(self, log):
+        """
+        Start the SSH master connection, the lock should be held
+        """
+        control_path = self._sh_control_socket()
+        if control_path is None:
+            log.cl_error("failed to create directory for SSH control "
+                         "sockets on local host")
+            return -1
+        if os.path.exists(control_path):
+            # Stale socket left by a dead master
+            os.unlink(control_path)
+
+        ssh_string = make_ssh_command(identity_file=self.sh_identity_file)
+        # Redirect all of the outputs, otherwise the background master
+        # process will keep the pipes open
+        command = ("%s -o ControlMaster=yes -o ControlPath=%s "
+                   "-o ControlPersist=%d -N -f %s "
+                   "< /dev/null > /dev/null 2>&1" %
+                   (ssh_string, control_path, SSH_CONTROL_PERSIST,
+                    self.sh_hostname))
+        ret = utils.run(command, timeout=LONGEST_SIMPLE_COMMAND_TIME)
+        if ret.cr_exit_status:
+            log.cl_debug("failed to run command [%s] on host [%s], "
+                         "ret = [%d], stdout = [%s], stderr = [%s]",
+                         command, self.sh_hostname, ret.cr_exit_status,
+                         ret.cr_stdout, ret.cr_stderr)
+            return -1
+        self.sh_control_check_time = time.time()
+        log.cl_debug("started SSH master connection to host [%s]",
+                     self.sh_hostname)
+        return 0
+
+    def sh_control_ensure(self, log):
+        """
+        Return the control socket of a healthy SSH master connection, start
+        a new master connection if necessary. Return None if the master
+        connection is not usable, in which case a normal SSH connection
+        should be used.
+        """
+        if not self.sh_ssh_multiplex:
+            return None
+
+        self.sh_control_lock.acquire()
+        control_path = self._sh_control_socket()
+        if control_path is None:
+            self.sh_control_lock.release()
+            return None
+        recent = (time.time() - self.sh_control_check_time <
+                  SSH_CONTROL_CHECK_INTERVAL)
+        if self.sh_control_path is None:
+            # Do not retry too often if the host is not reachable
+            if not recent:
+                ret = self._sh_control_start(log)
+                if ret == 0:
+                    self.sh_control_path = control_path
+                else:
+                    self.sh_control_check_time = time.time()
+        elif not recent or not os.path.exists(control_path):
+            ret = self.sh_control_check(log)
+            if ret:
+                self.sh_control_path = None
+                ret = self._sh_control_start(log)
+                if ret == 0:
+                    self.sh_control_path = control_path
+                else:
+                    self.sh_control_check_time = time.time()
+        control_path = self.sh_control_path
+        self.sh_control_lock.release()
+        return control_path
+
+    def sh_control_stop(self, log):
+        """
+        Stop the SSH master connection
+        """
+        self.sh_control_lock.acquire()
+        if self.sh_control_path is None:
+            self.sh_control_lock.release()
+            return 0
+
+        command = self._sh_control_command("exit")
+        ret = utils.run(command, timeout=LONGEST_SIMPLE_COMMAND_TIME)
+        self.sh_control_path = None
+        self.sh_control_lock.release()
+        if ret.cr_exit_status:
+            log.cl_error("failed to run command [%s] on host [%s], "
+                         "ret = [%d], stdout = [%s], stderr = [%s]",
+                         command, self.sh_hostname, ret.cr_exit_status,
+                         ret.cr_stdout, ret.cr_stderr)
+            return -1
+        log.cl_debug("stopped SSH master connection to host [%s]",
+                     self.sh_hostname)
+        return 0
 
     def sh_is_up(self, log, timeout=60):
         """
         Whether this host is up now
         """
-        ret = self.sh_run(log, "true", timeout=timeout)
+        ret = self.sh_run(log, "true", timeout=timeout, circuit_breaker=False)
         if ret.cr_exit_status != 0:
             return False
         return True
@@ -181,12 +670,15 @@ class SSHHost(object):
         return 0
 
     def sh_wait_condition(self, log, command, condition_func, args, timeout=90,
-                          sleep_interval=1):
+                          sleep_interval=1, max_interval=None, jitter=0.0):
         # pylint: disable=too-many-arguments
         """
         Wait until the condition_func returns 0
+        If max_interval is not None, the interval grows exponentially from
+        sleep_interval to max_interval.
         """
         time_start = time.time()
+        backoff = utils.Backoff(sleep_interval, max_interval, jitter=jitter)
         while True:
             retval = self.sh_run(log, command)
             ret = condition_func(retval, args)
@@ -196,7 +688,7 @@ class SSHHost(object):
             time_now = time.time()
             elapsed = time_now - time_start
             if elapsed < timeout:
-                time.sleep(sleep_interval)
+                backoff.bo_sleep(time_start + timeout)
                 continue
             log.cl_error("timeout on host [%s], ret = [%d], stdout = [%s], "
                          "stderr = [%s]",
@@ -209,31 +701,119 @@ class SSHHost(object):
                        expect_stdout=None,
                        expect_stderr=None,
                        timeout=90,
-                       sleep_interval=1):
+                       sleep_interval=1,
+                       max_interval=None,
+                       remote=False):
         # pylint: disable=too-many-arguments
         """
         Wait until the command result on a host changed to expected values
-        """
+        If remote is True, the waiting loop runs on the host in a single
+        SSH session, which detects the change quicker with less overhead.
+        """
+        if remote and expect_stderr is None:
+            return self.sh_wait_remote(log, command,
+                                       expect_exit_status=expect_exit_status,
+                                       expect_stdout=expect_stdout,
+                                       timeout=timeout,
+                                       sleep_interval=sleep_interval)
         args = [expect_exit_status, expect_stdout, expect_stderr]
         return self.sh_wait_condition(log, command, self.sh_expect_retval,
                                       args, timeout=timeout,
-                                      sleep_interval=sleep_interval)
+                                      sleep_interval=sleep_interval,
+                                      max_interval=max_interval)
+
+    def sh_wait_remote(self, log, command, expect_exit_status=None,
+                       expect_stdout=None, timeout=90, sleep_interval=1):
+        """
+        Run the waiting loop on the host until the exit status and stdout
+        of the command are expected, return 0 if succeeded
+        """
+        # pylint: disable=too-many-arguments
+        if expect_exit_status is None:
+            expect_exit_status = "-"
+        if expect_stdout is None:
+            expect_stdout = "-"
+        else:
+            expect_stdout = base64.b64encode(expect_stdout)
+        script = ("__cf_command='%s'\n"
+                  "__cf_deadline=$((SECONDS + %d))\n"
+                  "while :; do\n"
+                  "    __cf_stdout=$(eval \"$__cf_command\" 2>/dev/null "
+                  "< /dev/null; __cf_ret=$?; echo x; exit $__cf_ret)\n"
+                  "    __cf_ret=$?\n"
+                  "    __cf_stdout=${__cf_stdout%%x}\n"
+                  "    if [ \"%s\" = \"-\" -o \"%s\" = \"$__cf_ret\" ] && "
+                  "[ \"%s\" = \"-\" -o \"%s\" = "
+                  "\"$(printf '%%s' \"$__cf_stdout\" | base64 -w0)\" ]; then\n"
+                  "        exit 0\n"
+                  "    fi\n"
+                  "    if [ $SECONDS -ge $__cf_deadline ]; then\n"
+                  "        echo \"ret = [$__cf_ret], stdout = [$__cf_stdout]\"\n"
+                  "        exit 1\n"
+                  "    fi\n"
+                  "    sleep %s\n"
+                  "done\n" %
+                  (command.replace("'", "'\\''"), timeout,
+                   expect_exit_status, expect_exit_status,
+                   expect_stdout, expect_stdout, sleep_interval))
+        log.cl_debug("waiting on host [%s] until command [%s] returns "
+                     "expected result", self.sh_hostname, command)
+        retval = self.sh_run(log, "bash -s", silent=True,
+                             timeout=timeout + LONGEST_SIMPLE_COMMAND_TIME,
+                             stdin=script)
+        if retval.cr_exit_status == 0:
+            return 0
+        if retval.cr_exit_status == 1:
+            log.cl_error("timeout on host [%s] when waiting command [%s], "
+                         "last result: %s", self.sh_hostname, command,
+                         retval.cr_stdout)
+        else:
+            log.cl_error("failed to wait command [%s] on host [%s], "
+                         "ret = [%d], stdout = [%s], stderr = [%s]",
+                         command, self.sh_hostname, retval.cr_exit_status,
+                         retval.cr_stdout, retval.cr_stderr)
+        return -1
 
     def sh_wait_up(self, log, timeout=LONGEST_TIME_REBOOT):
         """
         Wait until the host is up
         """
         return self.sh_wait_update(log, "true", expect_exit_status=0,
-                                   timeout=timeout)
+                                   timeout=timeout,
+                                   max_interval=WAIT_REBOOT_MAX_INTERVAL)
+
+    def sh_cached_fact(self, log, name, func):
+        """
+        Return the cached fact if any, otherwise call func(log) to get
+        the fact and cache it if it is not None
+        """
+        hit, value = self.sh_fact_cache.hfc_get(name)
+        if hit:
+            return value
+        value = func(log)
+        if value is not None:
+            self.sh_fact_cache.hfc_set(name, value)
+        return value
+
+    def sh_facts_invalidate(self, log):
+        """
+        Invalidate all of the cached facts, e.g. when the host reboots
+        """
+        log.cl_debug("invalidating cached facts of host [%s]",
+                     self.sh_hostname)
+        self.sh_fact_cache.hfc_invalidate()
 
     def sh_distro(self, log):
         """
         Return the distro of this host
         """
-        # pylint: disable=too-many-return-statements,too-many-branches
-        if self.sh_cached_distro is not None:
-            return self.sh_cached_distro
+        return self.sh_cached_fact(log, HOST_FACT_DISTRO, self._sh_distro)
 
+    def _sh_distro(self, log):
+        """
+        Detect the distro of this host
+        """
+        # pylint: disable=too-many-return-statements,too-many-branches
         no_lsb = False
         ret = self.sh_run(log, "which lsb_release")
         if ret.cr_exit_status != 0:
@@ -249,10 +829,8 @@ class SSHHost(object):
                 return None
             else:
                 if "el7" in ret.cr_stdout:
-                    self.sh_cached_distro = DISTRO_RHEL7
                     return DISTRO_RHEL7
                 elif "el6" in ret.cr_stdout:
-                    self.sh_cached_distro = DISTRO_RHEL6
                     return DISTRO_RHEL6
                 else:
                     return None
@@ -279,10 +857,8 @@ class SSHHost(object):
                 name == "ScientificSL" or
                 name == "CentOS"):
             if version.startswith("7"):
-                self.sh_cached_distro = DISTRO_RHEL7
                 return DISTRO_RHEL7
             elif version.startswith("6"):
-                self.sh_cached_distro = DISTRO_RHEL6
                 return DISTRO_RHEL6
             else:
                 log.cl_error("unsupported version [%s] of [%s] on host [%s]",
@@ -381,8 +957,7 @@ class SSHHost(object):
         """
         Get the uptime of the host
         """
-        command = ("expr $(date +%s) - $(cat /proc/uptime | "
-                   "awk -F . '{print $1}')")
+        command = UPTIME_COMMAND
         retval = self.sh_run(log, command)
         if retval.cr_exit_status != 0:
             log.cl_error("can't get uptime on host [%s], command = [%s], "
@@ -625,14 +1200,20 @@ class SSHHost(object):
             self.sh_set_umask_perms(dest)
         return 0
 
-    def sh_make_rsync_cmd(self, sources, dest, delete_dest, preserve_symlinks):
+    def sh_make_rsync_cmd(self, sources, dest, delete_dest, preserve_symlinks,
+                          from_local=True):
         """
         Given a list of source paths and a destination path, produces the
         appropriate rsync command for copying them. Remote paths must be
         pre-encoded.
         """
-        # pylint: disable=no-self-use
-        ssh_cmd = make_ssh_command(identity_file=self.sh_identity_file)
+        # pylint: disable=too-many-arguments
+        # The control socket only exists on local host
+        control_path = None
+        if from_local:
+            control_path = self.sh_control_path
+        ssh_cmd = make_ssh_command(identity_file=self.sh_identity_file,
+                                   control_path=control_path)
         if delete_dest:
             delete_flag = "--delete"
         else:
@@ -649,18 +1230,26 @@ class SSHHost(object):
         """
         Check whether host has a command
         """
-        # pylint: disable=too-many-return-statements,too-many-branches
-        if command in self.sh_cached_has_commands:
-            return self.sh_cached_has_commands[command]
+        name = HOST_FACT_HAS_COMMAND_PREFIX + command
+        hit, result = self.sh_fact_cache.hfc_get(name)
+        if hit:
+            return result
 
-        ret = self.sh_run(log, "which %s" % command)
-        if ret.cr_exit_status != 0:
-            result = False
+        if self.sh_local:
+            result = utils.which(command) is not None
         else:
-            result = True
-        self.sh_cached_has_commands[command] = result
+            ret = self.sh_run(log, "which %s" % command)
+            result = ret.cr_exit_status == 0
+        self.sh_fact_cache.hfc_set(name, result)
         return result
 
+    def sh_has_command_set(self, command):
+        """
+        Mark the command as installed on the host
+        """
+        self.sh_fact_cache.hfc_set(HOST_FACT_HAS_COMMAND_PREFIX + command,
+                                   True)
+
     def sh_has_zpool(self, log):
         """
         Check whether host has zpool command
@@ -779,7 +1368,7 @@ class SSHHost(object):
             if ret.cr_exit_status:
                 log.cl_error("failed to install rsync")
                 return -1
-            self.sh_cached_has_commands["rsync"] = True
+            self.sh_has_command_set("rsync")
 
         if isinstance(source, basestring):
             source = [source]
@@ -789,7 +1378,8 @@ class SSHHost(object):
 
         local_sources = [sh_escape(path) for path in source]
         rsync = remote_host.sh_make_rsync_cmd(local_sources, remote_dest,
-                                              delete_dest, preserve_symlinks)
+                                              delete_dest, preserve_symlinks,
+                                              from_local=from_local)
         if from_local:
             ret = utils.run(rsync)
             from_host = "local"
@@ -810,11 +1400,21 @@ class SSHHost(object):
     def sh_run(self, log, command, silent=False, login_name="root",
                timeout=LONGEST_SIMPLE_COMMAND_TIME, stdout_tee=None,
                stderr_tee=None, stdin=None, return_stdout=True,
-               return_stderr=True, quit_func=None, flush_tee=False):
+               return_stderr=True, quit_func=None, flush_tee=False,
+               stdout_line_func=None, stderr_line_func=None,
+               circuit_breaker=True):
         """
         Run a command on the host
+        If command is a list of program and arguments, it is executed
+        directly without a shell on local host.
+        If stdout_line_func/stderr_line_func is not None, it will be called
+        with each line of the output as soon as the line is complete.
+        If circuit_breaker is False, run the command even if the host is
+        considered unreachable.
         """
         # pylint: disable=too-many-arguments
+        if isinstance(command, list) and not self.sh_local:
+            command = argv_command(command)
         if not silent:
             log.cl_debug("starting [%s] on host [%s]", command,
                          self.sh_hostname)
@@ -823,26 +1423,234 @@ class SSHHost(object):
                             stderr_tee=stderr_tee, stdin=stdin,
                             return_stdout=return_stdout,
                             return_stderr=return_stderr,
-                            quit_func=quit_func, flush_tee=flush_tee)
+                            quit_func=quit_func, flush_tee=flush_tee,
+                            stdout_line_func=stdout_line_func,
+                            stderr_line_func=stderr_line_func,
+                            stats_hostname=self.sh_hostname)
         else:
+            if circuit_breaker:
+                ret = self.sh_breaker_check(log)
+                if ret is not None:
+                    if not silent:
+                        log.cl_debug("skipped [%s] on host [%s]: %s",
+                                     command, self.sh_hostname,
+                                     ret.cr_stderr)
+                    return ret
+            control_path = None
+            if login_name == "root":
+                control_path = self.sh_control_ensure(log)
             ret = ssh_run(self.sh_hostname, command, login_name=login_name,
                           timeout=timeout,
                           stdout_tee=stdout_tee, stderr_tee=stderr_tee,
                           stdin=stdin, return_stdout=return_stdout,
                           return_stderr=return_stderr, quit_func=quit_func,
                           identity_file=self.sh_identity_file,
-                          flush_tee=flush_tee)
+                          flush_tee=flush_tee, control_path=control_path,
+                          stdout_line_func=stdout_line_func,
+                          stderr_line_func=stderr_line_func)
+            utils.COMMAND_STATISTICS.cst_record(self.sh_hostname, command,
+                                                ret)
+            self.sh_breaker_record(log, ret)
         if not silent:
             log.cl_debug("ran [%s] on host [%s], ret = [%d], stdout = [%s], "
                          "stderr = [%s]",
                          command, self.sh_hostname, ret.cr_exit_status,
-                         ret.cr_stdout, ret.cr_stderr)
+                         ret.cr_stdout_summary(), ret.cr_stderr_summary())
         return ret
 
+    def sh_run_async(self, log, command, silent=False, login_name="root",
+                     timeout=LONGEST_SIMPLE_COMMAND_TIME, stdout_tee=None,
+                     stderr_tee=None, stdin=None, return_stdout=True,
+                     return_stderr=True, quit_func=None, flush_tee=False):
+        """
+        Start to run a command on the host in the background event loop and
+        return a utils.CommandFuture immediately. The arguments have the
+        same meanings as sh_run().
+        """
+        # pylint: disable=too-many-arguments
+        if isinstance(command, list) and not self.sh_local:
+            command = argv_command(command)
+        if not silent:
+            log.cl_debug("starting [%s] on host [%s]", command,
+                         self.sh_hostname)
+        if self.sh_local or not isinstance(command, basestring):
+            full_command = command
+        else:
+            ret = self.sh_breaker_check(log)
+            if ret is not None:
+                # Return a future that has already finished
+                job = utils.CommandJob(command)
+                job.cj_result = ret
+                future = utils.CommandFuture(job)
+                future.cf_finish(job)
+                return future
+            control_path = None
+            if login_name == "root":
+                control_path = self.sh_control_ensure(log)
+            full_command = ssh_command(self.sh_hostname, command,
+                                       login_name=login_name,
+                                       identity_file=self.sh_identity_file,
+                                       control_path=control_path)
+        future = utils.run_async(full_command, timeout=timeout,
+                                 stdout_tee=stdout_tee, stderr_tee=stderr_tee,
+                                 stdin=stdin, return_stdout=return_stdout,
+                                 return_stderr=return_stderr,
+                                 quit_func=quit_func, flush_tee=flush_tee,
+                                 silent=True)
+        hostname = self.sh_hostname
+
+        def _sh_run_async_done(future):
+            """
+            Log and record the result when the command finishes
+            """
+            ret = future.cf_job.cj_result
+            utils.COMMAND_STATISTICS.cst_record(hostname, command, ret)
+            self.sh_breaker_record(log, ret)
+            if silent:
+                return
+            log.cl_debug("ran [%s] on host [%s], ret = [%d], stdout = [%s], "
+                         "stderr = [%s]",
+                         command, hostname, ret.cr_exit_status,
+                         ret.cr_stdout_summary(),
+                         ret.cr_stderr_summary())
+        future.cf_add_done_callback(_sh_run_async_done)
+        return future
+
+    def sh_iter_lines(self, log, command, login_name="root", timeout=None,
+                      stdin=None, stderr_line_func=None, quit_func=None):
+        """
+        Run a command on the host and yield the lines of stdout as soon as
+        they are complete, with constant memory. Use sh_line_job() and
+        job.cj_iter_lines() instead if the exit status is needed.
+        """
+        # pylint: disable=too-many-arguments
+        job = self.sh_line_job(log, command, login_name=login_name,
+                               timeout=timeout, stdin=stdin,
+                               stderr_line_func=stderr_line_func,
+                               quit_func=quit_func)
+        for line in job.cj_iter_lines():
+            yield line
+
+    def sh_line_job(self, log, command, login_name="root", timeout=None,
+                    stdin=None, stderr_line_func=None, quit_func=None):
+        """
+        Return a job whose stdout could be iterated line by line using
+        job.cj_iter_lines(). The stdout is not saved in the result.
+        """
+        # pylint: disable=too-many-arguments
+        log.cl_debug("starting [%s] on host [%s]", command, self.sh_hostname)
+        if self.sh_local:
+            full_command = command
+        else:
+            control_path = None
+            if login_name == "root":
+                control_path = self.sh_control_ensure(log)
+            full_command = ssh_command(self.sh_hostname, command,
+                                       login_name=login_name,
+                                       identity_file=self.sh_identity_file,
+                                       control_path=control_path)
+        return utils.CommandJob(full_command, timeout=timeout, stdin=stdin,
+                                return_stdout=False, quit_func=quit_func,
+                                stderr_line_func=stderr_line_func)
+
+    def sh_run_batch(self, log, commands, timeout=LONGEST_SIMPLE_COMMAND_TIME,
+                     quit_func=None):
+        """
+        Run a list of commands on the host in a single shell invocation.
+        The commands are run one by one, each with its own stdout, stderr and
+        exit status. Return a list of CommandResult with the same order as
+        the commands, or None on error.
+        """
+        # pylint: disable=too-many-locals
+        if len(commands) == 0:
+            return []
+
+        # The header of each command is:
+        # $marker $index $exit_status $stdout_size $stderr_size $start $end
+        # and is followed by the stdout and stderr of the command. The sizes
+        # are used to split the outputs, so the outputs can contain anything.
+        marker = "CLOWNFISH_BATCH_" + utils.random_word(16)
+        script = ('__cf_dir=$(mktemp -d /tmp/clownfish_batch.XXXXXXXX) || exit 1\n'
+                  '__cf_run() {\n'
+                  '    __cf_start=$(date +%s.%N)\n'
+                  '    (eval "$2") > $__cf_dir/stdout 2> $__cf_dir/stderr < /dev/null\n'
+                  '    __cf_ret=$?\n'
+                  '    __cf_end=$(date +%s.%N)\n'
+                  '    echo "' + marker + ' $1 $__cf_ret '
+                  '$(stat -c %s $__cf_dir/stdout) '
+                  '$(stat -c %s $__cf_dir/stderr) $__cf_start $__cf_end"\n'
+                  '    cat $__cf_dir/stdout $__cf_dir/stderr\n'
+                  '}\n')
+        for index, command in enumerate(commands):
+            script += ("__cf_run %d '%s'\n" %
+                       (index, command.replace("'", "'\\''")))
+        script += 'rm -fr $__cf_dir\n'
+
+        log.cl_debug("starting batch of [%d] commands on host [%s]: %s",
+                     len(commands), self.sh_hostname, commands)
+        retval = self.sh_run(log, "bash -s", silent=True, timeout=timeout,
+                             stdin=script, quit_func=quit_func)
+        if retval.cr_exit_status != 0:
+            log.cl_error("failed to run batch of commands %s on host [%s], "
+                         "ret = [%d], stdout = [%s], stderr = [%s]",
+                         commands, self.sh_hostname, retval.cr_exit_status,
+                         retval.cr_stdout, retval.cr_stderr)
+            return None
+
+        results = []
+        output = retval.cr_stdout
+        position = 0
+        for index, command in enumerate(commands):
+            newline = output.find("\n", position)
+            if newline < 0:
+                log.cl_error("no output of command [%s] in batch on host [%s], "
+                             "stdout = [%s], stderr = [%s]",
+                             command, self.sh_hostname, retval.cr_stdout,
+                             retval.cr_stderr)
+                return None
+            fields = output[position:newline].split()
+            if (len(fields) != 7 or fields[0] != marker or
+                    fields[1] != str(index)):
+                log.cl_error("unexpected header [%s] of command [%s] in batch "
+                             "on host [%s]", output[position:newline],
+                             command, self.sh_hostname)
+                return None
+            try:
+                exit_status = int(fields[2])
+                stdout_size = int(fields[3])
+                stderr_size = int(fields[4])
+                duration = float(fields[6]) - float(fields[5])
+            except ValueError:
+                log.cl_error("invalid header [%s] of command [%s] in batch "
+                             "on host [%s]", output[position:newline],
+                             command, self.sh_hostname)
+                return None
+            position = newline + 1
+            stdout = output[position:position + stdout_size]
+            position += stdout_size
+            stderr = output[position:position + stderr_size]
+            position += stderr_size
+            result = utils.CommandResult(stdout=stdout, stderr=stderr,
+                                         exit_status=exit_status,
+                                         duration=duration)
+            log.cl_debug("ran [%s] on host [%s], ret = [%d], stdout = [%s], "
+                         "stderr = [%s]",
+                         command, self.sh_hostname, result.cr_exit_status,
+                         result.cr_stdout, result.cr_stderr)
+            results.append(result)
+        return results
+
     def sh_get_kernel_ver(self, log):
         """
         Get the kernel version of the remote machine
         """
+        return self.sh_cached_fact(log, HOST_FACT_KERNEL_VERSION,
+                                   self._sh_get_kernel_ver)
+
+    def _sh_get_kernel_ver(self, log):
+        """
+        Detect the kernel version of the remote machine
+        """
         ret = self.sh_run(log, "/bin/uname -r")
         if ret.cr_exit_status != 0:
             return None
@@ -897,6 +1705,118 @@ class SSHHost(object):
             return -1
         return 0
 
+    def sh_in_process(self, path):
+        """
+        Whether the operation on the path could be done in-process rather
+        than running a command
+        """
+        return self.sh_local and plain_path(path)
+
+    def sh_path_exists(self, log, path):
+        """
+        Whether the path exists on the host
+        """
+        if self.sh_in_process(path):
+            return os.path.exists(path)
+        retval = self.sh_run(log, "test -e %s" % path)
+        return retval.cr_exit_status == 0
+
+    def sh_read_file(self, log, path):
+        """
+        Return the content of a file on the host
+        """
+        if self.sh_in_process(path):
+            try:
+                with open(path, "rb") as fd:
+                    return 0, fd.read()
+            except (IOError, OSError), error:
+                log.cl_error("failed to read file [%s] on host [%s]: %s",
+                             path, self.sh_hostname, error)
+                return -1, None
+
+        command = "cat %s" % path
+        retval = self.sh_run(log, command)
+        if retval.cr_exit_status:
+            log.cl_error("failed to run command [%s] on host [%s], "
+                         "ret = [%d], stdout = [%s], stderr = [%s]",
+                         command, self.sh_hostname,
+                         retval.cr_exit_status,
+                         retval.cr_stdout,
+                         retval.cr_stderr)
+            return -1, None
+        return 0, retval.cr_stdout
+
+    def sh_mkdir(self, log, directory):
+        """
+        Create the directory and its parents if they don't exist
+        """
+        if self.sh_in_process(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, error:
+                if error.errno != errno.EEXIST or not os.path.isdir(directory):
+                    log.cl_error("failed to create directory [%s] on host "
+                                 "[%s]: %s", directory, self.sh_hostname,
+                                 error)
+                    return -1
+            return 0
+
+        command = "mkdir -p %s" % directory
+        retval = self.sh_run(log, command)
+        if retval.cr_exit_status:
+            log.cl_error("failed to run command [%s] on host [%s], "
+                         "ret = [%d], stdout = [%s], stderr = [%s]",
+                         command, self.sh_hostname,
+                         retval.cr_exit_status,
+                         retval.cr_stdout,
+                         retval.cr_stderr)
+            return -1
+        return 0
+
+    def sh_stat(self, log, path):
+        """
+        Return the stat of a file on the host as a dict with keys of mode,
+        size, mtime, ino and dev. Symbol links are followed.
+        """
+        if self.sh_in_process(path):
+            try:
+                stat_result = os.stat(path)
+            except OSError, error:
+                log.cl_error("failed to stat file [%s] on host [%s]: %s",
+                             path, self.sh_hostname, error)
+                return -1, None
+            return 0, {"mode": stat_result.st_mode,
+                       "size": stat_result.st_size,
+                       "mtime": int(stat_result.st_mtime),
+                       "ino": stat_result.st_ino,
+                       "dev": stat_result.st_dev}
+
+        command = "stat -L -c '%%f %%s %%Y %%i %%d' %s" % path
+        retval = self.sh_run(log, command)
+        if retval.cr_exit_status:
+            log.cl_error("failed to run command [%s] on host [%s], "
+                         "ret = [%d], stdout = [%s], stderr = [%s]",
+                         command, self.sh_hostname,
+                         retval.cr_exit_status,
+                         retval.cr_stdout,
+                         retval.cr_stderr)
+            return -1, None
+        fields = retval.cr_stdout.split()
+        if len(fields) != 5:
+            log.cl_error("unexpected output [%s] of command [%s] on host [%s]",
+                         retval.cr_stdout, command, self.sh_hostname)
+            return -1, None
+        try:
+            return 0, {"mode": int(fields[0], 16),
+                       "size": int(fields[1]),
+                       "mtime": int(fields[2]),
+                       "ino": int(fields[3]),
+                       "dev": int(fields[4])}
+        except ValueError:
+            log.cl_error("unexpected output [%s] of command [%s] on host [%s]",
+                         retval.cr_stdout, command, self.sh_hostname)
+            return -1, None
+
     def sh_remove_dir(self, log, directory):
         """
         Remove directory recursively
@@ -908,6 +1828,20 @@ class SSHHost(object):
                              directory)
                 return -1
 
+        if self.sh_in_process(directory):
+            if not os.path.lexists(directory):
+                return 0
+            try:
+                if os.path.isdir(directory) and not os.path.islink(directory):
+                    shutil.rmtree(directory)
+                else:
+                    os.remove(directory)
+            except OSError, error:
+                log.cl_error("failed to remove directory [%s] on host [%s]: "
+                             "%s", directory, self.sh_hostname, error)
+                return -1
+            return 0
+
         ret = self.sh_run(log, "rm -fr %s" % (directory))
         if ret.cr_exit_status != 0:
             log.cl_error("failed to remove directory [%s] on host [%s], "
@@ -922,6 +1856,16 @@ class SSHHost(object):
         """
         Remove file
         """
+        if self.sh_in_process(fpath):
+            try:
+                os.remove(fpath)
+            except OSError, error:
+                if error.errno != errno.ENOENT:
+                    log.cl_error("failed to remove file [%s] on host [%s]: "
+                                 "%s", fpath, self.sh_hostname, error)
+                    return -1
+            return 0
+
         ret = self.sh_run(log, "rm -f %s" % (fpath))
         if ret.cr_exit_status != 0:
             log.cl_error("failed to remove file [%s] on host [%s], "
@@ -938,7 +1882,12 @@ class SSHHost(object):
         Return the command job on a host
         """
         # pylint: disable=too-many-arguments
-        full_command = ssh_command(self.sh_hostname, command)
+        if self.sh_local:
+            full_command = command
+        else:
+            full_command = ssh_command(self.sh_hostname, command,
+                                       identity_file=self.sh_identity_file,
+                                       control_path=self.sh_control_path)
         job = utils.CommandJob(full_command, timeout, stdout_tee, stderr_tee,
                                stdin)
         return job
@@ -1411,6 +2360,64 @@ class SSHHost(object):
             return None
         return retval.cr_stdout.strip()
 
+    def sh_checksums(self, log, paths=None, directory=None, pattern="*",
+                     algorithm="md5", parallelism=CHECKSUM_PARALLELISM):
+        """
+        Calculate the checksums of many files in a single invocation on the
+        host, several processes calculate in parallel. The files are either
+        the paths, or the regular files directly under the directory that
+        match the glob pattern. Algorithm is md5 or sha256. Return a dict
+        with path as key and checksum as value, the files that can't be read
+        are not included. Return None on error.
+        """
+        # pylint: disable=too-many-arguments
+        if algorithm not in ["md5", "sha256"]:
+            log.cl_error("unsupported checksum algorithm [%s]", algorithm)
+            return None
+
+        xargs_command = checksum_command(algorithm=algorithm,
+                                         parallelism=parallelism)
+        stdin = None
+        if paths is not None:
+            if len(paths) == 0:
+                return {}
+            command = xargs_command
+            stdin = "".join([path + "\0" for path in paths])
+        else:
+            command = ("find %s -maxdepth 1 -type f -name '%s' -print0 | %s" %
+                       (directory, pattern, xargs_command))
+        retval = self.sh_run(log, command, stdin=stdin)
+        if retval.cr_exit_status not in [0, XARGS_PARTIAL_FAILURE]:
+            log.cl_error("failed to run command [%s] on host [%s], "
+                         "ret = [%d], stdout = [%s], stderr = [%s]",
+                         command, self.sh_hostname,
+                         retval.cr_exit_status,
+                         retval.cr_stdout,
+                         retval.cr_stderr)
+            return None
+        if retval.cr_exit_status:
+            log.cl_debug("failed to calculate checksums of some files on "
+                         "host [%s]: %s", self.sh_hostname, retval.cr_stderr)
+
+        checksums = {}
+        for line in retval.cr_stdout.splitlines():
+            # Special characters in the path are escaped and the line starts
+            # with a backslash
+            escaped = line.startswith("\\")
+            if escaped:
+                line = line[1:]
+            fields = line.split("  ", 1)
+            if len(fields) != 2:
+                log.cl_error("unexpected line [%s] in the output of command "
+                             "[%s] on host [%s]", line, command,
+                             self.sh_hostname)
+                return None
+            checksum, path = fields
+            if escaped:
+                path = re.sub(r"\\(.)", checksum_unescape, path)
+            checksums[path] = checksum
+        return checksums
+
     def sh_gunzip_md5sum(self, log, fpath):
         """
         Use gunzip to decompress the file and then calculate the md5sum
@@ -1490,12 +2497,29 @@ class SSHHost(object):
         """
         Find RPM on the host
         """
-        command = "rpm -q %s" % rpm_name
-        retval = self.sh_run(log, command)
+        retval = self.sh_run(log, ["rpm", "-q", rpm_name])
         if retval.cr_exit_status:
             return -1
         return 0
 
+    def sh_rpms_installed(self, log, rpm_names):
+        """
+        Check whether many RPMs are installed in a single invocation on the
+        host. Return a dict with RPM name as key and whether the RPM is
+        installed as value. Return None on error.
+        """
+        commands = ["rpm -q %s" % rpm_name for rpm_name in rpm_names]
+        results = self.sh_run_batch(log, commands)
+        if results is None:
+            log.cl_error("failed to query RPMs on host [%s]",
+                         self.sh_hostname)
+            return None
+
+        installed = {}
+        for rpm_name, retval in zip(rpm_names, results):
+            installed[rpm_name] = retval.cr_exit_status == 0
+        return installed
+
     def sh_yumdb_info(self, log, rpm_name):
         """
         Get the key/value pairs of a RPM from yumdb
@@ -1511,20 +2535,7 @@ class SSHHost(object):
                          retval.cr_stdout,
                          retval.cr_stderr)
             return None
-        lines = retval.cr_stdout.splitlines()
-        output_pattern = (r"^ +(?P<key>\S+) = (?P<value>.+)$")
-        output_regular = re.compile(output_pattern)
-        infos = {}
-        for line in lines:
-            match = output_regular.match(line)
-            if match:
-                log.cl_debug("matched pattern [%s] with line [%s]",
-                             output_pattern, line)
-                key = match.group("key")
-                value = match.group("value")
-                infos[key] = value
-
-        return infos
+        return yumdb_info_parse(retval.cr_stdout)
 
     def sh_yumdb_sha256(self, log, rpm_name):
         """
@@ -1551,6 +2562,39 @@ class SSHHost(object):
 
         return rpm_infos["checksum_data"]
 
+    def sh_yumdb_sha256s(self, log, rpm_names):
+        """
+        Get the SHA256 checksums of RPMs from yumdb in a single invocation.
+        Return a dict with RPM name as key and checksum as value, the value
+        is None if failed to get the checksum of the RPM. Return None on
+        error.
+        """
+        commands = ["yumdb info %s" % rpm_name for rpm_name in rpm_names]
+        results = self.sh_run_batch(log, commands)
+        if results is None:
+            log.cl_error("failed to get YUM info of RPMs on host [%s]",
+                         self.sh_hostname)
+            return None
+
+        checksums = {}
+        for rpm_name, retval in zip(rpm_names, results):
+            checksums[rpm_name] = None
+            if retval.cr_exit_status:
+                log.cl_debug("failed to get YUM info of [%s] on host [%s], "
+                             "ret = [%d], stdout = [%s], stderr = [%s]",
+                             rpm_name, self.sh_hostname,
+                             retval.cr_exit_status,
+                             retval.cr_stdout,
+                             retval.cr_stderr)
+                continue
+            rpm_infos = yumdb_info_parse(retval.cr_stdout)
+            if rpm_infos.get("checksum_type") != "sha256":
+                log.cl_debug("no SHA256 checksum of RPM [%s] in yumdb of "
+                             "host [%s]", rpm_name, self.sh_hostname)
+                continue
+            checksums[rpm_name] = rpm_infos.get("checksum_data")
+        return checksums
+
     def sh_sha256sum(self, log, fpath):
         """
         Calculate the sha256sum of a file
@@ -1670,6 +2714,13 @@ class SSHHost(object):
         """
         Check the current status of SELinux
         """
+        return self.sh_cached_fact(log, HOST_FACT_SELINUX_STATUS,
+                                   self._sh_selinux_status)
+
+    def _sh_selinux_status(self, log):
+        """
+        Detect the current status of SELinux
+        """
         command = "getenforce"
         retval = self.sh_run(log, command)
         if retval.cr_exit_status != 0 or retval.cr_stderr != "":
@@ -1705,6 +2756,7 @@ class SSHHost(object):
             return 0
 
         command = "setenforce 0"
+        self.sh_fact_cache.hfc_invalidate(HOST_FACT_SELINUX_STATUS)
         retval = self.sh_run(log, command)
         if retval.cr_exit_status:
             log.cl_error("failed to run command [%s] on host [%s], "
@@ -1839,6 +2891,7 @@ class SSHHost(object):
                          "not up", self.sh_hostname)
             return -1
 
+        self.sh_facts_invalidate(log)
         if force:
             retval = self.sh_run(log, "echo b > /proc/sysrq-trigger &")
         else:
@@ -1864,6 +2917,11 @@ class SSHHost(object):
                          self.sh_hostname)
             return -1
 
+        if (self.sh_latest_uptime != 0 and
+                uptime >= self.sh_latest_uptime + SHORTEST_TIME_REBOOT):
+            log.cl_debug("host [%s] rebooted since last uptime update",
+                         self.sh_hostname)
+            self.sh_facts_invalidate(log)
         self.sh_latest_uptime = uptime
         return 0
 
@@ -1893,6 +2951,7 @@ class SSHHost(object):
                          self.sh_hostname, uptime,
                          uptime_before_reboot)
             return False
+        self.sh_facts_invalidate(log)
         return True
 
     def sh_wait_reboot(self, log, uptime_before_rebooted):
@@ -1901,12 +2960,13 @@ class SSHHost(object):
         """
         log.cl_info("waiting until host [%s] rebooted", self.sh_hostname)
         time_start = time.time()
-        sleep_interval = 1
+        backoff = utils.Backoff(1, WAIT_REBOOT_MAX_INTERVAL,
+                                jitter=WAIT_REBOOT_JITTER)
         while not self.sh_rebooted(log, uptime_before_rebooted):
             time_now = time.time()
             elapsed = time_now - time_start
             if elapsed < LONGEST_TIME_REBOOT:
-                time.sleep(sleep_interval)
+                backoff.bo_sleep(time_start + LONGEST_TIME_REBOOT)
                 continue
             log.cl_error("booting of host [%s] takes too long",
                          self.sh_hostname)
@@ -2078,6 +3138,17 @@ class SSHHost(object):
         """
         Get the repo IDs of yum
         """
+        repo_ids = self.sh_cached_fact(log, HOST_FACT_YUM_REPO_IDS,
+                                       self._sh_yum_repo_ids)
+        if repo_ids is None:
+            return None
+        # Callers might change the list
+        return list(repo_ids)
+
+    def _sh_yum_repo_ids(self, log):
+        """
+        Detect the repo IDs of yum
+        """
         command = "yum repolist -v | grep Repo-id | awk '{print $3}'"
         retval = self.sh_run(log, command)
         if retval.cr_exit_status:
@@ -2274,21 +3345,16 @@ class SSHHost(object):
                          self.sh_hostname)
         log.cl_change_config(simple_console=True,
                              resultsdir=log.cl_resultsdir)
-        args = {}
-        args[watched_io.WATCHEDIO_LOG] = log
-        args[watched_io.WATCHEDIO_HOSTNAME] = self.sh_hostname
-        stdout_fd = watched_io.watched_io_open(stdout_file,
-                                               watched_io.log_watcher_info_simplified,
-                                               args)
-        stderr_fd = watched_io.watched_io_open(stderr_file,
-                                               watched_io.log_watcher_error_simplified,
-                                               args)
+        stdout_fd = open(stdout_file, "w")
+        stderr_fd = open(stderr_file, "w")
         retval = self.sh_run(log, command, stdout_tee=stdout_fd,
                              stderr_tee=stderr_fd, silent=silent,
                              login_name=login_name, timeout=timeout,
                              stdin=stdin, return_stdout=return_stdout,
                              return_stderr=return_stderr, quit_func=quit_func,
-                             flush_tee=flush_tee)
+                             flush_tee=flush_tee,
+                             stdout_line_func=log.cl_info,
+                             stderr_line_func=log.cl_error)
         log.cl_change_config(simple_console=False,
                              resultsdir=log.cl_resultsdir)
         stdout_fd.close()
@@ -2358,6 +3424,73 @@ class SSHHost(object):
                          retval.cr_stderr)
         return size
 
+    def sh_file_stats(self, log, paths):
+        """
+        Stat many files in a single invocation on the host. Return a dict
+        with path as key and a dict of "size", "mode" and "mtime" as value,
+        the files that don't exist are not included. Return None on error.
+        """
+        if len(paths) == 0:
+            return {}
+        command = "xargs -0 -r stat --printf='%s %f %Y %n\\0'"
+        stdin = "".join([path + "\0" for path in paths])
+        retval = self.sh_run(log, command, stdin=stdin)
+        if retval.cr_exit_status not in [0, XARGS_PARTIAL_FAILURE]:
+            log.cl_error("failed to run command [%s] on host [%s], "
+                         "ret = [%d], stdout = [%s], stderr = [%s]",
+                         command, self.sh_hostname,
+                         retval.cr_exit_status, retval.cr_stdout,
+                         retval.cr_stderr)
+            return None
+
+        file_stats = {}
+        for record in retval.cr_stdout.split("\0"):
+            if record == "":
+                continue
+            fields = record.split(" ", 3)
+            try:
+                size = int(fields[0])
+                mode = int(fields[1], 16)
+                mtime = int(fields[2])
+                path = fields[3]
+            except (ValueError, IndexError):
+                log.cl_error("unexpected record [%s] in the output of "
+                             "command [%s] on host [%s]", record, command,
+                             self.sh_hostname)
+                return None
+            file_stats[path] = {"size": size, "mode": mode, "mtime": mtime}
+        return file_stats
+
+    def sh_get_file_sizes(self, log, paths):
+        """
+        Return a dict with path as key and file size as value, the files
+        that don't exist are not included. Return None on error.
+        """
+        file_stats = self.sh_file_stats(log, paths)
+        if file_stats is None:
+            return None
+        return dict((path, file_stat["size"])
+                    for path, file_stat in file_stats.iteritems())
+
+    def sh_files_executable(self, log, paths):
+        """
+        Return a dict with path as key and whether the path is an executable
+        regular file as value. Return None on error.
+        """
+        file_stats = self.sh_file_stats(log, paths)
+        if file_stats is None:
+            return None
+        executables = {}
+        for path in paths:
+            executables[path] = False
+            if path not in file_stats:
+                continue
+            mode = file_stats[path]["mode"]
+            if (stat.S_ISREG(mode) and
+                    mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)):
+                executables[path] = True
+        return executables
+
     def sh_pcs_resources(self, log):
         """
         Return a list of resources
@@ -2449,3 +3582,268 @@ class SSHHost(object):
                          retval.cr_stderr)
             return -1
         return 0
+
+
+def checksum_command(algorithm="md5", parallelism=CHECKSUM_PARALLELISM):
+    """
+    Return the command that calculates the checksums of the NUL-separated
+    paths from stdin. Several processes calculate in parallel, so the
+    order of the output lines is not fixed.
+    """
+    return ("xargs -0 -r -P %d -n %d %ssum" %
+            (parallelism, CHECKSUM_FILES_PER_PROCESS, algorithm))
+
+
+def checksum_unescape(match):
+    """
+    Unescape a special character in the path printed by md5sum/sha256sum
+    """
+    char = match.group(1)
+    if char == "n":
+        return "\n"
+    if char == "r":
+        return "\r"
+    return char
+
+
+def yumdb_info_parse(output):
+    """
+    Return the key/value pairs in the output of "yumdb info"
+    """
+    output_regular = re.compile(r"^ +(?P<key>\S+) = (?P<value>.+)$")
+    infos = {}
+    for line in output.splitlines():
+        match = output_regular.match(line)
+        if match:
+            infos[match.group("key")] = match.group("value")
+    return infos
+
+
+def parse_uptime(retval):
+    """
+    Return the boot time from the result of UPTIME_COMMAND, -1 on error
+    """
+    if retval.cr_exit_status != 0:
+        return -1
+    try:
+        return int(retval.cr_stdout)
+    except ValueError:
+        return -1
+
+
+class RebootingHost(object):
+    """
+    The reboot state of a host managed by RebootOrchestrator
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, host, uptime, force):
+        self.rh_host = host
+        # The boot time of the host before reboot
+        self.rh_uptime = uptime
+        # Whether force reboot should be or has been issued
+        self.rh_force = force
+        # The time that the first reboot was issued
+        self.rh_start_time = None
+        # The time to give up waiting for the issued reboot
+        self.rh_deadline = None
+
+
+class RebootOrchestrator(object):
+    """
+    Reboot a set of hosts in parallel. At most wave_size hosts are rebooting
+    at the same time, and a host never reboots together with the hosts that
+    it conflicts with, e.g. the other host of a HA pair. All the rebooting
+    hosts are checked in a single monitoring loop.
+    """
+    def __init__(self, hosts, wave_size=REBOOT_WAVE_SIZE, conflicts=None):
+        self.ro_hosts = hosts
+        self.ro_wave_size = max(1, wave_size)
+        # Key: hostname, value: the hostnames that should not be down
+        # together with the host
+        if conflicts is None:
+            conflicts = {}
+        self.ro_conflicts = conflicts
+        # The RebootingHost objects of the hosts waiting for reboot
+        self.ro_pending = []
+        # The RebootingHost objects of the hosts that are rebooting
+        self.ro_rebooting = []
+        # Key: hostname, value: the seconds that the reboot took
+        self.ro_durations = {}
+        # The hosts that failed to reboot
+        self.ro_failed = []
+
+    def _ro_prepare(self, log):
+        """
+        Get the boot time and sync the disks of the hosts
+        """
+        uptimes = {}
+        sync_hosts = []
+        host_results = run_on_hosts(log, self.ro_hosts, UPTIME_COMMAND)
+        for host in self.ro_hosts:
+            retval = host_results[host.sh_hostname]
+            uptime = parse_uptime(retval)
+            if uptime < 0:
+                log.cl_error("can't get uptime on host [%s], command = [%s], "
+                             "ret = [%d], stdout = [%s], stderr = [%s]",
+                             host.sh_hostname, UPTIME_COMMAND,
+                             retval.cr_exit_status,
+                             retval.cr_stdout,
+                             retval.cr_stderr)
+                self.ro_failed.append(host)
+                continue
+            uptimes[host.sh_hostname] = uptime
+            sync_hosts.append(host)
+
+        host_results = run_on_hosts(log, sync_hosts, "sync", timeout=120)
+        for host in sync_hosts:
+            retval = host_results[host.sh_hostname]
+            force = False
+            if retval.cr_exit_status != 0:
+                log.cl_error("failed to sync on host [%s], force reboot",
+                             host.sh_hostname)
+                force = True
+            rebooting_host = RebootingHost(host, uptimes[host.sh_hostname],
+                                           force)
+            self.ro_pending.append(rebooting_host)
+
+    def _ro_conflicting(self, rebooting_host):
+        """
+        Whether the host conflicts with any host that is rebooting
+        """
+        hostname = rebooting_host.rh_host.sh_hostname
+        conflicts = self.ro_conflicts.get(hostname, ())
+        for rebooting in self.ro_rebooting:
+            other = rebooting.rh_host.sh_hostname
+            if other in conflicts:
+                return True
+            if hostname in self.ro_conflicts.get(other, ()):
+                return True
+        return False
+
+    def _ro_issue(self, log, rebooting_hosts, force):
+        """
+        Issue reboot on the hosts
+        """
+        if len(rebooting_hosts) == 0:
+            return
+        hosts = []
+        time_now = time.time()
+        for rebooting_host in rebooting_hosts:
+            host = rebooting_host.rh_host
+            host.sh_facts_invalidate(log)
+            hosts.append(host)
+            rebooting_host.rh_force = force
+            if rebooting_host.rh_start_time is None:
+                rebooting_host.rh_start_time = time_now
+            rebooting_host.rh_deadline = time_now + LONGEST_TIME_REBOOT
+        if force:
+            command = "echo b > /proc/sysrq-trigger &"
+        else:
+            command = "reboot &"
+        log.cl_info("issuing %sreboot of hosts %s",
+                    "force " if force else "",
+                    [host.sh_hostname for host in hosts])
+        # The return values are not trustworthy since the connection might
+        # be broken by the reboot, so check the boot time later instead.
+        run_on_hosts(log, hosts, command, circuit_breaker=False)
+
+    def _ro_start_wave(self, log):
+        """
+        Start rebooting the pending hosts as many as allowed, return the
+        number of hosts started
+        """
+        wave = []
+        for rebooting_host in self.ro_pending[:]:
+            if len(self.ro_rebooting) >= self.ro_wave_size:
+                break
+            if self._ro_conflicting(rebooting_host):
+                continue
+            self.ro_pending.remove(rebooting_host)
+            self.ro_rebooting.append(rebooting_host)
+            wave.append(rebooting_host)
+        self._ro_issue(log, [rebooting_host for rebooting_host in wave
+                             if not rebooting_host.rh_force], False)
+        self._ro_issue(log, [rebooting_host for rebooting_host in wave
+                             if rebooting_host.rh_force], True)
+        return len(wave)
+
+    def _ro_check(self, log):
+        """
+        Check whether the rebooting hosts have rebooted
+        """
+        hosts = [rebooting_host.rh_host
+                 for rebooting_host in self.ro_rebooting]
+        host_results = run_on_hosts(log, hosts, UPTIME_COMMAND,
+                                    timeout=REBOOT_CHECK_TIMEOUT,
+                                    circuit_breaker=False)
+        time_now = time.time()
+        force_hosts = []
+        for rebooting_host in self.ro_rebooting[:]:
+            host = rebooting_host.rh_host
+            uptime = parse_uptime(host_results[host.sh_hostname])
+            if uptime >= rebooting_host.rh_uptime + SHORTEST_TIME_REBOOT:
+                host.sh_facts_invalidate(log)
+                host.sh_latest_uptime = uptime
+                duration = time_now - rebooting_host.rh_start_time
+                self.ro_durations[host.sh_hostname] = duration
+                self.ro_rebooting.remove(rebooting_host)
+                log.cl_info("host [%s] rebooted in [%.1f] seconds",
+                            host.sh_hostname, duration)
+                continue
+
+            if time_now < rebooting_host.rh_deadline:
+                continue
+
+            if not rebooting_host.rh_force:
+                log.cl_info("none-force reboot of host [%s] failed, trying "
+                            "force reboot", host.sh_hostname)
+                force_hosts.append(rebooting_host)
+                continue
+
+            log.cl_error("reboot of host [%s] failed", host.sh_hostname)
+            self.ro_rebooting.remove(rebooting_host)
+            self.ro_failed.append(host)
+        self._ro_issue(log, force_hosts, True)
+
+    def ro_run(self, log):
+        """
+        Reboot the hosts, return 0 if all hosts rebooted
+        """
+        time_start = time.time()
+        self._ro_prepare(log)
+        backoff = None
+        while len(self.ro_pending) > 0 or len(self.ro_rebooting) > 0:
+            if self._ro_start_wave(log) > 0:
+                backoff = utils.Backoff(1, WAIT_REBOOT_MAX_INTERVAL,
+                                        jitter=WAIT_REBOOT_JITTER)
+            deadline = min([rebooting_host.rh_deadline
+                            for rebooting_host in self.ro_rebooting])
+            backoff.bo_sleep(deadline)
+            self._ro_check(log)
+
+        slowest = None
+        for hostname, duration in self.ro_durations.iteritems():
+            if slowest is None or duration > self.ro_durations[slowest]:
+                slowest = hostname
+        if slowest is not None:
+            log.cl_info("rebooted [%d] hosts in [%.1f] seconds, the slowest "
+                        "host [%s] took [%.1f] seconds, [%d] failed",
+                        len(self.ro_durations), time.time() - time_start,
+                        slowest, self.ro_durations[slowest],
+                        len(self.ro_failed))
+        if len(self.ro_failed) > 0:
+            log.cl_error("failed to reboot hosts %s",
+                         [host.sh_hostname for host in self.ro_failed])
+            return -1
+        return 0
+
+
+def reboot_hosts(log, hosts, wave_size=REBOOT_WAVE_SIZE, conflicts=None):
+    """
+    Reboot the hosts in parallel, return 0 if all hosts rebooted.
+    Conflicts is a dict with hostname as key and the hostnames that should
+    not be down together with the host as value.
+    """
+    orchestrator = RebootOrchestrator(hosts, wave_size=wave_size,
+                                      conflicts=conflicts)
+    return orchestrator.ro_run(log)
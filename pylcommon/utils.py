@@ -11,6 +11,7 @@ library to install python packages.
 
 from __future__ import print_function
 import os
+import collections
 import errno
 import time
 import signal
@@ -25,6 +26,10 @@ import random
 import string
 import stat
 import socket
+import fcntl
+import traceback
+import tempfile
+import mmap
 
 
 def eprint(*args, **kwargs):
@@ -65,17 +70,20 @@ def signal_pid(pid, sig):
     Sends a signal to a process id. Returns True if the process terminated
     successfully, False otherwise.
     """
-    # pylint: disable=unused-variable
     try:
         os.kill(pid, sig)
     except OSError:
         # The process may have died before we could kill it.
         pass
 
-    for i in range(5):
+    # Most processes die quickly, so check frequently
+    deadline = time.time() + 5
+    while True:
         if not pid_is_alive(pid):
             return True
-        time.sleep(1)
+        if time.time() >= deadline:
+            break
+        time.sleep(0.1)
 
     # The process is still alive
     return False
@@ -98,6 +106,116 @@ def nuke_subprocess(subproc):
             return subproc.poll()
 
 
+# The size of each read from the stdout/stderr of a command
+COMMAND_READ_SIZE = 65536
+# The interval to check whether a command exits after it closed its outputs
+COMMAND_EXIT_CHECK_INTERVAL = 0.01
+# The first interval to check whether a command exits after it closed its
+# outputs, the interval doubles until COMMAND_EXIT_CHECK_INTERVAL. Most
+# commands exit right after closing outputs, so check soon at first.
+COMMAND_EXIT_CHECK_MIN_INTERVAL = 0.0005
+# The exit status when the program of a command can't be executed
+COMMAND_NOT_FOUND = 127
+
+
+# The output of a command bigger than this will be saved in a temporary file
+# rather than memory
+COMMAND_SPILL_SIZE = 16 * 1024 * 1024
+# The output of a command bigger than this will be truncated in debug log
+COMMAND_LOG_SIZE = 4096
+
+
+class SpillBuffer(object):
+    """
+    Buffer of command output. The data is kept in memory until the size
+    exceeds the limit, then moved into a temporary file.
+    """
+    def __init__(self, spill_size=COMMAND_SPILL_SIZE):
+        self.sb_spill_size = spill_size
+        self.sb_memory = StringIO.StringIO()
+        # The temporary file after spilling, None if not spilled
+        self.sb_file = None
+        self.sb_size = 0
+
+    def sb_write(self, data):
+        """
+        Append data to the buffer
+        """
+        if not data:
+            return
+        self.sb_size += len(data)
+        if self.sb_file is not None:
+            self.sb_file.write(data)
+            return
+        self.sb_memory.write(data)
+        if self.sb_spill_size is not None and self.sb_size > self.sb_spill_size:
+            self.sb_file = tempfile.TemporaryFile(prefix="clownfish_output_")
+            self.sb_file.write(self.sb_memory.getvalue())
+            self.sb_memory.close()
+            self.sb_memory = None
+
+    def sb_spilled(self):
+        """
+        Return True if the data has been moved to the temporary file
+        """
+        return self.sb_file is not None
+
+    def sb_read(self, offset=0, size=None):
+        """
+        Read part of the data
+        """
+        if size is None:
+            size = self.sb_size - offset
+        if self.sb_file is None:
+            return self.sb_memory.getvalue()[offset:offset + size]
+        self.sb_file.flush()
+        self.sb_file.seek(offset)
+        data = self.sb_file.read(size)
+        self.sb_file.seek(0, os.SEEK_END)
+        return data
+
+    def sb_getvalue(self):
+        """
+        Return all of the data as a string
+        """
+        return self.sb_read()
+
+    def sb_mmap(self):
+        """
+        Map the temporary file into memory and return the read only mmap
+        object, return None if the data is not spilled or empty
+        """
+        if self.sb_file is None or self.sb_size == 0:
+            return None
+        self.sb_file.flush()
+        return mmap.mmap(self.sb_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def sb_iter_lines(self):
+        """
+        Iterate the lines of the data without the tailing newlines
+        """
+        if self.sb_file is None:
+            for line in self.sb_memory.getvalue().splitlines():
+                yield line
+            return
+        self.sb_file.flush()
+        self.sb_file.seek(0)
+        for line in self.sb_file:
+            yield line.rstrip("\n")
+        self.sb_file.seek(0, os.SEEK_END)
+
+    def sb_summary(self, limit=COMMAND_LOG_SIZE):
+        """
+        Return the data if it is small, otherwise the head and tail of it
+        """
+        if self.sb_size <= limit:
+            return self.sb_getvalue()
+        half = limit / 2
+        return ("%s ... [%d bytes truncated] ... %s" %
+                (self.sb_read(0, half), self.sb_size - half * 2,
+                 self.sb_read(self.sb_size - half, half)))
+
+
 class CommandResult(object):
     """
     All command will return a command result of this class
@@ -106,9 +224,75 @@ class CommandResult(object):
     def __init__(self, stdout="", stderr="",
                  exit_status=None, duration=0):
         self.cr_exit_status = exit_status
-        self.cr_stdout = stdout
-        self.cr_stderr = stderr
+        self._cr_stdout = stdout
+        self._cr_stderr = stderr
         self.cr_duration = duration
+        # Whether the command was killed because of timeout
+        self.cr_timeout = False
+        # The sizes of the outputs, even if they are not returned
+        self.cr_stdout_bytes = 0
+        self.cr_stderr_bytes = 0
+        # The SpillBuffer of the outputs if the result is from a CommandJob.
+        # The strings will only be generated when cr_stdout/cr_stderr is
+        # accessed, so big outputs could be processed through the buffers
+        # without being loaded into memory.
+        self.cr_stdout_buffer = None
+        self.cr_stderr_buffer = None
+
+    @property
+    def cr_stdout(self):
+        """
+        The stdout of the command
+        """
+        if self._cr_stdout is None:
+            self._cr_stdout = self.cr_stdout_buffer.sb_getvalue()
+        return self._cr_stdout
+
+    @cr_stdout.setter
+    def cr_stdout(self, value):
+        self._cr_stdout = value
+        self.cr_stdout_buffer = None
+
+    @property
+    def cr_stderr(self):
+        """
+        The stderr of the command
+        """
+        if self._cr_stderr is None:
+            self._cr_stderr = self.cr_stderr_buffer.sb_getvalue()
+        return self._cr_stderr
+
+    @cr_stderr.setter
+    def cr_stderr(self, value):
+        self._cr_stderr = value
+        self.cr_stderr_buffer = None
+
+    def cr_set_buffers(self, stdout_buffer, stderr_buffer):
+        """
+        Use the buffers as the outputs, None means no output
+        """
+        if stdout_buffer is not None:
+            self._cr_stdout = None
+        self.cr_stdout_buffer = stdout_buffer
+        if stderr_buffer is not None:
+            self._cr_stderr = None
+        self.cr_stderr_buffer = stderr_buffer
+
+    def cr_stdout_summary(self, limit=COMMAND_LOG_SIZE):
+        """
+        Return stdout truncated to the limit for logging
+        """
+        if self._cr_stdout is None:
+            return self.cr_stdout_buffer.sb_summary(limit)
+        return output_summary(self._cr_stdout, limit)
+
+    def cr_stderr_summary(self, limit=COMMAND_LOG_SIZE):
+        """
+        Return stderr truncated to the limit for logging
+        """
+        if self._cr_stderr is None:
+            return self.cr_stderr_buffer.sb_summary(limit)
+        return output_summary(self._cr_stderr, limit)
 
     def cr_clear(self):
         """
@@ -118,18 +302,35 @@ class CommandResult(object):
         self.cr_stderr = ""
         self.cr_duration = 0
         self.cr_exit_status = None
+        self.cr_timeout = False
+        self.cr_stdout_bytes = 0
+        self.cr_stderr_bytes = 0
+
+
+def output_summary(output, limit=COMMAND_LOG_SIZE):
+    """
+    Return the output if it is small, otherwise the head and tail of it
+    """
+    if len(output) <= limit:
+        return output
+    half = limit / 2
+    return ("%s ... [%d bytes truncated] ... %s" %
+            (output[:half], len(output) - half * 2, output[-half:]))
 
 
 class CommandJob(object):
     """
-    Each running of a command has an object of this class
+    Each running of a command has an object of this class. The command is
+    either a string run by bash, or a list of program and arguments that is
+    executed directly without a shell.
     """
     # pylint: disable=too-many-instance-attributes
     def __init__(self, command, timeout=None, stdout_tee=None,
                  stderr_tee=None, stdin=None, return_stdout=True,
                  return_stderr=True, quit_func=None,
-                 flush_tee=False, silent=False):
-        # pylint: disable=too-many-arguments
+                 flush_tee=False, silent=False, stdout_line_func=None,
+                 stderr_line_func=None, spill_size=COMMAND_SPILL_SIZE):
+        # pylint: disable=too-many-arguments,too-many-locals
         self.cj_command = command
         self.cj_result = CommandResult()
         self.cj_timeout = timeout
@@ -146,9 +347,9 @@ class CommandJob(object):
             self.cj_string_stdin = None
             self.cj_stdin = None
         if return_stdout:
-            self.cj_stdout_file = StringIO.StringIO()
+            self.cj_stdout_file = SpillBuffer(spill_size=spill_size)
         if return_stderr:
-            self.cj_stderr_file = StringIO.StringIO()
+            self.cj_stderr_file = SpillBuffer(spill_size=spill_size)
         self.cj_started = False
         self.cj_killed = False
         self.cj_start_time = None
@@ -158,6 +359,13 @@ class CommandJob(object):
         self.cj_return_stdout = return_stdout
         self.cj_return_stderr = return_stderr
         self.cj_flush_tee = flush_tee
+        # Functions called with each line (without the tailing newline) of
+        # stdout/stderr as soon as the line is complete
+        self.cj_stdout_line_func = stdout_line_func
+        self.cj_stderr_line_func = stderr_line_func
+        # The incomplete lines that have not been passed to line functions
+        self.cj_stdout_partial = ""
+        self.cj_stderr_partial = ""
 
     def cj_run_start(self):
         """
@@ -170,6 +378,17 @@ class CommandJob(object):
         self.cj_start_time = time.time()
         if self.cj_timeout:
             self.cj_max_stop_time = self.cj_timeout + self.cj_start_time
+        if isinstance(self.cj_command, list):
+            try:
+                self.cj_subprocess = subprocess.Popen(self.cj_command,
+                                                      stdout=subprocess.PIPE,
+                                                      stderr=subprocess.PIPE,
+                                                      stdin=self.cj_stdin)
+            except OSError, error:
+                self.cj_result.cr_stderr = ("failed to execute %s: %s" %
+                                            (self.cj_command, error))
+                return COMMAND_NOT_FOUND
+            return 0
         shell = '/bin/bash'
         self.cj_subprocess = subprocess.Popen(self.cj_command,
                                               stdout=subprocess.PIPE,
@@ -193,6 +412,9 @@ class CommandJob(object):
         """
         self.cj_process_output(is_stdout=True, final_read=True)
         self.cj_process_output(is_stdout=False, final_read=True)
+        # Pass the last lines without newline
+        self.cj_handle_output(True, "")
+        self.cj_handle_output(False, "")
         if self.cj_stdout_tee:
             self.cj_stdout_tee.flush()
         if self.cj_stderr_tee:
@@ -200,18 +422,24 @@ class CommandJob(object):
         self.cj_subprocess.stdout.close()
         self.cj_subprocess.stderr.close()
         self.cj_stop_time = time.time()
+        stdout_buffer = None
+        stderr_buffer = None
         if self.cj_return_stdout:
-            self.cj_result.cr_stdout = self.cj_stdout_file.getvalue()
+            stdout_buffer = self.cj_stdout_file
         if self.cj_return_stderr:
-            self.cj_result.cr_stderr = self.cj_stderr_file.getvalue()
+            stderr_buffer = self.cj_stderr_file
+        self.cj_result.cr_set_buffers(stdout_buffer, stderr_buffer)
         self.cj_result.cr_duration = self.cj_stop_time - self.cj_start_time
+        self.cj_result.cr_timeout = (self.cj_killed and
+                                     bool(self.cj_timeout) and
+                                     self.cj_stop_time >= self.cj_max_stop_time)
         if not self.cj_silent:
             logging.debug("command [%s] finished, "
                           "ret = [%d], stdout = [%s], stderr = [%s]",
                           self.cj_command,
                           self.cj_result.cr_exit_status,
-                          self.cj_result.cr_stdout,
-                          self.cj_result.cr_stderr)
+                          self.cj_result.cr_stdout_summary(),
+                          self.cj_result.cr_stderr_summary())
 
     def cj_run(self):
         """
@@ -230,6 +458,7 @@ class CommandJob(object):
                           self.cj_result.cr_exit_status,
                           self.cj_result.cr_stdout,
                           self.cj_result.cr_stderr)
+            return self.cj_result
 
         self.cj_wait_for_command()
         self.cj_post_exit()
@@ -239,33 +468,101 @@ class CommandJob(object):
         """
         Process the stdout or stderr
         """
-        buf = None
         if is_stdout:
             pipe = self.cj_subprocess.stdout
-            if self.cj_return_stdout:
-                buf = self.cj_stdout_file
-            tee = self.cj_stdout_tee
         else:
             pipe = self.cj_subprocess.stderr
-            if self.cj_return_stderr:
-                buf = self.cj_stderr_file
-            tee = self.cj_stderr_tee
 
         if final_read:
             # read in all the data we can from pipe and then stop
             tmp_data = []
             while select.select([pipe], [], [], 0)[0]:
-                tmp_data.append(os.read(pipe.fileno(), 1024))
+                tmp_data.append(os.read(pipe.fileno(), COMMAND_READ_SIZE))
                 if len(tmp_data[-1]) == 0:
                     break
             data = "".join(tmp_data)
         else:
             # perform a single read
-            data = os.read(pipe.fileno(), 1024)
-        if buf is not None:
-            buf.write(data)
+            data = os.read(pipe.fileno(), COMMAND_READ_SIZE)
+        self.cj_handle_output(is_stdout, data)
+        return len(data)
+
+    def cj_handle_output(self, is_stdout, data):
+        """
+        Save the data read from stdout or stderr
+        """
+        if is_stdout:
+            self.cj_result.cr_stdout_bytes += len(data)
+            if self.cj_return_stdout:
+                self.cj_stdout_file.sb_write(data)
+            tee = self.cj_stdout_tee
+        else:
+            self.cj_result.cr_stderr_bytes += len(data)
+            if self.cj_return_stderr:
+                self.cj_stderr_file.sb_write(data)
+            tee = self.cj_stderr_tee
         if tee:
             tee.write(data)
+            if self.cj_flush_tee:
+                tee.flush()
+        if is_stdout and self.cj_stdout_line_func is not None:
+            self.cj_stdout_partial = self._cj_split_lines(self.cj_stdout_partial,
+                                                          data,
+                                                          self.cj_stdout_line_func)
+        elif not is_stdout and self.cj_stderr_line_func is not None:
+            self.cj_stderr_partial = self._cj_split_lines(self.cj_stderr_partial,
+                                                          data,
+                                                          self.cj_stderr_line_func)
+
+    def _cj_split_lines(self, partial, data, line_func):
+        """
+        Call line_func on each complete line, return the incomplete line
+        left. Empty data means EOF, so the incomplete line will be passed too.
+        """
+        # pylint: disable=no-self-use
+        if not data:
+            if partial:
+                line_func(partial)
+            return ""
+        lines = (partial + data).split("\n")
+        for line in lines[:-1]:
+            line_func(line)
+        return lines[-1]
+
+    def cj_iter_lines(self):
+        """
+        Run the command and yield the lines of stdout as soon as they are
+        complete. After the iteration finishes, the result is in cj_result.
+        Use return_stdout=False to process unlimited output with constant
+        memory. If the iteration is abandoned before the command exits, the
+        command is killed.
+        """
+        lines = collections.deque()
+        self.cj_stdout_line_func = lines.append
+        if self.cj_started:
+            return
+
+        ret = self.cj_run_start()
+        if ret:
+            self.cj_result.cr_exit_status = ret
+            return
+
+        exited = False
+        try:
+            for _ in self._cj_wait_iter():
+                while lines:
+                    yield lines.popleft()
+            self.cj_post_exit()
+            exited = True
+            while lines:
+                yield lines.popleft()
+        finally:
+            if not exited:
+                self.cj_kill()
+                process = self.cj_subprocess
+                for pipe in (process.stdin, process.stdout, process.stderr):
+                    if pipe is not None and not pipe.closed:
+                        pipe.close()
 
     def cj_kill(self):
         """
@@ -279,6 +576,13 @@ class CommandJob(object):
         """
         Wait until the command exits
         """
+        for _ in self._cj_wait_iter():
+            pass
+
+    def _cj_wait_iter(self):
+        """
+        Wait until the command exits, yield after each round of select
+        """
         # pylint: disable=too-many-branches
         read_list = []
         write_list = []
@@ -297,25 +601,32 @@ class CommandJob(object):
         else:
             time_left = None  # so that select never times out
 
+        exit_check_interval = COMMAND_EXIT_CHECK_MIN_INTERVAL
         while not self.cj_timeout or time_left > 0:
             # select will return when we may write to stdin or when there is
             # stdout/stderr output we can read (including when it is
             # EOF, that is the process has terminated).
             # To check for processes which terminate without producing any
-            # output, a 1 second timeout is used in select.
+            # output, a 1 second timeout is used in select. When all outputs
+            # have been closed, the process is about to exit, so check more
+            # often.
+            if read_list or write_list:
+                select_timeout = 1
+            else:
+                select_timeout = exit_check_interval
+                exit_check_interval = min(exit_check_interval * 2,
+                                          COMMAND_EXIT_CHECK_INTERVAL)
             read_ready, write_ready, _ = select.select(read_list, write_list,
-                                                       [], 1)
+                                                       [], select_timeout)
 
             # os.read() has to be used instead of
             # subproc.stdout.read() which will otherwise block
             for file_obj in read_ready:
                 is_stdout = reverse_dict[file_obj]
-                self.cj_process_output(is_stdout)
-                if self.cj_flush_tee:
-                    if is_stdout:
-                        self.cj_stdout_tee.flush()
-                    else:
-                        self.cj_stderr_tee.flush()
+                size = self.cj_process_output(is_stdout)
+                if size == 0:
+                    # EOF, no need to select it any more
+                    read_list.remove(file_obj)
 
             for file_obj in write_ready:
                 # we can write PIPE_BUF bytes without blocking
@@ -332,6 +643,8 @@ class CommandJob(object):
             if self.cj_result.cr_exit_status is not None:
                 return
 
+            yield
+
             if self.cj_timeout:
                 time_left = self.cj_max_stop_time - time.time()
 
@@ -340,25 +653,644 @@ class CommandJob(object):
 
         # Kill process if timeout
         self.cj_kill()
-        return
+
+
+COMMAND_REACTOR_STDOUT = "stdout"
+COMMAND_REACTOR_STDERR = "stderr"
+COMMAND_REACTOR_STDIN = "stdin"
+# The number of consecutive failed iterations after which the event loop
+# considers its reactor broken, fails all of the commands and starts over
+COMMAND_EVENT_LOOP_MAX_ERRORS = 3
+
+
+class CommandReactor(object):
+    """
+    Drive many running CommandJobs from a single thread using epoll, instead
+    of one thread for each job
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, quit_func=None, check_interval=1):
+        self.cmr_epoll = select.epoll()
+        # Key: file descriptor, Value: (job, COMMAND_REACTOR_*)
+        self.cmr_fds = {}
+        # Key: job, Value: the callback when the job finishes
+        self.cmr_callbacks = {}
+        # Key: job, Value: number of the outputs that are not closed
+        self.cmr_open_outputs = {}
+        self.cmr_quit_func = quit_func
+        # Processes might exit without closing the outputs, e.g. a child
+        # process in the background keeps the outputs open. So check the
+        # status of all jobs with this interval.
+        self.cmr_check_interval = check_interval
+        self.cmr_last_check_time = time.time()
+        # The pipe to wake up the reactor from other threads
+        self.cmr_wakeup_read, self.cmr_wakeup_write = os.pipe()
+        for fd in (self.cmr_wakeup_read, self.cmr_wakeup_write):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.cmr_epoll.register(self.cmr_wakeup_read, select.EPOLLIN)
+
+    def cmr_add(self, job, callback=None):
+        """
+        Start a job and add it into the reactor. The callback will be called
+        with the job as the argument when the job finishes.
+        """
+        ret = job.cj_run_start()
+        if ret:
+            return ret
+
+        process = job.cj_subprocess
+        for pipe, fd_type in ((process.stdout, COMMAND_REACTOR_STDOUT),
+                              (process.stderr, COMMAND_REACTOR_STDERR)):
+            self.cmr_epoll.register(pipe.fileno(), select.EPOLLIN)
+            self.cmr_fds[pipe.fileno()] = (job, fd_type)
+        self.cmr_open_outputs[job] = 2
+        if job.cj_string_stdin is not None:
+            if job.cj_string_stdin:
+                fd = process.stdin.fileno()
+                self.cmr_epoll.register(fd, select.EPOLLOUT)
+                self.cmr_fds[fd] = (job, COMMAND_REACTOR_STDIN)
+            else:
+                process.stdin.close()
+        self.cmr_callbacks[job] = callback
+        return 0
+
+    def _cmr_unregister(self, fd):
+        """
+        Stop watching a file descriptor
+        """
+        self.cmr_epoll.unregister(fd)
+        del self.cmr_fds[fd]
+
+    def _cmr_write_stdin(self, job, fd):
+        """
+        Write the stdin of a job
+        """
+        # we can write PIPE_BUF bytes without blocking
+        data = job.cj_string_stdin[:select.PIPE_BUF]
+        try:
+            written = os.write(fd, data)
+        except OSError:
+            # The process exited without reading all of the input
+            written = len(job.cj_string_stdin)
+        job.cj_string_stdin = job.cj_string_stdin[written:]
+        if not job.cj_string_stdin:
+            self._cmr_unregister(fd)
+            job.cj_subprocess.stdin.close()
+
+    def _cmr_finish(self, job, kill=False):
+        """
+        The job finished, cleanup and call the callback
+        """
+        for fd, value in self.cmr_fds.items():
+            if value[0] is job:
+                self._cmr_unregister(fd)
+        if kill:
+            job.cj_kill()
+        if job.cj_subprocess.stdin is not None and not job.cj_subprocess.stdin.closed:
+            job.cj_subprocess.stdin.close()
+        job.cj_post_exit()
+        callback = self.cmr_callbacks[job]
+        del self.cmr_callbacks[job]
+        del self.cmr_open_outputs[job]
+        if callback is not None:
+            callback(job)
+
+    def _cmr_poll_timeout(self, now, last_check_time):
+        """
+        Return the timeout of epoll
+        """
+        timeout = max(0, last_check_time + self.cmr_check_interval - now)
+        for job, open_outputs in self.cmr_open_outputs.iteritems():
+            if open_outputs == 0:
+                return COMMAND_EXIT_CHECK_INTERVAL
+            if job.cj_max_stop_time is not None:
+                timeout = min(timeout, max(0, job.cj_max_stop_time - now))
+        return timeout
+
+    def cmr_wakeup(self):
+        """
+        Wake up the reactor waiting in cmr_run_once(), could be called from
+        other threads
+        """
+        try:
+            os.write(self.cmr_wakeup_write, "x")
+        except OSError as error:
+            # The pipe is full, which means the reactor will wake up anyway
+            if error.errno != errno.EAGAIN:
+                raise
+
+    def cmr_run_once(self, max_timeout=None):
+        """
+        Wait for the events once and process them
+        """
+        # pylint: disable=too-many-branches
+        now = time.time()
+        timeout = self._cmr_poll_timeout(now, self.cmr_last_check_time)
+        if max_timeout is not None:
+            timeout = min(timeout, max_timeout)
+        try:
+            events = self.cmr_epoll.poll(timeout)
+        except IOError as error:
+            if error.errno == errno.EINTR:
+                return
+            raise
+
+        for fd, _ in events:
+            if fd == self.cmr_wakeup_read:
+                os.read(fd, COMMAND_READ_SIZE)
+                continue
+            if fd not in self.cmr_fds:
+                continue
+            job, fd_type = self.cmr_fds[fd]
+            if fd_type == COMMAND_REACTOR_STDIN:
+                self._cmr_write_stdin(job, fd)
+                continue
+            data = os.read(fd, COMMAND_READ_SIZE)
+            if data:
+                job.cj_handle_output(fd_type == COMMAND_REACTOR_STDOUT,
+                                     data)
+            else:
+                self._cmr_unregister(fd)
+                self.cmr_open_outputs[job] -= 1
+
+        now = time.time()
+        check_all = (now - self.cmr_last_check_time >=
+                     self.cmr_check_interval)
+        if check_all:
+            self.cmr_last_check_time = now
+        quit_all = (self.cmr_quit_func is not None and
+                    self.cmr_quit_func())
+        for job in self.cmr_callbacks.keys():
+            if check_all or self.cmr_open_outputs[job] == 0:
+                job.cj_result.cr_exit_status = job.cj_subprocess.poll()
+                if job.cj_result.cr_exit_status is not None:
+                    self._cmr_finish(job)
+                    continue
+            if (quit_all or
+                    (job.cj_max_stop_time is not None and
+                     now >= job.cj_max_stop_time) or
+                    (check_all and job.cj_quit_func is not None and
+                     job.cj_quit_func())):
+                self._cmr_finish(job, kill=True)
+
+    def cmr_run(self):
+        """
+        Run until all of the jobs finish
+        """
+        while self.cmr_callbacks:
+            self.cmr_run_once()
+        return 0
+
+    def cmr_abort(self, reason):
+        """
+        Kill all of the jobs and finish them as failed
+        """
+        for job, callback in self.cmr_callbacks.items():
+            try:
+                job.cj_kill()
+            except:
+                logging.error("failed to kill command [%s]: %s",
+                              job.cj_command, traceback.format_exc())
+            job.cj_result.cr_exit_status = -1
+            job.cj_result.cr_stderr = reason
+            if callback is not None:
+                callback(job)
+        self.cmr_fds = {}
+        self.cmr_callbacks = {}
+        self.cmr_open_outputs = {}
+
+    def cmr_close(self):
+        """
+        Release the resources of the reactor
+        """
+        self.cmr_epoll.close()
+        os.close(self.cmr_wakeup_read)
+        os.close(self.cmr_wakeup_write)
+
+
+def run_jobs(jobs, quit_func=None, parallelism=None):
+    """
+    Run the jobs in parallel using a single thread, return the results
+    with the same order of the jobs. At most parallelism jobs will be
+    running at the same time if parallelism is not None.
+    """
+    reactor = CommandReactor(quit_func=quit_func)
+    pending = list(jobs)
+    pending.reverse()
+
+    def _run_jobs_start(job):
+        """
+        Start the next job when a job finishes
+        """
+        # pylint: disable=unused-argument
+        while pending:
+            next_job = pending.pop()
+            ret = reactor.cmr_add(next_job, callback=_run_jobs_start)
+            if ret == 0:
+                break
+            next_job.cj_result.cr_exit_status = ret
+
+    if parallelism is None:
+        parallelism = len(jobs)
+    for _ in range(parallelism):
+        _run_jobs_start(None)
+    reactor.cmr_run()
+    reactor.cmr_close()
+    return [job.cj_result for job in jobs]
+
+
+class CommandFuture(object):
+    """
+    The handle of a command running in the background CommandEventLoop
+    """
+    def __init__(self, job):
+        self.cf_job = job
+        self.cf_event = threading.Event()
+        self.cf_lock = threading.Lock()
+        self.cf_callbacks = []
+
+    def cf_done(self):
+        """
+        Return True if the command has finished
+        """
+        return self.cf_event.is_set()
+
+    def cf_wait(self, timeout=None):
+        """
+        Wait until the command finishes, return the CommandResult, or None
+        if the command does not finish within the timeout
+        """
+        self.cf_event.wait(timeout)
+        if not self.cf_event.is_set():
+            return None
+        return self.cf_job.cj_result
+
+    def cf_add_done_callback(self, callback):
+        """
+        Call the callback with the future as the argument when the command
+        finishes. The callback will be called in the thread of the event
+        loop, or immediately if the command has already finished.
+        """
+        self.cf_lock.acquire()
+        if not self.cf_event.is_set():
+            self.cf_callbacks.append(callback)
+            self.cf_lock.release()
+            return
+        self.cf_lock.release()
+        callback(self)
+
+    def cf_finish(self, job):
+        """
+        Called by the event loop when the command finishes
+        """
+        # pylint: disable=unused-argument
+        self.cf_lock.acquire()
+        self.cf_event.set()
+        callbacks = self.cf_callbacks
+        self.cf_callbacks = []
+        self.cf_lock.release()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except:
+                logging.error("callback of command [%s] failed: %s",
+                              self.cf_job.cj_command,
+                              traceback.format_exc())
+
+
+class CommandEventLoop(object):
+    """
+    A thread running a CommandReactor forever, commands could be submitted
+    to it from any thread
+    """
+    def __init__(self):
+        self.cel_reactor = CommandReactor()
+        self.cel_lock = threading.Lock()
+        # The futures that are submitted but not added into the reactor yet
+        self.cel_pending = []
+        self.cel_thread = None
+
+    def cel_start(self):
+        """
+        Start the thread of the event loop
+        """
+        self.cel_thread = thread_start(self.cel_main, ())
+
+    def cel_submit(self, job):
+        """
+        Submit a job to the event loop, return a CommandFuture
+        """
+        future = CommandFuture(job)
+        self.cel_lock.acquire()
+        self.cel_pending.append(future)
+        reactor = self.cel_reactor
+        self.cel_lock.release()
+        reactor.cmr_wakeup()
+        return future
+
+    def _cel_iterate(self):
+        """
+        Add the pending futures into the reactor and process the events once
+        """
+        reactor = self.cel_reactor
+        self.cel_lock.acquire()
+        pending = self.cel_pending
+        self.cel_pending = []
+        self.cel_lock.release()
+        for future in pending:
+            try:
+                ret = reactor.cmr_add(future.cf_job,
+                                      callback=future.cf_finish)
+            except:
+                future.cf_job.cj_result.cr_stderr = traceback.format_exc()
+                ret = -1
+            if ret:
+                future.cf_job.cj_result.cr_exit_status = ret
+                future.cf_finish(future.cf_job)
+        reactor.cmr_run_once()
+
+    def _cel_reset(self, reason):
+        """
+        Fail all of the running commands and replace the broken reactor
+        """
+        old_reactor = self.cel_reactor
+        self.cel_lock.acquire()
+        self.cel_reactor = CommandReactor()
+        self.cel_lock.release()
+        old_reactor.cmr_abort(reason)
+        try:
+            old_reactor.cmr_close()
+        except:
+            logging.error("failed to close the reactor: %s",
+                          traceback.format_exc())
+
+    def cel_main(self):
+        """
+        The main function of the event loop thread
+        """
+        errors = 0
+        while True:
+            try:
+                self._cel_iterate()
+                errors = 0
+            except:
+                reason = traceback.format_exc()
+                logging.error("command event loop failed: %s", reason)
+                errors += 1
+                if errors >= COMMAND_EVENT_LOOP_MAX_ERRORS:
+                    self._cel_reset(reason)
+                    errors = 0
+
+
+# The upper bounds in seconds of the latency histogram buckets, from 1ms
+# to about 35 minutes, the last bucket has no upper bound
+COMMAND_LATENCY_BUCKETS = [0.001 * (2 ** i) for i in range(22)]
+# The tools that the first argument is a sub-command, the class of the
+# command includes the sub-command, e.g. "lctl get_param"
+COMMAND_SUBCOMMAND_TOOLS = ["lctl", "lfs", "pcs", "systemctl", "yum", "zfs",
+                            "zpool"]
+# The max number of command classes of each host, commands of other classes
+# are counted as COMMAND_CLASS_OTHER
+COMMAND_CLASS_MAX = 256
+COMMAND_CLASS_OTHER = "other"
+# The host name of the commands run by utils.run()
+COMMAND_STATISTICS_LOCALHOST = "localhost"
+
+
+def command_class(command):
+    """
+    Return the normalized class of a command, e.g.
+    "/usr/sbin/lctl get_param -n version" -> "lctl get_param"
+    """
+    if isinstance(command, list):
+        words = command
+    else:
+        words = command.split()
+    index = 0
+    # Skip the environment variables
+    while index < len(words) and "=" in words[index]:
+        index += 1
+    if index >= len(words):
+        return COMMAND_CLASS_OTHER
+    tool = os.path.basename(words[index])
+    if tool not in COMMAND_SUBCOMMAND_TOOLS:
+        return tool
+    for word in words[index + 1:]:
+        if not word.startswith("-"):
+            return tool + " " + word
+    return tool
+
+
+class CommandClassStats(object):
+    """
+    Statistics of a class of commands on a host
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self):
+        self.ccst_count = 0
+        self.ccst_failures = 0
+        self.ccst_timeouts = 0
+        self.ccst_total_time = 0.0
+        self.ccst_max_time = 0.0
+        self.ccst_stdout_bytes = 0
+        self.ccst_stderr_bytes = 0
+        # The last one is for the latency bigger than all buckets
+        self.ccst_buckets = [0] * (len(COMMAND_LATENCY_BUCKETS) + 1)
+
+    def ccst_record(self, retval):
+        """
+        Record the result of a command
+        """
+        self.ccst_count += 1
+        if retval.cr_exit_status:
+            self.ccst_failures += 1
+        if retval.cr_timeout:
+            self.ccst_timeouts += 1
+        duration = retval.cr_duration
+        self.ccst_total_time += duration
+        if duration > self.ccst_max_time:
+            self.ccst_max_time = duration
+        self.ccst_stdout_bytes += retval.cr_stdout_bytes
+        self.ccst_stderr_bytes += retval.cr_stderr_bytes
+        index = 0
+        for upper_bound in COMMAND_LATENCY_BUCKETS:
+            if duration <= upper_bound:
+                break
+            index += 1
+        self.ccst_buckets[index] += 1
+
+    def ccst_percentile(self, percent):
+        """
+        Return the estimated latency of the percentile, i.e. the upper bound
+        of the bucket that the percentile falls into
+        """
+        if self.ccst_count == 0:
+            return 0.0
+        threshold = self.ccst_count * percent / 100.0
+        accumulated = 0
+        for index, count in enumerate(self.ccst_buckets):
+            accumulated += count
+            if accumulated >= threshold:
+                if index < len(COMMAND_LATENCY_BUCKETS):
+                    return min(COMMAND_LATENCY_BUCKETS[index],
+                               self.ccst_max_time)
+                break
+        return self.ccst_max_time
+
+    def ccst_encode(self):
+        """
+        Return the statistics as a dict
+        """
+        if self.ccst_count:
+            average = self.ccst_total_time / self.ccst_count
+        else:
+            average = 0.0
+        return {"count": self.ccst_count,
+                "failures": self.ccst_failures,
+                "timeouts": self.ccst_timeouts,
+                "average": average,
+                "max": self.ccst_max_time,
+                "p50": self.ccst_percentile(50),
+                "p95": self.ccst_percentile(95),
+                "p99": self.ccst_percentile(99),
+                "stdout_bytes": self.ccst_stdout_bytes,
+                "stderr_bytes": self.ccst_stderr_bytes,
+                "buckets": list(self.ccst_buckets)}
+
+
+class CommandStatistics(object):
+    """
+    Statistics of the commands, grouped by host and command class
+    """
+    def __init__(self):
+        # Key: hostname, value: dict of command class -> CommandClassStats
+        self.cst_hosts = {}
+        self.cst_lock = threading.Lock()
+        self.cst_start_time = time.time()
+
+    def cst_record(self, hostname, command, retval):
+        """
+        Record the result of a command on a host, the command could be a
+        string or an argv list
+        """
+        cmd_class = command_class(command)
+        self.cst_lock.acquire()
+        if hostname not in self.cst_hosts:
+            self.cst_hosts[hostname] = {}
+        classes = self.cst_hosts[hostname]
+        if cmd_class not in classes:
+            if len(classes) >= COMMAND_CLASS_MAX:
+                cmd_class = COMMAND_CLASS_OTHER
+            if cmd_class not in classes:
+                classes[cmd_class] = CommandClassStats()
+        classes[cmd_class].ccst_record(retval)
+        self.cst_lock.release()
+
+    def cst_encode(self, hostnames=None):
+        """
+        Return the statistics as a dict which can be dumped to JSON/YAML.
+        If hostnames is not None, only include these hosts.
+        """
+        hosts = {}
+        self.cst_lock.acquire()
+        for hostname, classes in self.cst_hosts.iteritems():
+            if hostnames is not None and hostname not in hostnames:
+                continue
+            encoded_classes = {}
+            for cmd_class, stats in classes.iteritems():
+                encoded_classes[cmd_class] = stats.ccst_encode()
+            hosts[hostname] = encoded_classes
+        self.cst_lock.release()
+        return {"start_time": self.cst_start_time,
+                "buckets": COMMAND_LATENCY_BUCKETS,
+                "hosts": hosts}
+
+    def cst_reset(self):
+        """
+        Clear all of the statistics
+        """
+        self.cst_lock.acquire()
+        self.cst_hosts = {}
+        self.cst_start_time = time.time()
+        self.cst_lock.release()
+
+
+COMMAND_STATISTICS = CommandStatistics()
+
+COMMAND_EVENT_LOOP = None
+COMMAND_EVENT_LOOP_LOCK = threading.Lock()
+
+
+def command_event_loop():
+    """
+    Return the event loop shared by the process, start it if necessary
+    """
+    # pylint: disable=global-statement
+    global COMMAND_EVENT_LOOP
+    COMMAND_EVENT_LOOP_LOCK.acquire()
+    if COMMAND_EVENT_LOOP is None:
+        COMMAND_EVENT_LOOP = CommandEventLoop()
+        COMMAND_EVENT_LOOP.cel_start()
+    COMMAND_EVENT_LOOP_LOCK.release()
+    return COMMAND_EVENT_LOOP
+
+
+def run_async(command, timeout=None, stdout_tee=None, stderr_tee=None,
+              stdin=None, return_stdout=True, return_stderr=True,
+              quit_func=None, flush_tee=False, silent=False,
+              stdout_line_func=None, stderr_line_func=None):
+    """
+    Start to run a command in the background event loop and return a
+    CommandFuture immediately. The arguments have the same meanings as
+    run(). Note the line functions will be called in the thread of the
+    event loop.
+    """
+    # pylint: disable=too-many-arguments
+    job = CommandJob(command, timeout=timeout, stdout_tee=stdout_tee,
+                     stderr_tee=stderr_tee, stdin=stdin,
+                     return_stdout=return_stdout, return_stderr=return_stderr,
+                     quit_func=quit_func, flush_tee=flush_tee, silent=silent,
+                     stdout_line_func=stdout_line_func,
+                     stderr_line_func=stderr_line_func)
+    if not isinstance(command, (basestring, list)):
+        job.cj_result.cr_stderr = ("type of command argument is not a "
+                                   "basestring or list")
+        job.cj_result.cr_exit_status = -1
+        future = CommandFuture(job)
+        future.cf_finish(job)
+        return future
+    return command_event_loop().cel_submit(job)
 
 
 def run(command, timeout=None, stdout_tee=None, stderr_tee=None, stdin=None,
         return_stdout=True, return_stderr=True, quit_func=None,
-        flush_tee=False, silent=False):
+        flush_tee=False, silent=False, stdout_line_func=None,
+        stderr_line_func=None, stats_hostname=COMMAND_STATISTICS_LOCALHOST):
     """
     Run a command
+    If command is a list, the program is executed directly with the
+    arguments, without a shell.
+    If stdout_line_func/stderr_line_func is not None, it will be called
+    with each line of the output as soon as the line is complete.
+    The result is recorded in COMMAND_STATISTICS under stats_hostname,
+    unless stats_hostname is None.
     """
     # pylint: disable=too-many-arguments
-    if not isinstance(command, basestring):
-        stderr = "type of command argument is not a basestring"
+    if not isinstance(command, (basestring, list)):
+        stderr = "type of command argument is not a basestring or list"
         return CommandResult(stderr=stderr, exit_status=-1)
 
     job = CommandJob(command, timeout=timeout, stdout_tee=stdout_tee,
                      stderr_tee=stderr_tee, stdin=stdin,
                      return_stdout=return_stdout, return_stderr=return_stderr,
-                     quit_func=quit_func, flush_tee=flush_tee, silent=silent)
-    return job.cj_run()
+                     quit_func=quit_func, flush_tee=flush_tee, silent=silent,
+                     stdout_line_func=stdout_line_func,
+                     stderr_line_func=stderr_line_func)
+    retval = job.cj_run()
+    if stats_hostname is not None:
+        COMMAND_STATISTICS.cst_record(stats_hostname, command, retval)
+    return retval
 
 
 def thread_start(target, args):
@@ -420,7 +1352,45 @@ def mkdir(dirname):
 WAIT_CONDITION_QUIT = 8192
 
 
-def wait_condition(log, condition_func, args, timeout=90, sleep_interval=1):
+class Backoff(object):
+    """
+    The intervals between the retries of waiting. The interval starts from
+    initial and is multiplied by factor after each retry until reaching
+    maximum. If maximum is None, the interval is fixed. Jitter is the
+    fraction of the interval that is randomized, so that many waiters will
+    not retry at the same time.
+    """
+    def __init__(self, initial=1, maximum=None, factor=2, jitter=0.0):
+        self.bo_interval = initial
+        self.bo_maximum = maximum
+        self.bo_factor = factor
+        self.bo_jitter = jitter
+
+    def bo_next(self):
+        """
+        Return the next interval
+        """
+        interval = self.bo_interval
+        if self.bo_maximum is not None:
+            self.bo_interval = min(self.bo_interval * self.bo_factor,
+                                   self.bo_maximum)
+        if self.bo_jitter > 0:
+            interval *= 1 + random.uniform(-self.bo_jitter, self.bo_jitter)
+        return interval
+
+    def bo_sleep(self, deadline=None):
+        """
+        Sleep for the next interval, but not beyond the deadline
+        """
+        interval = self.bo_next()
+        if deadline is not None:
+            interval = min(interval, deadline - time.time())
+        if interval > 0:
+            time.sleep(interval)
+
+
+def wait_condition(log, condition_func, args, timeout=90, sleep_interval=1,
+                   max_interval=None, jitter=0.0):
     # pylint: disable=too-many-arguments
     """
     Wait until the condition_func returns 0
@@ -430,8 +1400,11 @@ def wait_condition(log, condition_func, args, timeout=90, sleep_interval=1):
     The return value should be an integer or a tuple starts with an integer
     If the integer returned by condition_func is zero, quit waiting
     The condition_func could set log.cl_abort to True to quit wait
+    If max_interval is not None, the interval grows exponentially from
+    sleep_interval to max_interval.
     """
     time_start = time.time()
+    backoff = Backoff(sleep_interval, max_interval, jitter=jitter)
     log.cl_abort = False
     while True:
         retval = condition_func(log, *args)
@@ -452,7 +1425,7 @@ def wait_condition(log, condition_func, args, timeout=90, sleep_interval=1):
 
         if elapsed < timeout:
             if sleep_interval > 0:
-                time.sleep(sleep_interval)
+                backoff.bo_sleep(time_start + timeout)
             continue
         log.cl_error("waiting times out after [%d] seconds", elapsed)
         break